@@ -3,28 +3,50 @@ import json
 import urllib.request
 import urllib.error
 import os
-import base64
+import sys
 import io
-from urllib.parse import parse_qs
+import logging
+from urllib.parse import parse_qs, urlsplit
+
+# Shared helpers live next to the proxy server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+from image_processing import image_preprocessor
+from multipart import PartRejected, UploadLimits, iter_multipart, parse_boundary
+from upload_body import Base64DataURI, StreamingJSONBody
+from upstream import upstream_pool
+
+# Function logs are whatever reaches stdout; debug lines (payload previews) are off unless LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='[%(levelname)s] %(message)s',
+                    stream=sys.stdout)
+logger = logging.getLogger('inkflow.vercel')
+
+# Checked per part while the upload streams in
+UPLOAD_LIMITS = UploadLimits(
+    int(os.getenv('MAX_FILES_PER_REQUEST', '5')),
+    int(os.getenv('MAX_FILE_SIZE_MB', '10')) * 1024 * 1024
+)
 
 class handler(BaseHTTPRequestHandler):
     def do_POST(self):
-        """Handle POST requests to /api/chat"""
+        """Handle POST requests to /api/chat (and /api/chat/stream, rewritten to ?stream=1)"""
+        self._upload_parts = []
+        url = urlsplit(self.path)
+        stream = url.path.rstrip('/').endswith('/stream') or parse_qs(url.query).get('stream') == ['1']
         try:
             # Get content length and type
             content_length = int(self.headers.get('Content-Length', 0))
             content_type = self.headers.get('Content-Type', '')
 
-            # Read request body
-            post_data = self.rfile.read(content_length)
+            logger.debug("Content-Type: %s", content_type)
+            logger.debug("Content-Length: %d", content_length)
 
-            print(f"[DEBUG] Content-Type: {content_type}")
-            print(f"[DEBUG] Content-Length: {content_length}")
-
-            # Handle multipart/form-data (file uploads)
+            # Handle multipart/form-data (file uploads), streamed from the socket
             if content_type.startswith('multipart/form-data'):
-                payload = self._parse_multipart(post_data, content_type)
+                payload = self._parse_multipart(content_type, content_length)
             else:
+                # Read request body
+                post_data = self.rfile.read(content_length)
+
                 # Parse JSON
                 try:
                     payload = json.loads(post_data.decode('utf-8'))
@@ -40,50 +62,56 @@ class handler(BaseHTTPRequestHandler):
             n8n_url = os.getenv('N8N_WEBHOOK_BASE_URL', 'https://inkflow.eu.ngrok.io')
             webhook_url = f"{n8n_url}/webhook-test/chat"
 
-            print(f"[DEBUG] Forwarding to: {webhook_url}")
+            logger.debug("Forwarding to: %s", webhook_url)
 
-            # Truncate imageUrl for logging to avoid huge logs
-            log_payload = payload.copy()
-            if 'imageUrl' in log_payload:
-                log_payload['imageUrl'] = log_payload['imageUrl'][:100] + '...[truncated]'
-            print(f"[DEBUG] Payload: {json.dumps(log_payload)}")
-
-            # Forward to n8n
-            req = urllib.request.Request(
-                webhook_url,
-                data=json.dumps(payload).encode('utf-8'),
-                headers={
-                    'Content-Type': 'application/json',
-                    'User-Agent': 'InkFlow-Vercel/1.0'
-                }
-            )
+            if logger.isEnabledFor(logging.DEBUG):
+                # Truncate imageUrl for logging to avoid huge logs
+                log_payload = payload.copy()
+                if 'imageUrl' in log_payload:
+                    log_payload['imageUrl'] = str(log_payload['imageUrl'])[:100] + '...[truncated]'
+                logger.debug("Payload: %s", json.dumps(log_payload))
 
+            # Forward to n8n over a keep-alive connection reused across warm invocations
             try:
-                with urllib.request.urlopen(req, timeout=30) as response:
-                    response_data = response.read()
-
-                    print(f"[DEBUG] n8n response status: {response.status}")
-                    print(f"[DEBUG] n8n response: {response_data[:200]}")
+                if stream:
+                    self._relay_stream(webhook_url, payload)
+                    return
 
-                    # Send response
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-                    self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-                    self.end_headers()
+                response = upstream_pool.post(
+                    webhook_url,
+                    StreamingJSONBody(payload),
+                    headers={
+                        'Content-Type': 'application/json',
+                        'User-Agent': 'InkFlow-Vercel/1.0'
+                    },
+                    timeout=30
+                )
+                response_data = response.body
+
+                logger.info("n8n response status: %d", response.status)
+                logger.debug("n8n response: %r", response_data[:200])
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Upstream pool: %s", upstream_pool.stats())
+
+                # Send response
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+                self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+                self.end_headers()
 
-                    if response_data:
-                        self.wfile.write(response_data)
-                    else:
-                        self.wfile.write(json.dumps({
-                            "status": "success",
-                            "message": "הודעה נשלחה בהצלחה!"
-                        }).encode())
+                if response_data:
+                    self.wfile.write(response_data)
+                else:
+                    self.wfile.write(json.dumps({
+                        "status": "success",
+                        "message": "הודעה נשלחה בהצלחה!"
+                    }).encode())
 
             except urllib.error.HTTPError as e:
                 error_body = e.read().decode() if e.fp else str(e)
-                print(f"[ERROR] n8n HTTP error {e.code}: {error_body}")
+                logger.error("n8n HTTP error %d: %s", e.code, error_body)
 
                 self.send_response(502)
                 self.send_header('Content-Type', 'application/json')
@@ -95,7 +123,7 @@ class handler(BaseHTTPRequestHandler):
                 }).encode())
 
             except urllib.error.URLError as e:
-                print(f"[ERROR] n8n connection error: {str(e)}")
+                logger.error("n8n connection error: %s", e)
 
                 self.send_response(502)
                 self.send_header('Content-Type', 'application/json')
@@ -106,8 +134,18 @@ class handler(BaseHTTPRequestHandler):
                     "details": str(e)
                 }).encode())
 
+        except PartRejected as e:
+            logger.warning("Upload rejected: %s", e)
+
+            self.send_response(e.status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(json.dumps({"error": str(e)}).encode())
+
         except Exception as e:
-            print(f"[ERROR] Unexpected error: {str(e)}")
+            logger.error("Unexpected error: %s", e, exc_info=True)
 
             self.send_response(500)
             self.send_header('Content-Type', 'application/json')
@@ -118,6 +156,53 @@ class handler(BaseHTTPRequestHandler):
                 "details": str(e)
             }).encode())
 
+        finally:
+            # Release spooled upload files
+            for part in self._upload_parts:
+                part.close()
+
+    def _relay_stream(self, webhook_url, payload):
+        """Relay the n8n answer to the client as its bytes arrive"""
+        response = upstream_pool.stream(
+            webhook_url,
+            StreamingJSONBody(payload),
+            headers={
+                'Content-Type': 'application/json',
+                'User-Agent': 'InkFlow-Vercel/1.0'
+            },
+            timeout=30
+        )
+        logger.info("n8n stream status: %d", response.status)
+
+        # HTTP/1.0 response: the body ends when the connection closes
+        self.send_response(200)
+        self.send_header('Content-Type', response.headers.get('Content-Type') or 'application/json')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.end_headers()
+
+        relayed = 0
+        try:
+            for chunk in response.iter_chunks():
+                self.wfile.write(chunk)
+                self.wfile.flush()
+                relayed += len(chunk)
+        except urllib.error.URLError as e:
+            # Headers are out already; the client sees a truncated body
+            logger.error("n8n stream failed after %d bytes: %s", relayed, e)
+            return
+        finally:
+            response.close()
+
+        if not relayed:
+            self.wfile.write(json.dumps({
+                "status": "success",
+                "message": "הודעה נשלחה בהצלחה!"
+            }).encode())
+        logger.debug("Streamed %d bytes from n8n", relayed)
+
     def do_OPTIONS(self):
         """Handle CORS preflight"""
         self.send_response(200)
@@ -126,71 +211,63 @@ class handler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         self.end_headers()
 
-    def _parse_multipart(self, post_data, content_type):
-        """Parse multipart/form-data and convert to JSON with base64 images"""
+    def _parse_multipart(self, content_type, content_length):
+        """Parse multipart/form-data from the socket into a payload with a streamed image"""
         try:
-            # Extract boundary from content-type
-            boundary = content_type.split('boundary=')[1].encode()
-            parts = post_data.split(b'--' + boundary)
+            boundary = parse_boundary(content_type)
 
             payload = {}
-            images = []
+            first_image = None
 
-            for part in parts:
-                if not part or part == b'--\r\n' or part == b'--':
+            for part in iter_multipart(self.rfile, boundary, content_length, limits=UPLOAD_LIMITS):
+                if part.name == 'chatInput' and not part.is_file:
+                    payload['chatInput'] = part.text()
+                    logger.debug("Chat message: %s", payload['chatInput'])
                     continue
 
-                # Split headers from content
-                if b'\r\n\r\n' not in part:
-                    continue
-
-                headers_section, content = part.split(b'\r\n\r\n', 1)
-                content = content.rstrip(b'\r\n')
-
-                # Parse Content-Disposition header
-                headers = headers_section.decode('utf-8', errors='ignore')
-
-                if 'name="chatInput"' in headers:
-                    payload['chatInput'] = content.decode('utf-8', errors='ignore')
-                    print(f"[DEBUG] Chat message: {payload['chatInput']}")
-
-                elif 'name="photo_' in headers and 'filename=' in headers:
-                    # Extract filename
-                    filename_start = headers.find('filename="') + 10
-                    filename_end = headers.find('"', filename_start)
-                    filename = headers[filename_start:filename_end]
-
-                    # Convert file to base64
-                    file_b64 = base64.b64encode(content).decode('utf-8')
-
-                    # Determine MIME type from filename
-                    mime_type = 'image/jpeg'
-                    if filename.lower().endswith('.png'):
-                        mime_type = 'image/png'
-                    elif filename.lower().endswith('.gif'):
-                        mime_type = 'image/gif'
-                    elif filename.lower().endswith('.webp'):
-                        mime_type = 'image/webp'
-
-                    images.append({
-                        'filename': filename,
-                        'mimeType': mime_type,
-                        'data': file_b64
-                    })
-
-                    print(f"[DEBUG] Image attached: {filename} ({len(content)} bytes)")
-
-            # Add images to payload if any
-            if images:
-                # Convert first image to data URI for AI agent vision
-                first_image = images[0]
-                data_uri = f"data:{first_image['mimeType']};base64,{first_image['data']}"
-                payload['imageUrl'] = data_uri
+                if part.name.startswith('photo_') and part.is_file and part.filename:
+                    logger.debug("Image attached: %s (%d bytes)", part.filename, part.size)
+                    # Only the first image is forwarded to the AI agent
+                    if first_image is None:
+                        first_image = part
+                        continue
+
+                part.close()
+
+            # Add image to payload if any
+            if first_image is not None:
+                self._upload_parts.append(first_image)
+
+                # Downscale, strip EXIF and recompress before it goes upstream
+                bytes_before, bytes_after = image_preprocessor.process([first_image], timeout=20)
+                logger.debug("Image preprocessing: %d -> %d bytes", bytes_before, bytes_after)
+
+                # Convert first image to data URI for AI agent vision, encoded while sending
+                if first_image.content_type.startswith('image/'):
+                    mime_type = first_image.content_type
+                else:
+                    mime_type = self._guess_image_type(first_image.filename)
+                payload['imageUrl'] = Base64DataURI(first_image.file, first_image.size, mime_type,
+                                                    encoded=first_image.encoded)
                 payload['hasImage'] = True
-                print(f"[DEBUG] Image data URI created: {first_image['filename']}")
+                logger.debug("Image data URI attached: %s", first_image.filename)
 
             return payload
 
+        except PartRejected:
+            raise
         except Exception as e:
-            print(f"[ERROR] Multipart parsing error: {str(e)}")
+            logger.error("Multipart parsing error: %s", e)
             raise ValueError(f"Failed to parse multipart data: {str(e)}")
+
+    @staticmethod
+    def _guess_image_type(filename):
+        """Determine MIME type from filename"""
+        mime_type = 'image/jpeg'
+        if filename.lower().endswith('.png'):
+            mime_type = 'image/png'
+        elif filename.lower().endswith('.gif'):
+            mime_type = 'image/gif'
+        elif filename.lower().endswith('.webp'):
+            mime_type = 'image/webp'
+        return mime_type
@@ -0,0 +1,208 @@
+"""Admission control: a bounded wait queue in front of the request handlers.
+
+At most ADMISSION_MAX_ACTIVE requests are handled at once. A request that
+arrives while every slot is taken waits in a FIFO queue instead of having
+its connection reset, so a short burst is absorbed and served a moment
+later. The wait is bounded twice: each lane queues at most
+ADMISSION_QUEUE_SIZE requests, and a request gives up after
+ADMISSION_QUEUE_TIMEOUT_SECONDS. Either way the client gets 503 with a
+Retry-After estimated from how long requests currently hold a slot.
+
+Requests go into one of two lanes. Chat calls (and job polls) can hold a
+slot for many seconds; static assets, health checks and metrics take
+milliseconds. The priority lane has ADMISSION_RESERVED_SLOTS slots chat
+can never take, and freed slots go to waiting priority requests first, so
+the landing page and health probes stay responsive under chat load.
+"""
+import asyncio
+import collections
+import math
+import os
+import threading
+import time
+
+from metrics import Gauge, metrics
+
+ADMISSION_MAX_ACTIVE = int(os.getenv('ADMISSION_MAX_ACTIVE', '0'))  # 0 = per engine, see proxy_server
+ADMISSION_RESERVED_SLOTS = int(os.getenv('ADMISSION_RESERVED_SLOTS', '5'))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '100'))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT_SECONDS', '10'))
+MAX_RETRY_AFTER = 30
+
+PRIORITY, CHAT = 'priority', 'chat'
+# Order in which freed slots are handed out
+LANES = (PRIORITY, CHAT)
+
+
+def lane_for(method, path):
+    """Chat calls and job polls queue behind each other; everything else is quick"""
+    if path.startswith('/api/chat') and method in ('POST', 'GET', 'HEAD'):
+        return CHAT
+    return PRIORITY
+
+
+class Overloaded(Exception):
+    """No slot within the queueing deadline, or the lane's queue is full"""
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    __slots__ = ('lane', 'wake', 'granted')
+
+    def __init__(self, lane, wake):
+        self.lane = lane
+        self.wake = wake
+        self.granted = False
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionController:
+    """Request slots shared by the lanes, with a bounded FIFO queue per lane"""
+    def __init__(self, max_active=ADMISSION_MAX_ACTIVE, reserved=ADMISSION_RESERVED_SLOTS,
+                 queue_size=ADMISSION_QUEUE_SIZE, timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_active = max_active
+        self.reserved = reserved
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.active = dict.fromkeys(LANES, 0)
+        self.waiting = {lane: collections.deque() for lane in LANES}
+        # Moving average of how long a request holds its slot, per lane
+        self.hold_seconds = dict.fromkeys(LANES, 0.1)
+        self.admitted = dict.fromkeys(LANES, 0)
+        self.queued = dict.fromkeys(LANES, 0)
+        self.rejected = {}
+
+    def has_room(self, lane):
+        if sum(self.active.values()) >= self.max_active:
+            return False
+        # Chat never takes the slots reserved for the priority lane
+        return lane == PRIORITY or self.active[CHAT] < max(1, self.max_active - self.reserved)
+
+    def retry_after(self, lane):
+        """Seconds until the lane's queue has likely drained, for the Retry-After header"""
+        capacity = max(1, self.max_active - (self.reserved if lane == CHAT else 0))
+        estimate = self.hold_seconds[lane] * (len(self.waiting[lane]) + 1) / capacity
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(estimate)))
+
+    def reject(self, lane, reason):
+        key = (lane, reason)
+        self.rejected[key] = self.rejected.get(key, 0) + 1
+        metrics.count_admission_rejected(lane, reason)
+        return Overloaded(reason, self.retry_after(lane))
+
+    def enqueue(self, lane, wake):
+        """Take a slot now (returns None) or join the lane's queue (returns its ticket)"""
+        with self.lock:
+            # Only jump straight in when nobody of this lane is waiting ahead
+            if not self.waiting[lane] and self.has_room(lane):
+                self.active[lane] += 1
+                self.admitted[lane] += 1
+                return None
+            if len(self.waiting[lane]) >= self.queue_size:
+                raise self.reject(lane, 'queue_full')
+            ticket = _Ticket(lane, wake)
+            self.waiting[lane].append(ticket)
+            self.queued[lane] += 1
+            return ticket
+
+    def abandon(self, ticket, reason='timeout'):
+        """Leave the queue after the deadline; True if a slot was granted in the meantime"""
+        with self.lock:
+            if ticket.granted:
+                return True
+            self.waiting[ticket.lane].remove(ticket)
+            raise self.reject(ticket.lane, reason)
+
+    def grant(self):
+        """Hand free slots to waiting requests, priority lane first (called with the lock held)"""
+        for lane in LANES:
+            queue = self.waiting[lane]
+            while queue and self.has_room(lane):
+                ticket = queue.popleft()
+                ticket.granted = True
+                self.active[lane] += 1
+                self.admitted[lane] += 1
+                ticket.wake()
+
+    def acquire(self, lane):
+        """Block until the request may run; returns the admission time for release()"""
+        queued_at = time.monotonic()
+        event = threading.Event()
+        ticket = self.enqueue(lane, event.set)
+        if ticket is not None and not event.wait(self.timeout):
+            self.abandon(ticket)
+        admitted_at = time.monotonic()
+        metrics.observe_admission_wait(lane, admitted_at - queued_at)
+        return admitted_at
+
+    async def acquire_async(self, lane):
+        """acquire() for the asyncio engine: waits on a future instead of blocking the loop"""
+        queued_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        ticket = self.enqueue(lane, lambda: loop.call_soon_threadsafe(_resolve, future))
+        if ticket is not None:
+            try:
+                await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self.abandon(ticket)
+            except asyncio.CancelledError:
+                # The client went away while queued
+                try:
+                    if self.abandon(ticket, 'cancelled'):
+                        self.release(lane, time.monotonic())
+                except Overloaded:
+                    pass
+                raise
+        admitted_at = time.monotonic()
+        metrics.observe_admission_wait(lane, admitted_at - queued_at)
+        return admitted_at
+
+    def release(self, lane, admitted_at):
+        held = time.monotonic() - admitted_at
+        with self.lock:
+            self.active[lane] -= 1
+            self.hold_seconds[lane] += 0.1 * (held - self.hold_seconds[lane])
+            self.grant()
+
+    def depths(self):
+        """Requests waiting per lane, for the queue depth gauge"""
+        return {(lane,): len(self.waiting[lane]) for lane in LANES}
+
+    def waiting_count(self):
+        return sum(len(queue) for queue in self.waiting.values())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_active': self.max_active,
+                'reserved_priority_slots': self.reserved,
+                'queue_size': self.queue_size,
+                'queue_timeout': self.timeout,
+                'lanes': {
+                    lane: {
+                        'active': self.active[lane],
+                        'waiting': len(self.waiting[lane]),
+                        'admitted': self.admitted[lane],
+                        'queued': self.queued[lane],
+                        'avg_hold_seconds': round(self.hold_seconds[lane], 3),
+                        'rejected': {reason: count for (rejected_lane, reason), count in self.rejected.items()
+                                     if rejected_lane == lane},
+                    }
+                    for lane in LANES
+                },
+            }
+
+
+# Shared controller for both serving engines
+admission = AdmissionController()
+metrics.register(Gauge('inkflow_admission_queue_depth', 'Requests waiting for an admission slot, by lane.',
+                       ('lane',), admission.depths))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Local stand-in for the n8n chat webhook, for benchmarks and load tests.
+
+Answers POSTs to any /webhook/... or /webhook-test/... path like the
+workflow's Respond node would ({"output": ...}), after an injected delay.
+Faults can be injected to see how the proxy copes:
+
+    --latency 2 --jitter 0.5     think time per call (uniform +/- jitter)
+    --error-rate 0.05            share of calls answered 500
+    --fail-primary               /webhook/ always fails (exercises the fallback URL)
+    --slow-body 3                dribble the response body over 3 seconds
+    --stream                     NDJSON token stream, like a streaming Webhook node
+
+GET /__stats returns call counts, so a load run can check how many n8n
+executions it caused (coalescing, caching and merging all lower it).
+
+Usage: python fake_n8n.py [--port 5678] [options]
+"""
+import argparse
+import http.server
+import json
+import random
+import threading
+import time
+
+REPLY_WORDS = ('Thanks', 'for', 'your', 'message!', 'Our', 'artist', 'will', 'get', 'back', 'to', 'you', 'soon.')
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'calls': 0, 'errors': 0, 'bytes_received': 0}
+
+    def add(self, **amounts):
+        with self.lock:
+            for key, amount in amounts.items():
+                self.counts[key] = self.counts.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class FakeN8nHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None
+    stats = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            size = 0
+            while True:
+                chunk_size = int(self.rfile.readline().split(b';')[0], 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    return size
+                size += len(self.rfile.read(chunk_size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        remaining = length
+        while remaining:
+            data = self.rfile.read(min(remaining, 64 * 1024))
+            if not data:
+                break
+            remaining -= len(data)
+        return length - remaining
+
+    def send_json(self, status, document):
+        body = json.dumps(document).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/__stats':
+            self.send_json(200, self.stats.snapshot())
+        else:
+            self.send_json(404, {'message': 'not found'})
+
+    def do_POST(self):
+        options = self.options
+        received = self.read_body()
+        self.stats.add(calls=1, bytes_received=received)
+        if options.fail_primary and self.path.startswith('/webhook/'):
+            self.stats.add(errors=1)
+            self.send_json(500, {'message': 'primary webhook disabled'})
+            return
+        delay = max(0.0, options.latency + random.uniform(-options.jitter, options.jitter))
+        time.sleep(delay)
+        if random.random() < options.error_rate:
+            self.stats.add(errors=1)
+            self.send_json(500, {'message': 'Error in workflow'})
+            return
+        if options.stream:
+            self.send_stream()
+            return
+        body = json.dumps({'output': ' '.join(REPLY_WORDS), 'received_bytes': received}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if options.slow_body > 0:
+            # Same bytes, spread over slow_body seconds
+            pieces = 10
+            step = max(1, len(body) // pieces)
+            for start in range(0, len(body), step):
+                self.wfile.write(body[start:start + step])
+                self.wfile.flush()
+                time.sleep(options.slow_body / pieces)
+        else:
+            self.wfile.write(body)
+
+    def send_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        items = [{'type': 'begin'}] + [{'type': 'item', 'content': word + ' '} for word in REPLY_WORDS] + [{'type': 'end'}]
+        gap = self.options.slow_body / len(items) if self.options.slow_body > 0 else 0.02
+        for item in items:
+            data = (json.dumps(item) + '\n').encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+            time.sleep(gap)
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class FakeN8nServer(http.server.ThreadingHTTPServer):
+    # The default backlog of 5 resets connections in a burst: the benchmark would measure this server
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def make_server(host, port, options):
+    """A fake n8n server (not started); options is the parsed argparse namespace"""
+    handler = type('Handler', (FakeN8nHandler,), {'options': options, 'stats': Stats()})
+    return FakeN8nServer((host, port), handler)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Fake n8n chat webhook with fault injection')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5678)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds per call (default 0.5)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='uniform +/- seconds around --latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls answered 500 (0-1)')
+    parser.add_argument('--slow-body', type=float, default=0.0, help='seconds to spread the response body over')
+    parser.add_argument('--stream', action='store_true', help='answer with a chunked NDJSON token stream')
+    parser.add_argument('--fail-primary', action='store_true', help='answer 500 on /webhook/ paths')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = make_server(args.host, args.port, args)
+    print(f"Fake n8n on http://{args.host}:{args.port} (latency {args.latency}s, errors {args.error_rate:.0%})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+"""Load generator and benchmark runner for the InkFlow proxy.
+
+Drives a running proxy (or one it starts itself with --spawn, next to an
+in-process fake n8n) with a weighted mix of requests:
+
+    chat_json     POST /api/chat, a text message (one session per client)
+    chat_upload   POST /api/chat, multipart with a real image from src/images
+    health        GET /api/health
+    static        GET of the landing page and its assets (gzip/br accepted)
+
+Each concurrency level is a stage of closed-loop clients running for
+--duration seconds. Per stage it reports throughput, p50/p95/p99 latency
+overall and per scenario, error counts, and the proxy's RSS and thread
+count (its whole process tree, so pre-fork workers are included).
+Results can be saved as a baseline and diffed against a later run:
+
+    python loadgen.py --spawn --concurrency 1,8,32 --save baselines/main.json
+    python loadgen.py --spawn --concurrency 1,8,32 --compare baselines/main.json
+
+psutil is used for process stats when installed; otherwise /proc is read
+(Linux, proxy process only).
+"""
+import argparse
+import datetime
+import glob
+import http.client
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import fake_n8n
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+STATIC_DIR = os.path.join(os.path.dirname(SERVER_DIR), 'src')
+
+DEFAULT_MIX = 'chat_json=6,chat_upload=1,health=1,static=2'
+STATIC_PATHS = ['/', '/index.html', '/styles.css', '/chat.js']
+# Typical first messages on the landing page (Hebrew and English)
+MESSAGES = [
+    'היי, כמה עולה קעקוע קטן על פרק כף היד?',
+    'אפשר לקבוע תור לשבוע הבא?',
+    'מה שעות הפעילות של הסטודיו?',
+    'Hi! Do you do fine-line tattoos?',
+    'I have a reference photo, can you price it?',
+    'כמה זמן לוקח להחלים אחרי קעקוע?',
+]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(samples):
+    values = sorted(samples)
+    return {
+        'p50': percentile(values, 0.50),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': values[-1] if values else 0.0,
+        'mean': sum(values) / len(values) if values else 0.0,
+    }
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario '{name}' (choose from {', '.join(SCENARIOS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def find_images(limit_bytes):
+    """Real photos for the upload scenario, smallest first"""
+    paths = []
+    for pattern in ('*.png', '*.jpg', '*.jpeg'):
+        paths += glob.glob(os.path.join(STATIC_DIR, 'images', pattern))
+    images = []
+    for path in sorted(paths, key=os.path.getsize):
+        if os.path.getsize(path) <= limit_bytes:
+            with open(path, 'rb') as f:
+                images.append((os.path.basename(path), f.read()))
+    return images
+
+
+def json_payload(session_id, text):
+    """The body src/chat.js sends for a text message"""
+    return {
+        'chatInput': text,
+        'sessionId': session_id,
+        'senderName': '',
+        'senderPhone': '',
+        'timestamp': datetime.datetime.now().isoformat(),
+        'userAgent': 'InkFlow-LoadGen/1.0',
+        'connectionStatus': 'connected',
+        'hasFiles': False,
+    }
+
+
+def multipart_body(fields, files):
+    """multipart/form-data body and Content-Type for fields {name: text} and files [(name, filename, data)]"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode('utf-8')
+                     + value.encode('utf-8') + b'\r\n')
+    for name, filename, data in files:
+        content_type = 'image/png' if filename.lower().endswith('.png') else 'image/jpeg'
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('ascii'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class Client:
+    """One closed-loop client: a keep-alive connection and its own chat session"""
+    def __init__(self, runner, index):
+        self.runner = runner
+        self.session_id = f'loadgen-{os.getpid()}-{index}-{uuid.uuid4().hex[:8]}'
+        self.counter = itertools.count()
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.runner.host, self.runner.port, timeout=self.runner.timeout)
+            try:
+                self.conn.request(method, path, body=body, headers=headers or {})
+                response = self.conn.getresponse()
+                response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.close()
+                return response.status
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # A kept-alive connection the server had already closed: retry once on a new one
+                self.close()
+                if attempt == 2:
+                    raise
+            except Exception:
+                self.close()
+                raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def chat_json(self):
+        text = f"{random.choice(MESSAGES)} #{next(self.counter)}"
+        body = json.dumps(json_payload(self.session_id, text), ensure_ascii=False).encode('utf-8')
+        return self.request('POST', '/api/chat', body, {'Content-Type': 'application/json',
+                                                         'X-Session-Id': self.session_id})
+
+    def chat_upload(self):
+        if not self.runner.images:
+            return self.chat_json()
+        filename, data = random.choice(self.runner.images)
+        body, content_type = multipart_body(
+            {'chatInput': f'{random.choice(MESSAGES)} #{next(self.counter)}', 'sessionId': self.session_id,
+             'hasFiles': 'true'},
+            [('photo_0', filename, data)])
+        return self.request('POST', '/api/chat', body, {'Content-Type': content_type,
+                                                         'X-Session-Id': self.session_id})
+
+    def health(self):
+        return self.request('GET', '/api/health')
+
+    def static(self):
+        return self.request('GET', random.choice(STATIC_PATHS), headers={'Accept-Encoding': 'br, gzip'})
+
+
+SCENARIOS = {name: getattr(Client, name) for name in ('chat_json', 'chat_upload', 'health', 'static')}
+
+
+class ProcessSampler:
+    """Samples RSS and thread count of a process tree in the background"""
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.thread = None
+        try:
+            import psutil
+            self.psutil = psutil
+        except ImportError:
+            self.psutil = None
+
+    def sample(self):
+        if self.psutil is not None:
+            try:
+                root = self.psutil.Process(self.pid)
+                processes = [root] + root.children(recursive=True)
+                rss = threads = 0
+                for process in processes:
+                    try:
+                        rss += process.memory_info().rss
+                        threads += process.num_threads()
+                    except self.psutil.NoSuchProcess:
+                        pass
+                return rss, threads
+            except self.psutil.NoSuchProcess:
+                return None
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                fields = dict(line.split(':', 1) for line in f if ':' in line)
+            return int(fields['VmRSS'].split()[0]) * 1024, int(fields['Threads'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def start(self):
+        if not self.pid:
+            return
+
+        def loop():
+            while not self.stop_event.is_set():
+                sample = self.sample()
+                if sample:
+                    self.samples.append(sample)
+                self.stop_event.wait(self.interval)
+
+        self.thread = threading.Thread(target=loop, daemon=True, name='process-sampler')
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if not self.samples:
+            return None
+        rss = [sample[0] for sample in self.samples]
+        threads = [sample[1] for sample in self.samples]
+        return {
+            'rss_peak_mb': round(max(rss) / 1024 / 1024, 1),
+            'rss_mean_mb': round(sum(rss) / len(rss) / 1024 / 1024, 1),
+            'threads_peak': max(threads),
+            'threads_mean': round(sum(threads) / len(threads), 1),
+        }
+
+
+class LoadRunner:
+    def __init__(self, host, port, mix, timeout, images, pid=None):
+        self.host = host
+        self.port = port
+        self.mix = mix
+        self.timeout = timeout
+        self.images = images
+        self.pid = pid
+
+    def run_stage(self, concurrency, duration, warmup):
+        """Run concurrency clients for warmup + duration seconds; only the measured part is reported"""
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        results = []  # (scenario, status or exception name, seconds)
+        lock = threading.Lock()
+        measure_from = time.monotonic() + warmup
+        stop_at = measure_from + duration
+
+        def client_loop(index):
+            client = Client(self, index)
+            local = []
+            while True:
+                started = time.monotonic()
+                if started >= stop_at:
+                    break
+                name = random.choices(names, weights)[0]
+                try:
+                    outcome = SCENARIOS[name](client)
+                except Exception as e:
+                    outcome = type(e).__name__
+                finished = time.monotonic()
+                if started >= measure_from:
+                    local.append((name, outcome, finished - started))
+            client.close()
+            with lock:
+                results.extend(local)
+
+        sampler = ProcessSampler(self.pid)
+        threads = [threading.Thread(target=client_loop, args=(i,), daemon=True) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        # Sample only the measured part
+        time.sleep(max(0.0, measure_from - time.monotonic()))
+        sampler.start()
+        for thread in threads:
+            thread.join()
+        process = sampler.stop()
+        return summarize(concurrency, duration, results, process)
+
+
+def summarize(concurrency, duration, results, process):
+    def block(rows):
+        errors = {}
+        for _name, outcome, _seconds in rows:
+            if not (isinstance(outcome, int) and 200 <= outcome < 400):
+                errors[str(outcome)] = errors.get(str(outcome), 0) + 1
+        ok = [seconds for _name, outcome, seconds in rows if isinstance(outcome, int) and 200 <= outcome < 400]
+        return {
+            'requests': len(rows),
+            'throughput': round(len(rows) / duration, 2),
+            'errors': errors,
+            'error_rate': round(sum(errors.values()) / len(rows), 4) if rows else 0.0,
+            'latency': {key: round(value, 4) for key, value in latency_summary(ok).items()},
+        }
+
+    stage = dict(block(results), concurrency=concurrency, duration=duration)
+    stage['scenarios'] = {name: block([row for row in results if row[0] == name])
+                          for name in sorted({row[0] for row in results})}
+    stage['process'] = process
+    return stage
+
+
+def print_stage(stage):
+    latency = stage['latency']
+    print(f"\n== concurrency {stage['concurrency']}: {stage['requests']} requests, "
+          f"{stage['throughput']} req/s, error rate {stage['error_rate']:.2%}")
+    print(f"   {'scenario':<12} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>8}")
+    rows = list(stage['scenarios'].items()) + [('all', stage)]
+    for name, block in rows:
+        lat = block['latency']
+        print(f"   {name:<12} {block['throughput']:>8} {lat['p50'] * 1000:>9.1f} {lat['p95'] * 1000:>9.1f} "
+              f"{lat['p99'] * 1000:>9.1f} {sum(block['errors'].values()):>8}")
+    if stage['errors']:
+        print(f"   errors: {stage['errors']}")
+    if stage['process']:
+        process = stage['process']
+        print(f"   proxy RSS peak {process['rss_peak_mb']} MB (mean {process['rss_mean_mb']}), "
+              f"threads peak {process['threads_peak']} (mean {process['threads_mean']})")
+    elif latency:
+        print("   (no process stats: pass --pid or use --spawn)")
+
+
+# Lower is better for all of these except throughput
+COMPARED = [
+    ('throughput', lambda s: s['throughput'], True),
+    ('p50 ms', lambda s: s['latency']['p50'] * 1000, False),
+    ('p95 ms', lambda s: s['latency']['p95'] * 1000, False),
+    ('p99 ms', lambda s: s['latency']['p99'] * 1000, False),
+    ('error rate', lambda s: s['error_rate'], False),
+    ('RSS peak MB', lambda s: (s['process'] or {}).get('rss_peak_mb'), False),
+    ('threads peak', lambda s: (s['process'] or {}).get('threads_peak'), False),
+]
+
+
+def compare(baseline, current, threshold):
+    """Print per-stage differences; returns the number of regressions beyond threshold"""
+    print(f"\n== compared with {baseline.get('label') or 'baseline'} ({baseline.get('created', '?')}, "
+          f"commit {baseline.get('config', {}).get('commit') or '?'})")
+    old_stages = {stage['concurrency']: stage for stage in baseline['stages']}
+    regressions = 0
+    for stage in current['stages']:
+        old = old_stages.get(stage['concurrency'])
+        if old is None:
+            print(f"   concurrency {stage['concurrency']}: not in baseline")
+            continue
+        print(f"   concurrency {stage['concurrency']}:")
+        for name, value, higher_is_better in COMPARED:
+            before, after = value(old), value(stage)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before if before else 0.0
+            worse = change < -threshold if higher_is_better else change > threshold
+            regressions += worse
+            print(f"     {name:<13} {before:>10.2f} -> {after:>10.2f}  {change:+7.1%}{'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def wait_until_ready(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=2)
+            conn.request('GET', '/api/health')
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def spawn(args):
+    """Start the fake n8n (in this process) and a proxy subprocess; returns (proxy, fake server)"""
+    fake_options = fake_n8n.parse_args([
+        '--port', str(args.n8n_port), '--latency', str(args.n8n_latency), '--jitter', str(args.n8n_jitter),
+        '--error-rate', str(args.n8n_error_rate), '--slow-body', str(args.n8n_slow_body),
+    ])
+    fake = fake_n8n.make_server('127.0.0.1', args.n8n_port, fake_options)
+    threading.Thread(target=fake.serve_forever, daemon=True, name='fake-n8n').start()
+    env = dict(os.environ,
+               HOST='127.0.0.1',
+               PORT=str(args.port),
+               N8N_WEBHOOK_BASE_URL=f'http://127.0.0.1:{args.n8n_port}',
+               SERVER_ENGINE=args.engine,
+               WORKERS=str(args.workers),
+               # One load generator is one IP sending far more than any visitor
+               RATE_LIMIT_ENABLED='false')
+    for item in args.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+    proxy = subprocess.Popen([sys.executable, 'proxy_server.py'], cwd=SERVER_DIR, env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_until_ready('127.0.0.1', args.port):
+        proxy.kill()
+        raise SystemExit("Proxy did not become ready; run it by hand to see why")
+    return proxy, fake
+
+
+def stop_spawned(proxy, fake):
+    """Stop what spawn() started (either may be None)"""
+    if proxy is not None:
+        proxy.terminate()
+        try:
+            proxy.wait(timeout=40)
+        except subprocess.TimeoutExpired:
+            proxy.kill()
+    if fake is not None:
+        fake.shutdown()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the InkFlow proxy')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--pid', type=int, help='proxy PID for RSS/thread stats (automatic with --spawn)')
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated client counts, one stage each')
+    parser.add_argument('--duration', type=float, default=20, help='measured seconds per stage')
+    parser.add_argument('--warmup', type=float, default=3, help='unmeasured seconds before each stage')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'scenario weights (default {DEFAULT_MIX})')
+    parser.add_argument('--timeout', type=float, default=60, help='per-request client timeout')
+    parser.add_argument('--max-image-mb', type=float, default=5, help='largest image used for uploads')
+    parser.add_argument('--label', default='', help='name stored with the results')
+    parser.add_argument('--save', help='write the results (a baseline) to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to diff the results against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative change counted as a regression (default 0.10); exit code 1 if any')
+    add_spawn_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def add_spawn_arguments(parser):
+    """Options of spawn(), shared with replay.py"""
+    spawned = parser.add_argument_group('--spawn: start a proxy and a fake n8n for the run')
+    spawned.add_argument('--spawn', action='store_true')
+    spawned.add_argument('--engine', default='threaded', choices=('threaded', 'asyncio'))
+    spawned.add_argument('--workers', type=int, default=1)
+    spawned.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                         help='extra proxy environment (repeatable)')
+    spawned.add_argument('--n8n-port', type=int, default=5999)
+    spawned.add_argument('--n8n-latency', type=float, default=0.5)
+    spawned.add_argument('--n8n-jitter', type=float, default=0.1)
+    spawned.add_argument('--n8n-error-rate', type=float, default=0.0)
+    spawned.add_argument('--n8n-slow-body', type=float, default=0.0)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    mix = parse_mix(args.mix)
+    levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    proxy = fake = None
+    pid = args.pid
+    if args.spawn:
+        if args.host not in ('127.0.0.1', 'localhost'):
+            raise SystemExit("--spawn runs the proxy locally; drop --host")
+        proxy, fake = spawn(args)
+        pid = proxy.pid
+    images = find_images(args.max_image_mb * 1024 * 1024) if 'chat_upload' in mix else []
+    runner = LoadRunner(args.host, args.port, mix, args.timeout, images, pid)
+    results = {
+        'version': 1,
+        'label': args.label,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'commit': git_commit(),
+            'mix': mix,
+            'duration': args.duration,
+            'spawned': args.spawn,
+            'engine': args.engine if args.spawn else None,
+            'workers': args.workers if args.spawn else None,
+            'env': args.env,
+            'n8n': {'latency': args.n8n_latency, 'jitter': args.n8n_jitter, 'error_rate': args.n8n_error_rate,
+                    'slow_body': args.n8n_slow_body} if args.spawn else None,
+            'images': [name for name, _data in images],
+        },
+        'stages': [],
+    }
+    print(f"Benchmarking http://{args.host}:{args.port} with {mix} "
+          f"at concurrency {levels}, {args.duration:g}s per stage")
+    try:
+        for level in levels:
+            stage = runner.run_stage(level, args.duration, args.warmup)
+            results['stages'].append(stage)
+            print_stage(stage)
+        if fake is not None:
+            results['n8n_calls'] = fake.RequestHandlerClass.stats.snapshot()
+            print(f"\nn8n stand-in: {results['n8n_calls']}")
+    finally:
+        stop_spawned(proxy, fake)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nSaved results to {args.save}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""Replay captured chat traffic against a proxy.
+
+Reads the shape-only records the proxy writes with TRAFFIC_CAPTURE=true
+(see server/traffic_capture.py) and sends a synthetic request for each,
+on the captured schedule:
+
+- arrivals keep their spacing, divided by --speed (0: as fast as possible,
+  bounded by --max-inflight); idle gaps are capped at --max-gap seconds,
+- messages of one captured session share a replay session id, so session
+  ordering, merging, caching and rate limits see the same pattern,
+- message text has the captured length and share of Hebrew characters,
+- photos have the captured sizes: a real image from src/images, padded,
+  and the same captured hash always maps to the same bytes.
+
+Requests are open-loop (sent when due, not when the previous one returns),
+each on a new connection. --speed also compresses each session's own pace,
+so per-session queues and limits trip sooner than the same load spread
+over more sessions would make them. The report compares replayed latency and status
+codes with the captured ones, per mode, with process stats and --save as
+in loadgen.py:
+
+    python replay.py traffic_capture.jsonl* --spawn --speed 4
+    python replay.py ../traffic_capture.jsonl --port 8000 --pid 1234 --save replay.json
+"""
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import glob
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import loadgen
+
+CAPTURE_VERSION = 1
+HEBREW_WORDS = ['שלום', 'קעקוע', 'כמה', 'עולה', 'תור', 'מחר', 'אפשר', 'עיצוב', 'קטן', 'על', 'היד', 'תודה', 'רוצה']
+LATIN_WORDS = ['hi', 'tattoo', 'price', 'small', 'arm', 'fine', 'line', 'booking', 'next', 'week', 'thanks', 'ok']
+
+
+def load_records(patterns, limit=None):
+    """Capture records from files or globs (rotated backups included), oldest first"""
+    records = []
+    skipped = 0
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        skipped += 1
+                        continue
+                    if record.get('v') != CAPTURE_VERSION:
+                        skipped += 1
+                        continue
+                    records.append(record)
+    if skipped:
+        print(f"Skipped {skipped} unreadable or foreign records")
+    records.sort(key=lambda record: record['ts'])
+    return records[:limit] if limit else records
+
+
+def schedule(records, speed, max_gap):
+    """Seconds after the start at which each record is due"""
+    offsets = []
+    offset = 0.0
+    previous = None
+    for record in records:
+        if previous is not None and speed > 0:
+            offset += min(record['ts'] - previous, max_gap) / speed
+        previous = record['ts']
+        offsets.append(offset)
+    return offsets
+
+
+def synthetic_text(shape, rng):
+    """Text with the captured length and number of Hebrew characters"""
+    if not shape:
+        return ''
+    length, hebrew = shape
+
+    def words(pool, count):
+        # `count` letters, spaces between words not included
+        picked = []
+        while count > 0:
+            picked.append(rng.choice(pool)[:count])
+            count -= len(picked[-1])
+        return picked
+
+    hebrew_words = words(HEBREW_WORDS, hebrew)
+    text = ' '.join(hebrew_words)
+    if len(text) > length:
+        text = ''.join(hebrew_words)
+    if len(text) < length:
+        text += (' ' if text else '') + ' '.join(words(LATIN_WORDS, length))
+    return text[:length]
+
+
+class Synthesizer:
+    """Builds the request for a capture record"""
+    def __init__(self, images, seed=0):
+        # (filename, data), smallest first
+        self.images = sorted(images, key=lambda image: len(image[1]))
+        self.rng = random.Random(seed)
+        self.file_bytes = {}
+
+    def session_id(self, record):
+        return f"replay-{record['session']}" if record.get('session') else None
+
+    def file_data(self, shape):
+        """Image bytes of the captured size; equal hashes give equal bytes"""
+        key = (shape.get('hash'), shape['size'])
+        if key not in self.file_bytes:
+            fitting = [image for image in self.images if len(image[1]) <= shape['size']]
+            filename, data = fitting[-1] if fitting else self.images[0]
+            # Decoders ignore bytes after the image's end marker
+            padding = (shape.get('hash') or '0').encode('ascii')
+            missing = shape['size'] - len(data)
+            if missing > 0:
+                data += (padding * (missing // len(padding) + 1))[:missing]
+            self.file_bytes[key] = (filename, data)
+        return self.file_bytes[key]
+
+    def build(self, record):
+        """(path, body, headers) for the record"""
+        session_id = self.session_id(record)
+        text = synthetic_text(record.get('text'), self.rng)
+        headers = {}
+        if record.get('session_header') and session_id:
+            headers['X-Session-Id'] = session_id
+        if record.get('async'):
+            headers['Prefer'] = 'respond-async'
+        if record['mode'] == 'upload':
+            body, content_type = self.upload_body(record, session_id, text)
+        else:
+            defaults = loadgen.json_payload(session_id, text)
+            fields = record.get('fields') or list(defaults)
+            payload = {name: defaults.get(name, '') for name in fields}
+            if 'sessionId' in payload and session_id is None:
+                del payload['sessionId']
+            body, content_type = json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json'
+        headers['Content-Type'] = content_type
+        return record.get('route') or '/api/chat', body, headers
+
+    def upload_body(self, record, session_id, text):
+        files = list(record.get('files') or [])
+        fields = {}
+        file_parts = []
+        for name in record.get('fields') or ['chatInput', 'sessionId']:
+            if name.startswith('photo_') and files:
+                file_parts.append((name, files.pop(0)))
+            elif name == 'chatInput':
+                fields[name] = text
+            elif name == 'sessionId':
+                if session_id:
+                    fields[name] = session_id
+            elif not name.startswith('photo_'):
+                fields[name] = ''
+        file_parts += [(f'photo_{len(file_parts) + i}', shape) for i, shape in enumerate(files)]
+        multipart_files = []
+        for name, shape in file_parts:
+            filename, data = self.file_data(shape)
+            multipart_files.append((name, filename, data))
+        return loadgen.multipart_body(fields, multipart_files)
+
+
+def send(host, port, timeout, path, body, headers):
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('POST', path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def replay(records, offsets, synthesizer, host, port, timeout, max_inflight):
+    """Send every record when due; returns [(record, status or exception name, seconds, lateness)]"""
+    results = []
+    lock = threading.Lock()
+    started = time.monotonic()
+
+    def run(record, due):
+        lateness = time.monotonic() - due
+        path, body, headers = synthesizer.build(record)
+        sent = time.monotonic()
+        try:
+            outcome = send(host, port, timeout, path, body, headers)
+        except Exception as e:
+            outcome = type(e).__name__
+        with lock:
+            results.append((record, outcome, time.monotonic() - sent, lateness))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_inflight) as pool:
+        for record, offset in zip(records, offsets):
+            due = started + offset
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(run, record, due)
+    return results, time.monotonic() - started
+
+
+def mode_of(record):
+    return 'async' if record.get('async') else 'stream' if record.get('route', '').endswith('/stream') else record['mode']
+
+
+def summarize(results, elapsed):
+    by_mode = collections.defaultdict(list)
+    for row in results:
+        by_mode[mode_of(row[0])].append(row)
+    report = {'requests': len(results), 'elapsed': round(elapsed, 2),
+              'throughput': round(len(results) / elapsed, 2) if elapsed else 0.0, 'modes': {}}
+    for mode, rows in sorted(by_mode.items()):
+        replayed = collections.Counter(str(outcome) for _record, outcome, _seconds, _late in rows)
+        captured = collections.Counter(str(record.get('status')) for record, *_rest in rows)
+        report['modes'][mode] = {
+            'requests': len(rows),
+            'status_replayed': dict(replayed),
+            'status_captured': dict(captured),
+            'status_mismatches': sum(1 for record, outcome, *_rest in rows if outcome != record.get('status')),
+            'latency_replayed': {key: round(value, 4) for key, value in
+                                 loadgen.latency_summary([seconds for _r, _o, seconds, _l in rows]).items()},
+            'latency_captured': {key: round(value, 4) for key, value in
+                                 loadgen.latency_summary([record['ms'] / 1000 for record, *_rest in rows
+                                                          if record.get('ms') is not None]).items()},
+        }
+    lateness = loadgen.latency_summary([late for *_rest, late in results])
+    report['send_lateness'] = {key: round(value, 4) for key, value in lateness.items()}
+    return report
+
+
+def print_report(report):
+    print(f"\n== replayed {report['requests']} requests in {report['elapsed']}s ({report['throughput']} req/s)")
+    print(f"   {'mode':<8} {'count':>6} {'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16}  status (replayed | captured)")
+    for mode, block in report['modes'].items():
+        new, old = block['latency_replayed'], block['latency_captured']
+        cells = ' '.join(f"{new[key] * 1000:>7.0f}/{old[key] * 1000:<8.0f}" for key in ('p50', 'p95', 'p99'))
+        print(f"   {mode:<8} {block['requests']:>6} {cells}  {block['status_replayed']} | {block['status_captured']}")
+    print("   (latency cells are replayed/captured)")
+    late = report['send_lateness']
+    if late['p95'] > 0.05:
+        print(f"   sends ran late (p95 {late['p95'] * 1000:.0f} ms): raise --max-inflight or lower --speed")
+    if report.get('process'):
+        process = report['process']
+        print(f"   proxy RSS peak {process['rss_peak_mb']} MB (mean {process['rss_mean_mb']}), "
+              f"threads peak {process['threads_peak']} (mean {process['threads_mean']})")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured chat traffic against the InkFlow proxy')
+    parser.add_argument('captures', nargs='+', help='capture files or globs (e.g. traffic_capture.jsonl*)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--pid', type=int, help='proxy PID for RSS/thread stats (automatic with --spawn)')
+    parser.add_argument('--speed', type=float, default=1.0, help='time compression: 1 real time, 4 four times '
+                                                                 'faster, 0 no waiting (default 1)')
+    parser.add_argument('--max-gap', type=float, default=30.0, help='cap on captured idle gaps in seconds')
+    parser.add_argument('--max-inflight', type=int, default=256, help='requests in flight at most')
+    parser.add_argument('--limit', type=int, help='replay only the first N records')
+    parser.add_argument('--timeout', type=float, default=60, help='per-request client timeout')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic text')
+    parser.add_argument('--save', help='write the report to this JSON file')
+    loadgen.add_spawn_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    records = load_records(args.captures, args.limit)
+    if not records:
+        raise SystemExit("No capture records to replay")
+    images = loadgen.find_images(float('inf'))
+    if not images and any(record.get('files') for record in records):
+        raise SystemExit(f"No images in {loadgen.STATIC_DIR}/images to stand in for captured photos")
+    offsets = schedule(records, args.speed, args.max_gap)
+    print(f"Replaying {len(records)} chat requests over {offsets[-1]:.0f}s against http://{args.host}:{args.port}")
+
+    proxy = fake = None
+    pid = args.pid
+    if args.spawn:
+        proxy, fake = loadgen.spawn(args)
+        pid = proxy.pid
+    sampler = loadgen.ProcessSampler(pid)
+    try:
+        sampler.start()
+        results, elapsed = replay(records, offsets, Synthesizer(images, args.seed), args.host, args.port,
+                                  args.timeout, args.max_inflight)
+        report = summarize(results, elapsed)
+        report['process'] = sampler.stop()
+        if fake is not None:
+            report['n8n_calls'] = fake.RequestHandlerClass.stats.snapshot()
+    finally:
+        loadgen.stop_spawned(proxy, fake)
+
+    print_report(report)
+    if 'n8n_calls' in report:
+        print(f"   n8n stand-in: {report['n8n_calls']}")
+    if args.save:
+        report.update(created=datetime.datetime.now().isoformat(timespec='seconds'), commit=loadgen.git_commit(),
+                      captures=args.captures, speed=args.speed)
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved report to {args.save}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
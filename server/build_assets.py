@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Build optimized variants of the landing page images.
+
+For every PNG/JPEG under the static directory (default ../src) this writes
+resized AVIF and WebP copies at each IMAGE_VARIANT_WIDTHS width (never
+upscaled) into <static dir>/_optimized/, named after a hash of the
+source content, plus a manifest.json describing them. The proxy's static
+asset cache reads the manifest and answers requests for the original
+URL with the best variant for the client's Accept header and width hints.
+
+Usage: python build_assets.py [static_dir]
+
+Unchanged sources are skipped, so the step is cheap to re-run on deploy.
+Requires Pillow; AVIF output needs a Pillow build with AVIF support.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_DIR_NAME = '_optimized'
+MANIFEST_NAME = 'manifest.json'
+SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+IMAGE_VARIANT_WIDTHS = [int(w) for w in os.getenv('IMAGE_VARIANT_WIDTHS', '480,960,1600').split(',') if w.strip()]
+IMAGE_VARIANT_WEBP_QUALITY = int(os.getenv('IMAGE_VARIANT_WEBP_QUALITY', '80'))
+IMAGE_VARIANT_AVIF_QUALITY = int(os.getenv('IMAGE_VARIANT_AVIF_QUALITY', '60'))
+
+# Best format first; the server walks this order against the Accept header
+FORMATS = [
+    ('avif', 'AVIF', 'image/avif', {'quality': IMAGE_VARIANT_AVIF_QUALITY, 'speed': 6}),
+    ('webp', 'WEBP', 'image/webp', {'quality': IMAGE_VARIANT_WEBP_QUALITY, 'method': 6}),
+]
+
+
+def slugify(name):
+    return re.sub(r'[^A-Za-z0-9]+', '-', name).strip('-').lower() or 'image'
+
+
+def variant_widths(original_width):
+    """Target widths for one image, capped at its own width"""
+    widths = {w for w in IMAGE_VARIANT_WIDTHS if w < original_width}
+    widths.add(min(original_width, max(IMAGE_VARIANT_WIDTHS)))
+    return sorted(widths)
+
+
+def find_sources(static_dir):
+    output_dir = os.path.join(static_dir, OUTPUT_DIR_NAME)
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        if os.path.realpath(dirpath) == os.path.realpath(output_dir):
+            dirnames[:] = []
+            continue
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.lower().endswith(SOURCE_EXTENSIONS):
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, static_dir).replace(os.sep, '/'), path
+
+
+def build_variants(path, source_hash, output_dir, formats):
+    """Encode every width/format of one image; returns (width, height, variants)"""
+    source_bytes = os.path.getsize(path)
+    stem = slugify(os.path.splitext(os.path.basename(path))[0])
+    variants = []
+    with Image.open(path) as image:
+        image.load()
+        width, height = image.size
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        for target_width in variant_widths(width):
+            if target_width < width:
+                target_height = max(1, round(height * target_width / width))
+                resized = image.resize((target_width, target_height), Image.LANCZOS)
+            else:
+                resized = image
+            for extension, pil_format, mime_type, options in formats:
+                filename = f"{stem}-{source_hash[:10]}-{target_width}w.{extension}"
+                output_path = os.path.join(output_dir, filename)
+                if not os.path.exists(output_path):
+                    temp_path = output_path + '.tmp'
+                    resized.save(temp_path, pil_format, **options)
+                    os.replace(temp_path, output_path)
+                size = os.path.getsize(output_path)
+                # A full-size variant that is not smaller than the original is useless
+                if size >= source_bytes:
+                    os.remove(output_path)
+                    continue
+                variants.append({
+                    'path': f"{OUTPUT_DIR_NAME}/{filename}",
+                    'type': mime_type,
+                    'width': target_width,
+                    'bytes': size,
+                })
+    return width, height, variants
+
+
+def largest_variant_bytes(entry):
+    """Smallest encoding at the widest variant width (the original if there is none)"""
+    if not entry['variants']:
+        return entry['bytes']
+    widest = max(v['width'] for v in entry['variants'])
+    return min(v['bytes'] for v in entry['variants'] if v['width'] == widest)
+
+
+def build(static_dir):
+    static_dir = os.path.realpath(static_dir)
+    output_dir = os.path.join(static_dir, OUTPUT_DIR_NAME)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            previous = json.load(f).get('images', {})
+    except (OSError, ValueError):
+        previous = {}
+
+    formats = [fmt for fmt in FORMATS if features.check(fmt[0])]
+    if len(formats) < len(FORMATS):
+        logger.warning(f"Pillow lacks support for: {[fmt[0] for fmt in FORMATS if fmt not in formats]}")
+    format_names = [fmt[0] for fmt in formats]
+
+    images = {}
+    for relative, path in find_sources(static_dir):
+        with open(path, 'rb') as f:
+            source_hash = hashlib.sha256(f.read()).hexdigest()
+        entry = previous.get(relative)
+        if (entry and entry.get('hash') == source_hash and entry.get('formats') == format_names
+                and entry.get('widths') == IMAGE_VARIANT_WIDTHS
+                and all(os.path.exists(os.path.join(static_dir, v['path'])) for v in entry['variants'])):
+            images[relative] = entry
+            continue
+        width, height, variants = build_variants(path, source_hash, output_dir, formats)
+        images[relative] = {
+            'hash': source_hash,
+            'bytes': os.path.getsize(path),
+            'width': width,
+            'height': height,
+            'formats': format_names,
+            'widths': IMAGE_VARIANT_WIDTHS,
+            'variants': variants,
+        }
+        summary = ', '.join(f"{v['width']}w {v['type'][len('image/'):]} {v['bytes']}" for v in variants)
+        logger.info(f"{relative}: {images[relative]['bytes']} bytes -> {summary or 'kept original'}")
+
+    # Drop variants of removed or changed sources
+    referenced = {os.path.basename(v['path']) for entry in images.values() for v in entry['variants']}
+    for filename in os.listdir(output_dir):
+        if filename != MANIFEST_NAME and filename not in referenced:
+            os.remove(os.path.join(output_dir, filename))
+
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': 1, 'images': images}, f, indent=2, ensure_ascii=False)
+    os.replace(temp_path, manifest_path)
+
+    original = sum(entry['bytes'] for entry in images.values())
+    largest = sum(largest_variant_bytes(entry) for entry in images.values())
+    logger.info(f"Built variants for {len(images)} images: {original} bytes of originals, "
+                f"{largest} bytes for their largest variants in the best format")
+    return images
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    default_dir = os.getenv('STATIC_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+    build(sys.argv[1] if len(sys.argv) > 1 else default_dir)
@@ -0,0 +1,169 @@
+"""Shared fixtures for the server unit tests (run with `python -m pytest` from server/)."""
+import asyncio
+import http.server
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+
+class FakeClock:
+    """Stands in for a module's `time`: monotonic() only moves when a test advances it"""
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+class FakeN8nHandler(http.server.BaseHTTPRequestHandler):
+    """Webhook stand-in: records each POST and answers with the server's configured chunks"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append((self.path, dict(self.headers), body))
+        time.sleep(self.server.delay)
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for index, chunk in enumerate(self.server.chunks):
+            if index:
+                time.sleep(self.server.chunk_delay)
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeN8n(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeN8nHandler)
+        self.requests = []
+        self.status = 200
+        self.chunks = [b'{"output": "hi"}']
+        self.delay = 0
+        # Pause between answer chunks, like tokens arriving from the agent
+        self.chunk_delay = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/webhook/tattoo-chat'
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    """proxy_server with the admission slots serve() would set, and no rate limits"""
+    import proxy_server
+    import rate_limit
+    monkeypatch.setattr(proxy_server.admission, 'max_active', 20)
+    monkeypatch.setattr(rate_limit, 'RATE_LIMIT_ENABLED', False)
+    return proxy_server
+
+
+@pytest.fixture
+def fake_n8n(proxy, monkeypatch):
+    server = FakeN8n()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(proxy, 'N8N_WEBHOOK_URLS', [server.url])
+    yield server
+    server.shutdown()
+    server.server_close()
+    proxy.upstream_pool.close_all()
+
+
+@pytest.fixture
+def threaded_server(proxy):
+    """Port of a threaded-engine server on localhost"""
+    httpd = proxy.ResilientTCPServer(('127.0.0.1', 0), proxy.ProxyHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def async_server(proxy):
+    """Port of an asyncio-engine server on localhost"""
+    server = proxy.AsyncProxyServer('127.0.0.1', 0)
+    loop = asyncio.new_event_loop()
+
+    def run():
+        try:
+            loop.run_until_complete(server.serve_forever())
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    for _ in range(500):
+        if server.server is not None and server.server.sockets:
+            break
+        time.sleep(0.01)
+    yield server.server.sockets[0].getsockname()[1]
+    loop.call_soon_threadsafe(server.close)
+    thread.join(5)
+    loop.close()
+
+
+@pytest.fixture(params=['threaded', 'asyncio'])
+def engine_server(request):
+    """Port of a server for each engine in turn"""
+    return request.getfixturevalue('threaded_server' if request.param == 'threaded' else 'async_server')
+
+
+def exchange(port, raw, timeout=5):
+    """Send raw request bytes, read until the server closes; returns (status, headers, body)"""
+    with socket.create_connection(('127.0.0.1', port), timeout=timeout) as sock:
+        sock.sendall(raw)
+        received = bytearray()
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            received += chunk
+    head, _, body = bytes(received).partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return int(lines[0].split()[1]), headers, body
+
+
+def request(method, path, body=b'', version='HTTP/1.1', headers=()):
+    """Raw bytes of a one-shot request (Connection: close, so exchange() can read to EOF)"""
+    lines = [f'{method} {path} {version}', 'Host: localhost', 'Connection: close']
+    if body or method == 'POST':
+        lines.append(f'Content-Length: {len(body)}')
+    lines += [f'{name}: {value}' for name, value in headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+def chat_message(text='hi', session_id='chat_engines'):
+    """JSON body of a plain chat message"""
+    return json.dumps({'chatInput': text, 'sessionId': session_id}).encode('utf-8')
@@ -0,0 +1,67 @@
+"""Per-request deadlines for chat messages.
+
+Every blocking step used to get REQUEST_TIMEOUT_SECONDS of its own: the
+body read, each n8n URL in turn, the pause between them and the response
+write. Past the first, a slow message could hold a connection for several
+times the configured timeout before the client heard anything. (The
+threaded engine also set that timeout with socket.setdefaulttimeout(),
+which is process-wide and raced between request threads.)
+
+A Deadline is created when a chat message arrives and is handed down to
+every step, which gets only the time that is left:
+
+- socket and asyncio timeouts for the body read and the response write;
+- each upstream attempt, capped at REQUEST_TIMEOUT_SECONDS, with the time
+  left sent to n8n in REQUEST_DEADLINE_HEADER (milliseconds) so a workflow
+  can skip work nobody will wait for;
+- the fallback loop, which stops trying further URLs once it is spent.
+
+A finished n8n answer still gets at least DEADLINE_WRITE_FLOOR_SECONDS to
+reach the client, rather than being thrown away at the last moment. A
+streamed answer is bound by the deadline until its head arrives; the relay
+after that only has the per-read REQUEST_TIMEOUT_SECONDS, since tokens may
+keep coming for longer than any single request should wait. Async chat
+jobs retry on their own schedule and keep the per-attempt timeout.
+"""
+import os
+import socket
+import time
+
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', os.getenv('REQUEST_TIMEOUT_SECONDS', '30')))
+DEADLINE_WRITE_FLOOR_SECONDS = 1.0
+
+# Milliseconds the proxy will still wait for n8n's answer
+REQUEST_DEADLINE_HEADER = 'X-Request-Deadline-Ms'
+
+
+class DeadlineExceeded(socket.timeout):
+    """The request's time budget ran out before a step could start"""
+
+
+class Deadline:
+    """A point in time a request has to be answered by"""
+    def __init__(self, seconds=REQUEST_DEADLINE_SECONDS):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def timeout(self, cap=None):
+        """Seconds the next blocking step may take, at most cap; raises DeadlineExceeded when none are left"""
+        remaining = self.expires - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"request deadline of {self.seconds:g}s exceeded")
+        return remaining if cap is None else min(remaining, cap)
+
+    def write_timeout(self):
+        """Time allowed for writing a response that is already complete"""
+        return max(self.remaining(), DEADLINE_WRITE_FLOOR_SECONDS)
+
+    def headers(self, headers):
+        """Upstream request headers with the time left added"""
+        return {**headers, REQUEST_DEADLINE_HEADER: str(int(self.remaining() * 1000))}
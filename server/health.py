@@ -0,0 +1,221 @@
+"""Background health sampling and cheap liveness/readiness probes.
+
+Load balancers poll every instance every few seconds. Collecting process
+metrics on each poll costs more than the poll is worth, and says nothing
+about whether chat messages can actually be answered. A background thread
+does the work instead:
+
+- every HEALTH_SAMPLE_INTERVAL_SECONDS it samples RSS, CPU and threads
+  (psutil, when installed) for /api/health and the worker stats;
+- every HEALTH_PROBE_INTERVAL_SECONDS it sends a HEAD request to each n8n
+  webhook URL. Any answer from n8n counts as reachable; connection errors,
+  timeouts, 502/503/504 and tunnel errors (ngrok's Ngrok-Error-Code) do not.
+
+/api/health/live (the process is serving) and /api/health/ready (send it
+traffic: n8n is reachable and the server is not draining) answer from
+bodies rebuilt after each sample or probe, so a probe costs a dictionary
+lookup. The full /api/health document is rebuilt at the same time from
+the serving engine's describe() callback, so polling it never runs the
+component stats on a request thread or the event loop; it can be up to
+one sample interval old. With HEALTH_READY_REQUIRES_N8N=false readiness ignores n8n, for
+setups where the async job queue holds messages through n8n outages.
+Uptime counts from when this process started serving.
+"""
+import http.client
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+HEALTH_SAMPLE_INTERVAL = float(os.getenv('HEALTH_SAMPLE_INTERVAL_SECONDS', '5'))
+HEALTH_PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL_SECONDS', '10'))
+HEALTH_PROBE_TIMEOUT = float(os.getenv('HEALTH_PROBE_TIMEOUT_SECONDS', '3'))
+HEALTH_READY_REQUIRES_N8N = os.getenv('HEALTH_READY_REQUIRES_N8N', 'true').lower() in ('1', 'true', 'yes')
+
+HEALTH_PATH = '/api/health'
+LIVE_PATH = '/api/health/live'
+READY_PATH = '/api/health/ready'
+# Gateway answers: something in front of n8n is up, n8n is not
+UNREACHABLE_STATUSES = (502, 503, 504)
+
+DRAINING_REPLY = (503, b'{"status": "draining"}')
+
+
+def probe_url(url, timeout=HEALTH_PROBE_TIMEOUT):
+    """HEAD the URL; returns the endpoint's health entry"""
+    parts = urllib.parse.urlsplit(url)
+    conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    entry = {'url': url, 'reachable': False, 'status': None, 'latency_ms': None, 'error': None,
+             'checked_at': time.time()}
+    started = time.perf_counter()
+    conn = conn_class(parts.hostname, parts.port, timeout=timeout)
+    try:
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        conn.request('HEAD', target, headers={'User-Agent': 'InkFlow-Proxy/2.0 health'})
+        response = conn.getresponse()
+        response.read()
+        entry['status'] = response.status
+        if response.getheader('Ngrok-Error-Code'):
+            entry['error'] = f"tunnel error {response.getheader('Ngrok-Error-Code')}"
+        elif response.status in UNREACHABLE_STATUSES:
+            entry['error'] = f"gateway answered {response.status}"
+        else:
+            entry['reachable'] = True
+    except (OSError, http.client.HTTPException) as e:
+        entry['error'] = str(e) or type(e).__name__
+    finally:
+        conn.close()
+    entry['latency_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return entry
+
+
+class HealthMonitor:
+    """Samples the process and probes n8n in the background; serves precomputed probe replies"""
+    def __init__(self, sample_interval=HEALTH_SAMPLE_INTERVAL, probe_interval=HEALTH_PROBE_INTERVAL,
+                 requires_n8n=HEALTH_READY_REQUIRES_N8N):
+        self.sample_interval = sample_interval
+        self.probe_interval = probe_interval
+        self.requires_n8n = requires_n8n
+        self.started = time.time()
+        self.urls = []
+        self.draining = lambda: False
+        self.process = None
+        self.system = {}
+        self.endpoints = []
+        self.probes = 0
+        self.live = (200, b'{"status": "alive"}')
+        self.ready = (503, b'{"status": "starting"}')
+        # /api/health: built by `document` (set by the serving engine) on each refresh
+        self.document = None
+        self.health = (200, b'{"status": "starting"}')
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self, urls, draining=None):
+        """Start sampling for this process (call once it is about to serve)"""
+        self.started = time.time()
+        self.urls = list(urls)
+        if draining is not None:
+            self.draining = draining
+        try:
+            import psutil
+            self.process = psutil.Process()
+            # The first cpu_percent() call only sets the baseline
+            self.process.cpu_percent()
+        except ImportError:
+            self.process = None
+        self.sample()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='health-monitor')
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=HEALTH_PROBE_TIMEOUT * max(1, len(self.urls)) + 1)
+            self.thread = None
+
+    def run(self):
+        next_sample = time.monotonic() + self.sample_interval
+        next_probe = time.monotonic()
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            if now >= next_probe:
+                self.probe()
+                next_probe = time.monotonic() + self.probe_interval
+            if now >= next_sample:
+                self.sample()
+                next_sample = time.monotonic() + self.sample_interval
+            self.stop_event.wait(max(0.0, min(next_sample, next_probe) - time.monotonic()))
+
+    def sample(self):
+        try:
+            if self.process is not None:
+                with self.process.oneshot():
+                    memory = self.process.memory_info()
+                    cpu = self.process.cpu_times()
+                    self.system = {
+                        'rss': memory.rss,
+                        'vms': memory.vms,
+                        'memory_percent': round(self.process.memory_percent(), 2),
+                        'cpu_percent': self.process.cpu_percent(),
+                        'cpu_seconds': round(cpu.user + cpu.system, 2),
+                        'threads': self.process.num_threads(),
+                        'sampled_at': time.time(),
+                    }
+        except Exception as e:
+            logger.warning(f"Health sample failed: {e}")
+        self.refresh()
+
+    def probe(self):
+        previous = {entry['url']: entry['reachable'] for entry in self.endpoints}
+        self.endpoints = [probe_url(url) for url in self.urls]
+        self.probes += 1
+        # Log changes only, not every probe of an endpoint that stays down
+        for entry in self.endpoints:
+            if entry['reachable'] and previous.get(entry['url']) is False:
+                logger.info(f"n8n endpoint {entry['url']} reachable again")
+            elif not entry['reachable'] and previous.get(entry['url']) is not False:
+                logger.warning(f"n8n endpoint {entry['url']} unreachable: {entry['error']}")
+        self.refresh()
+
+    def describe(self, document):
+        """Serve document() as /api/health from now on, rebuilt on each refresh"""
+        self.document = document
+        self.refresh()
+
+    def uptime(self):
+        return time.time() - self.started
+
+    def refresh(self):
+        """Rebuild the precomputed probe replies"""
+        reachable = sum(1 for entry in self.endpoints if entry['reachable'])
+        if not self.endpoints and self.requires_n8n:
+            status, state = 503, 'starting'
+        elif reachable or not self.requires_n8n:
+            status, state = 200, 'ready'
+        else:
+            status, state = 503, 'n8n_unreachable'
+        self.ready = (status, json.dumps({
+            'status': state,
+            'n8n_reachable': reachable,
+            'n8n_endpoints': len(self.endpoints),
+            'checked_at': max((entry['checked_at'] for entry in self.endpoints), default=None),
+        }).encode('utf-8'))
+        self.live = (200, json.dumps({
+            'status': 'alive',
+            'pid': os.getpid(),
+            'uptime': round(self.uptime(), 1),
+        }).encode('utf-8'))
+        if self.document is not None:
+            try:
+                self.health = (200, json.dumps(self.document(), indent=2).encode('utf-8'))
+            except Exception as e:
+                logger.warning(f"Health document failed: {e}")
+
+    def reply(self, path):
+        """(status, body) for HEALTH_PATH, LIVE_PATH or READY_PATH"""
+        if path == LIVE_PATH:
+            return self.live
+        if path == HEALTH_PATH:
+            return self.health
+        if self.draining():
+            return DRAINING_REPLY
+        return self.ready
+
+    def snapshot(self):
+        """Latest sample and probe results for /api/health"""
+        return {
+            'ready': self.ready[0] == 200 and not self.draining(),
+            'system': self.system,
+            'n8n_endpoints': self.endpoints or [{'url': url, 'reachable': None} for url in self.urls],
+            'probes': self.probes,
+        }
+
+
+# Shared monitor for both serving engines
+health_monitor = HealthMonitor()
@@ -0,0 +1,410 @@
+"""Circuit breakers and hedged requests across the n8n webhook URLs.
+
+Every webhook URL gets a circuit breaker: after CIRCUIT_FAILURE_THRESHOLD
+consecutive failures it is skipped for CIRCUIT_RESET_SECONDS, then a
+single trial request decides whether it closes again. This stops a dead
+endpoint from costing each message a full timeout.
+
+With HEDGED_REQUESTS enabled, the fallback URL is not tried only after
+the primary has failed. It is also started when the primary has not
+answered within a delay taken from the primary's recent latency
+percentile. The first success wins and the other call is cancelled.
+n8n webhooks are not idempotent, so hedging is off by default.
+
+Given a request Deadline, no further URL is tried once it has run out.
+Only transport errors and 5xx answers count as breaker failures: a 4xx
+means n8n answered and rejected that one request.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from deadline import DeadlineExceeded
+from upstream import CancelToken
+
+logger = logging.getLogger(__name__)
+
+HEDGED_REQUESTS = os.getenv('HEDGED_REQUESTS', 'false').lower() in ('1', 'true', 'yes')
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY_SECONDS', '5'))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY_SECONDS', '0.5'))
+HEDGE_MIN_SAMPLES = 20
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '3'))
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', '30'))
+# Pause between serial attempts, as the original fallback loop did
+FALLBACK_PAUSE_SECONDS = 0.5
+
+
+class CircuitOpen(RuntimeError):
+    """The endpoint's breaker refused the attempt (another request holds the half-open trial)"""
+
+
+def is_client_error(error):
+    """Whether an attempt failed because n8n answered 4xx (HTTPError.code / UpstreamHTTPError.status)"""
+    status = getattr(error, 'status', None) or getattr(error, 'code', None)
+    return isinstance(status, int) and 400 <= status < 500
+
+
+def pause_for(deadline):
+    """The pause before the next serial attempt, never longer than the time left"""
+    if deadline is None:
+        return FALLBACK_PAUSE_SECONDS
+    return min(FALLBACK_PAUSE_SECONDS, deadline.remaining())
+
+
+class EndpointState:
+    """Circuit breaker and latency window for one webhook URL"""
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, url):
+        self.url = url
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.latencies = deque(maxlen=200)
+        self.successes = 0
+        self.failures = 0
+        self.skipped = 0
+
+    def available(self):
+        """Whether allow() would let a request through now, without claiming the trial slot"""
+        with self.lock:
+            if self.state == self.OPEN:
+                ready = time.monotonic() - self.opened_at >= CIRCUIT_RESET_SECONDS
+            else:
+                ready = self.state == self.CLOSED or not self.trial_in_flight
+            if not ready:
+                self.skipped += 1
+            return ready
+
+    def allow(self):
+        """Whether a request may be sent now (claims the half-open trial slot; call right before sending)"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= CIRCUIT_RESET_SECONDS:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            self.skipped += 1
+            return False
+
+    def record_success(self, latency):
+        with self.lock:
+            self.successes += 1
+            self.latencies.append(latency)
+            if self.state != self.CLOSED:
+                logger.info(f"Circuit closed for {self.url}")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                if self.state != self.OPEN:
+                    logger.warning(f"Circuit opened for {self.url} after {self.consecutive_failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        """Give back a half-open trial slot whose attempt was cancelled, not failed"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def percentile(self, pct):
+        with self.lock:
+            samples = sorted(self.latencies)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def hedge_delay(self, max_delay):
+        with self.lock:
+            enough = len(self.latencies) >= HEDGE_MIN_SAMPLES
+        delay = self.percentile(HEDGE_PERCENTILE) if enough else HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, min(delay, max_delay))
+
+    def stats(self):
+        p50 = self.percentile(50)
+        p95 = self.percentile(95)
+        with self.lock:
+            return {
+                'url': self.url,
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'successes': self.successes,
+                'failures': self.failures,
+                'skipped': self.skipped,
+                'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+                'p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+            }
+
+
+class FallbackForwarder:
+    """Runs an attempt function across webhook URLs: serial with breakers, or hedged"""
+    def __init__(self, hedged=HEDGED_REQUESTS):
+        self.hedged = hedged
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.hedges_fired = 0
+        self.hedge_wins = 0
+        self.executor = None
+
+    def endpoint(self, url):
+        with self.lock:
+            state = self.endpoints.get(url)
+            if state is None:
+                state = self.endpoints[url] = EndpointState(url)
+            return state
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=int(os.getenv('HEDGE_WORKERS', '64')), thread_name_prefix='hedge')
+            return self.executor
+
+    def _attempt(self, url, attempt, cancel_token=None):
+        """Run one attempt and feed the breaker; cancelled attempts are not failures"""
+        state = self.endpoint(url)
+        # Claimed only now, so a URL that is never tried cannot keep the half-open trial slot
+        if not state.allow():
+            raise CircuitOpen(f"circuit open for {url}")
+        start = time.monotonic()
+        try:
+            result = attempt(url, cancel_token)
+        except Exception as e:
+            # Nor are attempts the request had no time left to send
+            if isinstance(e, DeadlineExceeded) or (cancel_token is not None and cancel_token.cancelled):
+                state.release_trial()
+            elif is_client_error(e):
+                # The endpoint is up; the request was at fault
+                state.record_success(time.monotonic() - start)
+            else:
+                state.record_failure()
+            raise
+        state.record_success(time.monotonic() - start)
+        return result
+
+    def call(self, urls, attempt, label, hedge=True, max_delay=30, deadline=None):
+        """attempt(url, cancel_token) -> result; returns (result, None) or (None, last_error)"""
+        available = [url for url in urls if self.endpoint(url).available()]
+        for url in urls:
+            if url not in available:
+                logger.warning(f"Skipping {url} for {label}: circuit open")
+        if not available:
+            return None, RuntimeError("all n8n endpoints have open circuits")
+        if self.hedged and hedge and len(available) > 1:
+            return self._call_hedged(available, attempt, label, max_delay, deadline)
+        return self._call_serial(available, attempt, label, deadline)
+
+    def _call_serial(self, urls, attempt, label, deadline=None):
+        last_error = None
+        for url_index, url in enumerate(urls):
+            if url_index and deadline is not None and deadline.expired:
+                logger.warning(f"Not trying {url} for {label}: request deadline exceeded")
+                break
+            try:
+                logger.info(f"Proxying {label} to: {url} (attempt {url_index + 1}/{len(urls)})")
+                return self._attempt(url, attempt), None
+            except Exception as e:
+                logger.warning(f"Failed to connect to {url}: {e}")
+                last_error = e
+                # Add small delay between attempts
+                if url_index < len(urls) - 1:
+                    time.sleep(pause_for(deadline))
+        return None, last_error
+
+    def _call_hedged(self, urls, attempt, label, max_delay, deadline=None):
+        executor = self.get_executor()
+        primary, backups = urls[0], list(urls[1:])
+        tokens = {}
+        pending = {}
+
+        def launch(url):
+            token = CancelToken()
+            started = threading.Event()
+
+            def run():
+                started.set()
+                return self._attempt(url, attempt, token)
+
+            future = executor.submit(run)
+            tokens[future] = token
+            pending[future] = url
+            return started
+
+        logger.info(f"Proxying {label} to: {primary} (hedged)")
+        started = launch(primary)
+        last_error = None
+        try:
+            # The hedge delay counts from when the primary is on a worker, not queued behind other requests
+            if not started.wait(deadline.remaining() if deadline is not None else None):
+                logger.warning(f"Not sending {label}: request deadline exceeded while queued for a hedge worker")
+                return None, DeadlineExceeded("request deadline exceeded")
+            delay = self.endpoint(primary).hedge_delay(max_delay)
+            while pending:
+                done, _not_done = concurrent.futures.wait(
+                    list(pending), timeout=delay if backups else None,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done and deadline is not None and deadline.expired:
+                    logger.warning(f"Not hedging {label}: request deadline exceeded")
+                    backups.clear()
+                    continue
+                if not done:
+                    # Primary is slower than its usual percentile: fire the next URL too
+                    url = backups.pop(0)
+                    with self.lock:
+                        self.hedges_fired += 1
+                    logger.info(f"Hedging {label} to: {url} after {delay:.2f}s")
+                    launch(url)
+                    continue
+                for future in done:
+                    url = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.warning(f"Failed to connect to {url}: {e}")
+                        last_error = e
+                        continue
+                    if url != primary:
+                        with self.lock:
+                            self.hedge_wins += 1
+                    return result, None
+                if not pending and backups:
+                    if deadline is not None and deadline.expired:
+                        logger.warning(f"Not trying {backups[0]} for {label}: request deadline exceeded")
+                        break
+                    # Everything in flight failed: move on to the next URL immediately
+                    launch(backups.pop(0))
+            return None, last_error
+        finally:
+            for future in pending:
+                # Attempts still queued never start; running ones stop at their next check
+                future.cancel()
+                tokens[future].cancel()
+
+    async def call_async(self, urls, attempt, label, hedge=True, max_delay=30, deadline=None):
+        """Event-loop variant of call(); attempt(url) returns an awaitable"""
+        available = [url for url in urls if self.endpoint(url).available()]
+        for url in urls:
+            if url not in available:
+                logger.warning(f"Skipping {url} for {label}: circuit open")
+        if not available:
+            return None, RuntimeError("all n8n endpoints have open circuits")
+        if not (self.hedged and hedge and len(available) > 1):
+            last_error = None
+            for url_index, url in enumerate(available):
+                if url_index and deadline is not None and deadline.expired:
+                    logger.warning(f"Not trying {url} for {label}: request deadline exceeded")
+                    break
+                try:
+                    logger.info(f"Proxying {label} to: {url} (attempt {url_index + 1}/{len(available)})")
+                    return await self._attempt_async(url, attempt), None
+                except Exception as e:
+                    logger.warning(f"Failed to connect to {url}: {e!r}")
+                    last_error = e
+                    if url_index < len(available) - 1:
+                        await asyncio.sleep(pause_for(deadline))
+            return None, last_error
+
+        primary, backups = available[0], list(available[1:])
+        pending = {}
+
+        def launch(url):
+            pending[asyncio.ensure_future(self._attempt_async(url, attempt))] = url
+
+        logger.info(f"Proxying {label} to: {primary} (hedged)")
+        launch(primary)
+        delay = self.endpoint(primary).hedge_delay(max_delay)
+        last_error = None
+        try:
+            while pending:
+                done, _not_done = await asyncio.wait(
+                    list(pending), timeout=delay if backups else None,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done and deadline is not None and deadline.expired:
+                    logger.warning(f"Not hedging {label}: request deadline exceeded")
+                    backups.clear()
+                    continue
+                if not done:
+                    url = backups.pop(0)
+                    with self.lock:
+                        self.hedges_fired += 1
+                    logger.info(f"Hedging {label} to: {url} after {delay:.2f}s")
+                    launch(url)
+                    continue
+                for task in done:
+                    url = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        logger.warning(f"Failed to connect to {url}: {e!r}")
+                        last_error = e
+                        continue
+                    if url != primary:
+                        with self.lock:
+                            self.hedge_wins += 1
+                    return result, None
+                if not pending and backups:
+                    if deadline is not None and deadline.expired:
+                        logger.warning(f"Not trying {backups[0]} for {label}: request deadline exceeded")
+                        break
+                    launch(backups.pop(0))
+            return None, last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _attempt_async(self, url, attempt):
+        state = self.endpoint(url)
+        if not state.allow():
+            raise CircuitOpen(f"circuit open for {url}")
+        start = time.monotonic()
+        try:
+            result = await attempt(url)
+        except (asyncio.CancelledError, DeadlineExceeded):
+            state.release_trial()
+            raise
+        except Exception as e:
+            if is_client_error(e):
+                state.record_success(time.monotonic() - start)
+            else:
+                state.record_failure()
+            raise
+        state.record_success(time.monotonic() - start)
+        return result
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            endpoints = list(self.endpoints.values())
+            summary = {
+                'hedged_requests': self.hedged,
+                'hedges_fired': self.hedges_fired,
+                'hedge_wins': self.hedge_wins,
+            }
+        summary['endpoints'] = [state.stats() for state in endpoints]
+        return summary
+
+
+# Shared forwarder for every n8n call in the process
+fallback_forwarder = FallbackForwarder()
@@ -0,0 +1,186 @@
+"""Content-addressed cache for upload images, ready to forward.
+
+Keys are the SHA-256 of the original upload bytes plus the processing
+settings. Values are what n8n receives for the image: its MIME type, file
+extension and the base64 text of the (preprocessed, if that shrank it)
+image. The same reference photo re-sent in a session, or a popular flash
+design shared across sessions, then skips decoding, resizing, re-encoding
+and the base64 pass. The memory tier is an LRU bounded by entry count and
+a byte budget; an optional on-disk tier keeps results across restarts.
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_MB = float(os.getenv('IMAGE_CACHE_MB', '64'))
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv('IMAGE_CACHE_MAX_ENTRIES', '1000'))
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', '')
+IMAGE_CACHE_DISK_MB = float(os.getenv('IMAGE_CACHE_DISK_MB', '512'))
+
+
+class ImageCache:
+    """LRU + byte-budget cache of (mime_type, extension, base64 data) keyed by content hash
+
+    An empty extension means the upload's own filename is kept.
+    """
+    def __init__(self, max_bytes=int(IMAGE_CACHE_MB * 1024 * 1024), max_entries=IMAGE_CACHE_MAX_ENTRIES,
+                 disk_dir=IMAGE_CACHE_DIR, disk_max_bytes=int(IMAGE_CACHE_DISK_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        # Running total of the disk tier, so a put() does not list the directory
+        self.disk_size = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.disk_size = sum(size for _mtime, size, _path in self._disk_entries())
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 or bool(self.disk_dir)
+
+    @staticmethod
+    def key_for(data, settings=''):
+        digest = hashlib.sha256(data)
+        digest.update(settings.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key, original_size=0):
+        """Return the cached (mime_type, extension, base64 data) or None; original_size feeds bytes_saved"""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += original_size
+                return value
+        value = self._disk_get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.bytes_saved += original_size
+        self._memory_put(key, value)
+        return value
+
+    def put(self, key, value):
+        self._memory_put(key, value)
+        self._disk_put(key, value)
+
+    def _memory_put(self, key, value):
+        size = len(value[2])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[2])
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+                _key, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[2])
+                self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key)
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                header = f.readline().decode('ascii').split()
+                data = f.read()
+            os.utime(self._disk_path(key))
+        except (OSError, UnicodeDecodeError):
+            return None
+        if len(header) != 2:
+            return None
+        return header[0], '' if header[1] == '-' else header[1], data
+
+    def _disk_put(self, key, value):
+        if not self.disk_dir:
+            return
+        mime_type, extension, data = value
+        header = f"{mime_type} {extension or '-'}\n".encode('ascii')
+        path = self._disk_path(key)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(header)
+                f.write(data)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.warning(f"Image cache disk write failed: {e}")
+            return
+        with self.lock:
+            self.disk_size += len(header) + len(data) - replaced
+            over_budget = self.disk_size > self.disk_max_bytes
+        if over_budget:
+            self._trim_disk()
+
+    def _disk_entries(self):
+        """(mtime, size, path) of every file in the disk tier"""
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _trim_disk(self):
+        """Drop the least recently used files once the disk tier is over budget"""
+        # Listed only now; the listing also corrects the total for other processes' writes
+        entries = self._disk_entries()
+        total = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in sorted(entries):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        with self.lock:
+            self.disk_size = total
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                # Upload bytes whose decode/resize/re-encode and base64 pass were skipped thanks to the cache
+                'bytes_saved': self.bytes_saved,
+                'disk_tier': bool(self.disk_dir),
+                'disk_bytes': self.disk_size,
+            }
+
+
+# Shared cache used by the image preprocessor
+image_cache = ImageCache()
@@ -0,0 +1,244 @@
+"""Downscale and recompress uploaded photos before they are sent to n8n.
+
+Phone photos are usually far larger than the vision model needs. Each
+upload is capped to IMAGE_MAX_EDGE pixels on its longest side, has its
+EXIF data stripped (after applying the orientation) and is re-encoded as
+WebP or JPEG. The work runs in a process pool so request threads and the
+asyncio event loop are not blocked by image decoding. The pool starts its
+workers through a forkserver (spawn where there is none): by the time the
+first upload arrives the server is multithreaded, and fork() would copy
+whatever locks its threads held into every worker.
+
+Every image, processed or not, is looked up in the image cache first; a
+hit brings the base64 text n8n receives, so a repeated photo skips both
+Pillow and the base64 pass. Pillow is optional: without it (or with
+IMAGE_PREPROCESS=false) uploads are forwarded unchanged, but still cached.
+"""
+import asyncio
+import base64
+import concurrent.futures
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+
+from image_cache import image_cache
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PREPROCESS = os.getenv('IMAGE_PREPROCESS', 'true').lower() in ('1', 'true', 'yes')
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', '1600'))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'webp').lower()
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '80'))
+# 0 processes images on the calling thread (e.g. serverless runtimes without multiprocessing)
+IMAGE_PROCESS_WORKERS = int(os.getenv('IMAGE_PROCESS_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+FORMAT_INFO = {
+    'webp': ('WEBP', 'image/webp', '.webp'),
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+}
+
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+
+def pool_context():
+    """Start method for the pool workers: never a plain fork() of the running server"""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def process_image(data, max_edge=IMAGE_MAX_EDGE, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    """Resize and re-encode one image; returns (bytes, mime_type, extension) or None to keep the original.
+
+    Runs inside pool worker processes, so it only takes and returns picklable values.
+    """
+    pil_format, mime_type, extension = FORMAT_INFO.get(image_format, FORMAT_INFO['webp'])
+    with Image.open(io.BytesIO(data)) as image:
+        # Animated images would lose their frames
+        if getattr(image, 'is_animated', False):
+            return None
+        # Bake the EXIF orientation into the pixels before the metadata is dropped
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            rgba = image.convert('RGBA')
+            background.paste(rgba, mask=rgba.getchannel('A'))
+            image = background
+        elif image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+        output = io.BytesIO()
+        # No exif= argument: the re-encoded file carries no EXIF/GPS metadata
+        image.save(output, pil_format, quality=quality, optimize=True)
+
+    result = output.getvalue()
+    if len(result) >= len(data):
+        return None
+    return result, mime_type, extension
+
+
+class ImagePreprocessor:
+    """Runs process_image for upload parts on a lazily created process pool"""
+    def __init__(self, workers=IMAGE_PROCESS_WORKERS, enabled=IMAGE_PREPROCESS, cache=image_cache):
+        self.workers = workers
+        self.cache = cache if cache is not None and cache.enabled else None
+        self.settings = f"{IMAGE_MAX_EDGE}:{IMAGE_FORMAT}:{IMAGE_QUALITY}"
+        self.enabled = enabled and PIL_AVAILABLE
+        self.pool = None
+        self.lock = threading.Lock()
+        self.images_processed = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        if enabled and not PIL_AVAILABLE:
+            logger.warning("Pillow not installed; uploaded images will be forwarded unprocessed")
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None and self.workers > 0:
+                try:
+                    self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                                       mp_context=pool_context())
+                except (OSError, NotImplementedError) as e:
+                    logger.warning(f"Image process pool unavailable, processing inline: {e}")
+                    self.workers = 0
+            return self.pool
+
+    def shutdown(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            # wait=True: workers are joined here, not by the interpreter's exit hook after their pipes closed
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, part):
+        """Look one part up in the cache, else start processing it; returns (cache_key, cached, Future)
+
+        cached is the cache entry on a hit; the Future is None when there is nothing to process.
+        """
+        part.file.seek(0)
+        data = part.file.read()
+        key = None
+        if self.cache is not None:
+            # Unprocessed uploads are cached under keys of their own
+            key = self.cache.key_for(data, self.settings if self.enabled else 'original')
+            cached = self.cache.get(key, original_size=len(data))
+            if cached is not None:
+                return None, cached, None
+        if not self.enabled:
+            return key, None, None
+        pool = self.get_pool()
+        if pool is not None:
+            return key, None, pool.submit(process_image, data)
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(process_image(data))
+        except Exception as e:
+            future.set_exception(e)
+        return key, None, future
+
+    def apply(self, part, key, cached, future):
+        """Swap a part's file for the processed or cached image; returns (bytes_before, bytes_after)"""
+        before = part.size
+        if cached is not None:
+            self.use_cached(part, *cached)
+        else:
+            result = None
+            if future is not None:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning(f"Image preprocessing failed for {part.filename}: {e}")
+                    # Not cached: the next upload of it gets another try
+                    key = None
+            if result is not None:
+                data, mime_type, extension = result
+                new_file = tempfile.SpooledTemporaryFile(max_size=len(data) + 1)
+                new_file.write(data)
+                new_file.seek(0)
+                part.file.close()
+                part.file = new_file
+                part.size = len(data)
+                part.content_type = mime_type
+                part.filename = os.path.splitext(part.filename)[0] + extension
+            if key is not None:
+                # Encoded once here: the request body and every later hit use this text
+                part.file.seek(0)
+                part.encoded = base64.b64encode(part.file.read())
+                self.cache.put(key, (part.content_type, result[2] if result else '', part.encoded))
+        with self.lock:
+            self.images_processed += 1
+            self.bytes_before += before
+            self.bytes_after += part.size
+        return before, part.size
+
+    @staticmethod
+    def use_cached(part, mime_type, extension, encoded):
+        """Point a part at a cache entry; its file keeps the original upload, which is no longer sent"""
+        part.encoded = encoded
+        part.size = len(encoded) // 4 * 3 - encoded[-2:].count(b'=')
+        part.content_type = mime_type
+        if extension:
+            part.filename = os.path.splitext(part.filename)[0] + extension
+
+    def candidates(self, parts):
+        if not self.enabled and self.cache is None:
+            return []
+        return [part for part in parts if part.content_type.startswith('image/')]
+
+    def process(self, parts, timeout=None):
+        """Preprocess image parts in place; returns (bytes_before, bytes_after) for the request"""
+        jobs = [(part, *self.submit(part)) for part in self.candidates(parts)]
+        futures = [future for _part, _key, _cached, future in jobs if future is not None]
+        if futures:
+            concurrent.futures.wait(futures, timeout=timeout)
+        return self._apply_all(jobs)
+
+    async def process_async(self, parts, timeout=None):
+        """Event-loop friendly variant of process(): hashing and base64 run on a worker thread"""
+        parts = self.candidates(parts)
+        if not parts:
+            return 0, 0
+        jobs = await asyncio.to_thread(lambda: [(part, *self.submit(part)) for part in parts])
+        futures = [asyncio.wrap_future(future) for _part, _key, _cached, future in jobs if future is not None]
+        if futures:
+            await asyncio.wait(futures, timeout=timeout)
+        return await asyncio.to_thread(self._apply_all, jobs)
+
+    def _apply_all(self, jobs):
+        total_before = total_after = 0
+        for part, key, cached, future in jobs:
+            if future is not None and not future.done():
+                future.cancel()
+                logger.warning(f"Image preprocessing timed out for {part.filename}, sending original")
+                total_before += part.size
+                total_after += part.size
+                continue
+            before, after = self.apply(part, key, cached, future)
+            total_before += before
+            total_after += after
+        return total_before, total_after
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'images_processed': self.images_processed,
+                'bytes_before': self.bytes_before,
+                'bytes_after': self.bytes_after,
+                'max_edge': IMAGE_MAX_EDGE,
+                'format': IMAGE_FORMAT,
+                'quality': IMAGE_QUALITY,
+                'cache': self.cache.stats() if self.cache is not None else None,
+            }
+
+
+# Shared preprocessor used by every upload path in the process
+image_preprocessor = ImagePreprocessor()
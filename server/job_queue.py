@@ -0,0 +1,291 @@
+"""Durable queue for chat messages answered asynchronously.
+
+A chat POST sent with ``Prefer: respond-async`` (or ``?async=1``) is not
+forwarded while the client waits. The message is stored in a local SQLite
+database, the client gets 202 with a job id, and a bounded pool of worker
+threads forwards queued messages to n8n, retrying failures with
+exponential back-off. The client polls GET /api/chat/jobs/<id>, or
+long-polls it with ``?wait=<seconds>``, for the answer.
+
+A slow AI turn then holds a queue worker instead of a request thread, and
+a message survives n8n being down for a while or the proxy restarting.
+Running jobs hold a lease; a job whose worker died is picked up again when
+the lease runs out. The database may be shared by pre-fork workers: jobs
+are claimed with a single UPDATE, and two messages of one session are
+never sent to n8n at the same time, so the agent sees them in order.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+CHAT_JOBS_ENABLED = os.getenv('CHAT_JOBS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+CHAT_JOBS_DB = os.getenv('CHAT_JOBS_DB', 'chat_jobs.sqlite3')
+CHAT_JOB_WORKERS = int(os.getenv('CHAT_JOB_WORKERS', '4'))
+CHAT_JOB_MAX_ATTEMPTS = int(os.getenv('CHAT_JOB_MAX_ATTEMPTS', '3'))
+CHAT_JOB_RETRY_SECONDS = float(os.getenv('CHAT_JOB_RETRY_SECONDS', '5'))
+CHAT_JOB_LEASE_SECONDS = float(os.getenv('CHAT_JOB_LEASE_SECONDS', '120'))
+CHAT_JOB_MAX_QUEUED = int(os.getenv('CHAT_JOB_MAX_QUEUED', '1000'))
+CHAT_JOB_RETENTION_SECONDS = float(os.getenv('CHAT_JOB_RETENTION_SECONDS', '3600'))
+CHAT_JOB_MAX_WAIT_SECONDS = float(os.getenv('CHAT_JOB_MAX_WAIT_SECONDS', '25'))
+# Idle workers and long-polls re-check the database this often, which picks up
+# retries coming due and changes made by other processes
+POLL_INTERVAL = 0.5
+PRUNE_INTERVAL = 60
+# stats() reports job counts the workers took at most this long ago, so
+# /api/health never runs a query (nor waits for the database lock) itself
+COUNTS_INTERVAL = 2
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    session_id TEXT,
+    content_type TEXT NOT NULL,
+    body BLOB NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL,
+    result BLOB,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, run_after);
+"""
+
+# Oldest runnable job: queued and due, or running with an expired lease,
+# and no other job of its session currently leased
+CLAIM_SQL = """
+UPDATE jobs SET status = 'running', attempts = attempts + 1, run_after = :lease, updated_at = :now
+WHERE id = (
+    SELECT id FROM jobs
+    WHERE status IN ('queued', 'running') AND run_after <= :now
+      AND (session_id IS NULL OR session_id NOT IN (
+          SELECT session_id FROM jobs
+          WHERE status = 'running' AND run_after > :now AND session_id IS NOT NULL))
+    ORDER BY created_at
+    LIMIT 1
+)
+RETURNING id, content_type, body, attempts
+"""
+
+
+class QueueFull(Exception):
+    """Raised by submit() when CHAT_JOB_MAX_QUEUED jobs are already waiting"""
+
+
+def wants_async(prefer, query):
+    """Whether a chat request asked for job mode (Prefer: respond-async or ?async=1)"""
+    if 'respond-async' in (prefer or '').lower():
+        return True
+    return any(pair in ('async=1', 'async=true') for pair in (query or '').split('&'))
+
+
+class ChatJobQueue:
+    """SQLite-backed job store plus the worker threads that drain it to n8n"""
+    def __init__(self, path=CHAT_JOBS_DB, workers=CHAT_JOB_WORKERS, max_attempts=CHAT_JOB_MAX_ATTEMPTS,
+                 retry_seconds=CHAT_JOB_RETRY_SECONDS, lease_seconds=CHAT_JOB_LEASE_SECONDS,
+                 max_queued=CHAT_JOB_MAX_QUEUED):
+        self.path = path
+        self.worker_count = workers
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.lease_seconds = lease_seconds
+        self.max_queued = max_queued
+        self.forward = None
+        self.conn = None
+        self.db_lock = threading.Lock()
+        # Notified whenever a job is added or finishes in this process
+        self.changed = threading.Condition()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.last_prune = 0.0
+        self.counts = {}
+        self.counts_at = 0.0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+    @property
+    def running(self):
+        return bool(self.threads)
+
+    def open(self):
+        """Open the database (in the process that uses it, never before a fork)"""
+        with self.db_lock:
+            if self.conn is None:
+                conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                conn.executescript(SCHEMA)
+                self.conn = conn
+
+    def execute(self, sql, params=()):
+        with self.db_lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def start(self, forward):
+        """Start the workers; forward(body, content_type) returns n8n's answer or None on failure"""
+        if self.threads:
+            return
+        self.open()
+        self.forward = forward
+        self.stopping.clear()
+        for index in range(self.worker_count):
+            thread = threading.Thread(target=self.work, daemon=True, name=f'chat-job-{index}')
+            thread.start()
+            self.threads.append(thread)
+        self.refresh_counts(force=True)
+        pending = self.counts.get(QUEUED, 0) + self.counts.get(RUNNING, 0)
+        logger.info(f"Chat job queue at {self.path}: {self.worker_count} workers, {pending} jobs pending")
+
+    def stop(self):
+        self.stopping.set()
+        with self.changed:
+            self.changed.notify_all()
+        self.threads = []
+
+    def notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def submit(self, body, content_type, session_id=None):
+        """Persist a message for the workers; returns the job id"""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self.db_lock:
+            queued = self.conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFull(f"{queued} chat jobs already queued")
+            self.conn.execute(
+                "INSERT INTO jobs (id, status, session_id, content_type, body, run_after, created_at, updated_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?)",
+                (job_id, session_id or None, content_type, body, now, now, now))
+            self.submitted += 1
+        self.notify()
+        logger.info(f"Queued chat job {job_id} ({len(body)} bytes)")
+        return job_id
+
+    def get(self, job_id):
+        """The job as a dict (without its request body), or None if unknown or pruned"""
+        rows = self.execute(
+            "SELECT id, status, attempts, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+            (job_id,))
+        if not rows:
+            return None
+        keys = ('id', 'status', 'attempts', 'result', 'error', 'created_at', 'updated_at')
+        return dict(zip(keys, rows[0]))
+
+    def wait(self, job_id, timeout):
+        """get(), but block up to timeout seconds for the job to finish"""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] in (DONE, FAILED) or remaining <= 0:
+                return job
+            with self.changed:
+                self.changed.wait(min(POLL_INTERVAL, remaining))
+
+    def claim(self):
+        now = time.time()
+        rows = self.execute(CLAIM_SQL, {'now': now, 'lease': now + self.lease_seconds})
+        return rows[0] if rows else None
+
+    def finish(self, job_id, status, result=None, error=None):
+        self.execute("UPDATE jobs SET status = ?, result = ?, error = ?, body = CASE WHEN ? THEN x'' ELSE body END, "
+                     "updated_at = ? WHERE id = ?",
+                     (status, result, error, status in (DONE, FAILED), time.time(), job_id))
+        self.notify()
+
+    def work(self):
+        while not self.stopping.is_set():
+            try:
+                self.refresh_counts()
+                job = self.claim()
+                if job is None:
+                    self.prune()
+                    with self.changed:
+                        self.changed.wait(POLL_INTERVAL)
+                    continue
+                self.run(*job)
+            except Exception as e:
+                logger.error(f"Chat job worker error: {e}", exc_info=True)
+                self.stopping.wait(POLL_INTERVAL)
+
+    def run(self, job_id, content_type, body, attempts):
+        if attempts > self.max_attempts:
+            # Its earlier workers died mid-attempt
+            logger.error(f"Chat job {job_id} abandoned after {attempts - 1} interrupted attempts")
+            self.failed += 1
+            self.finish(job_id, FAILED, error='interrupted too many times')
+            return
+        started = time.monotonic()
+        try:
+            result = self.forward(body, content_type)
+        except Exception as e:
+            logger.error(f"Chat job {job_id} attempt {attempts} failed: {e}", exc_info=True)
+            result = None
+        if result is not None:
+            self.completed += 1
+            self.finish(job_id, DONE, result=result)
+            logger.info(f"Chat job {job_id} done in {time.monotonic() - started:.2f}s (attempt {attempts})")
+        elif attempts >= self.max_attempts:
+            self.failed += 1
+            self.finish(job_id, FAILED, error='n8n unavailable')
+            logger.error(f"Chat job {job_id} failed after {attempts} attempts")
+        else:
+            delay = self.retry_seconds * 2 ** (attempts - 1)
+            self.retried += 1
+            self.execute("UPDATE jobs SET status = 'queued', run_after = ?, updated_at = ? WHERE id = ?",
+                         (time.time() + delay, time.time(), job_id))
+            logger.warning(f"Chat job {job_id} attempt {attempts} failed, retrying in {delay:.1f}s")
+
+    def prune(self):
+        """Drop finished jobs older than CHAT_JOB_RETENTION_SECONDS"""
+        now = time.time()
+        if now - self.last_prune < PRUNE_INTERVAL:
+            return
+        self.last_prune = now
+        removed = self.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ? RETURNING id",
+                               (now - CHAT_JOB_RETENTION_SECONDS,))
+        if removed:
+            logger.info(f"Pruned {len(removed)} finished chat jobs")
+
+    def refresh_counts(self, force=False):
+        """Re-count jobs by status for stats(), at most every COUNTS_INTERVAL; runs on the worker threads"""
+        now = time.monotonic()
+        if not force and now - self.counts_at < COUNTS_INTERVAL:
+            return
+        self.counts_at = now
+        self.counts = dict(self.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def stats(self):
+        if self.conn is None:
+            return {'enabled': CHAT_JOBS_ENABLED, 'running': False}
+        counts = self.counts
+        return {
+            'enabled': CHAT_JOBS_ENABLED,
+            'running': self.running,
+            'workers': self.worker_count,
+            'queued': counts.get(QUEUED, 0),
+            'in_progress': counts.get(RUNNING, 0),
+            'done': counts.get(DONE, 0),
+            'failed': counts.get(FAILED, 0),
+            # This process since start
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failures': self.failed,
+            'retries': self.retried,
+        }
+
+
+# Shared queue for both serving engines
+chat_jobs = ChatJobQueue()
@@ -0,0 +1,210 @@
+"""Logging off the request path: a queue, a writer thread and JSON records.
+
+With the standard handlers every log call formats its message and writes
+it to the file and to stdout on the calling thread, under each handler's
+lock, so under load request threads queue up behind disk writes. Here a
+QueueHandler only puts the record on a bounded queue; one writer thread
+formats it and writes it out. Records are formatted only there, so a
+message passed as a %-format with arguments costs almost nothing on the
+request thread, and nothing at all when its level is disabled. When the
+queue is full (the disk cannot keep up) records are dropped and counted
+rather than blocking requests.
+
+- LOG_FILE gets one JSON object per line (LOG_FILE_FORMAT=text for the
+  old layout) and rotates at LOG_MAX_MB, keeping LOG_BACKUPS files.
+- stdout keeps the human-readable layout (LOG_CONSOLE=false turns it off).
+- LOG_SAMPLE_RATES, e.g. "INFO=0.1,DEBUG=0.01", keeps that share of the
+  per-request lines logged to REQUEST_LOGGER; warnings, errors and all
+  other loggers are never sampled.
+
+Threads do not survive fork(): a forked child (a pre-fork worker) starts
+its own writer thread and writes to its own file, named with its PID.
+Arguments are formatted later on the writer thread, so pass values that
+do not change afterwards (str, numbers), not live objects.
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE', 'proxy_server.log')
+LOG_FILE_FORMAT = os.getenv('LOG_FILE_FORMAT', 'json').lower()
+LOG_CONSOLE = os.getenv('LOG_CONSOLE', 'true').lower() in ('1', 'true', 'yes')
+LOG_MAX_MB = float(os.getenv('LOG_MAX_MB', '50'))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '5'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+
+# Per-request lines (access log, chat progress) go here and may be sampled
+REQUEST_LOGGER = 'inkflow.requests'
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed with extra=
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+def parse_sample_rates(text):
+    """'INFO=0.1,DEBUG=0.01' -> {logging.INFO: 0.1, logging.DEBUG: 0.01}"""
+    rates = {}
+    for item in text.split(','):
+        name, _, rate = item.partition('=')
+        if name.strip():
+            rates[logging.getLevelName(name.strip().upper())] = float(rate)
+    return rates
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with any extra= fields"""
+    def format(self, record):
+        document = {
+            'ts': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES:
+                document[key] = value
+        if record.exc_info:
+            document['exc'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            document['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(document, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a share of the request logger's records per level"""
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = 0
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is None or rate >= 1 or record.levelno >= logging.WARNING or record.name != REQUEST_LOGGER:
+            return True
+        if random.random() < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records unformatted; drop them when the queue is full"""
+    def __init__(self, record_queue, on_close=None):
+        super().__init__(record_queue)
+        self.on_close = on_close
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Same process: the writer thread formats, message, arguments and traceback included
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # logging.shutdown() closes the newest handler first: drain the queue into the others
+        if self.on_close is not None:
+            self.on_close()
+        super().close()
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    """QueueListener whose stop() waits for room in a full queue instead of failing"""
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """Root logging setup: queue handler in front, file and console handlers on a writer thread"""
+    def __init__(self):
+        self.queue_handler = None
+        self.listener = None
+        self.file_handler = None
+        self.sampler = None
+        self.lock = threading.Lock()
+
+    def configure(self, level=LOG_LEVEL, path=LOG_FILE, file_format=LOG_FILE_FORMAT, console=LOG_CONSOLE,
+                  max_bytes=LOG_MAX_MB * 1024 * 1024, backups=LOG_BACKUPS, queue_size=LOG_QUEUE_SIZE,
+                  sample_rates=LOG_SAMPLE_RATES):
+        """Replace the root logger's handlers with the pipeline and start the writer thread"""
+        text = logging.Formatter(TEXT_FORMAT)
+        handlers = []
+        if path:
+            # delay: nothing is opened until the first record, so a forked child can switch files first
+            self.file_handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=int(max_bytes), backupCount=backups, encoding='utf-8', delay=True)
+            self.file_handler.setFormatter(JSONFormatter() if file_format == 'json' else text)
+            handlers.append(self.file_handler)
+        if console:
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(text)
+            handlers.append(console_handler)
+
+        self.queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size), on_close=self.stop)
+        self.sampler = SamplingFilter(parse_sample_rates(sample_rates))
+        self.queue_handler.addFilter(self.sampler)
+        self.queue_size = queue_size
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        root.setLevel(level)
+        self.listener = DrainingQueueListener(self.queue_handler.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        os.register_at_fork(after_in_child=self.after_fork)
+        atexit.register(self.stop)
+        return self
+
+    def after_fork(self):
+        """In a forked child: a fresh queue and writer thread, and a file of its own"""
+        if self.listener is None:
+            return
+        self.lock = threading.Lock()
+        if self.file_handler is not None:
+            if self.file_handler.stream is not None:
+                self.file_handler.stream.close()
+                self.file_handler.stream = None
+            root, ext = os.path.splitext(self.file_handler.baseFilename)
+            self.file_handler.baseFilename = f"{root}-{os.getpid()}{ext}"
+        self.queue_handler.queue = queue.Queue(self.queue_size)
+        self.listener = DrainingQueueListener(self.queue_handler.queue, *self.listener.handlers,
+                                              respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Write out what is queued and stop the writer thread"""
+        with self.lock:
+            listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.flush()
+
+    def stats(self):
+        if self.queue_handler is None:
+            return {'enabled': False}
+        return {
+            'enabled': True,
+            'file': self.file_handler.baseFilename if self.file_handler else None,
+            'queued': self.queue_handler.queue.qsize(),
+            'dropped': self.queue_handler.dropped,
+            'sampled_out': self.sampler.sampled_out,
+        }
+
+
+# Shared pipeline for the whole process
+log_pipeline = LogPipeline()
@@ -0,0 +1,236 @@
+"""Fixed-bucket latency histograms exposed in Prometheus text format.
+
+Request phases (body read, parse, image preprocessing, upstream, response
+write) are recorded per route, and upstream connect / time to first byte
+per n8n endpoint. Streamed chat replies also record time to first token,
+and admission control its queue waits, rejections and queue depth.
+Samples are spread over striped shards, each with its own lock, so
+request threads only contend when they land on the same shard. The shards
+are merged when /api/metrics is scraped.
+"""
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_SHARDS = 16
+
+# Seconds; chat turns through the AI agent commonly take several seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Shard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cells = {}
+
+
+class Histogram:
+    """Cumulative-bucket histogram with label values, recorded on striped shards"""
+    def __init__(self, name, documentation, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.shards = [_Shard() for _ in range(METRICS_SHARDS)]
+
+    def observe(self, value, *label_values):
+        if not METRICS_ENABLED:
+            return
+        # Linear scan: the bucket list is short and most samples land early
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        shard = self.shards[threading.get_ident() % METRICS_SHARDS]
+        with shard.lock:
+            cell = shard.cells.get(label_values)
+            if cell is None:
+                # [per-bucket counts..., +Inf count, sum]
+                cell = shard.cells[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            cell[index] += 1
+            cell[-1] += value
+
+    def snapshot(self):
+        """Merged {label_values: (bucket_counts, sum)} across shards"""
+        merged = {}
+        for shard in self.shards:
+            with shard.lock:
+                cells = [(labels, list(cell)) for labels, cell in shard.cells.items()]
+            for labels, cell in cells:
+                total = merged.get(labels)
+                if total is None:
+                    merged[labels] = cell
+                else:
+                    for i, count in enumerate(cell):
+                        total[i] += count
+        return {labels: (cell[:-1], cell[-1]) for labels, cell in merged.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="' + _format_number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {total!r}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter with label values, recorded on striped shards"""
+    def __init__(self, name, documentation, label_names):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.shards = [_Shard() for _ in range(METRICS_SHARDS)]
+
+    def inc(self, *label_values, amount=1):
+        if not METRICS_ENABLED:
+            return
+        shard = self.shards[threading.get_ident() % METRICS_SHARDS]
+        with shard.lock:
+            shard.cells[label_values] = shard.cells.get(label_values, 0) + amount
+
+    def snapshot(self):
+        merged = {}
+        for shard in self.shards:
+            with shard.lock:
+                items = list(shard.cells.items())
+            for labels, value in items:
+                merged[labels] = merged.get(labels, 0) + value
+        return merged
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.snapshot().items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """Current values read from a callback when /api/metrics is scraped"""
+    def __init__(self, name, documentation, label_names, collect):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_number(value)}")
+        return lines
+
+
+class TimedReader:
+    """Wraps a request stream and adds up the time spent blocked in read()"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        try:
+            return self.stream.read(size)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+class MetricsRegistry:
+    """The proxy's metrics and the /api/metrics document"""
+    def __init__(self):
+        self.request_duration = Histogram(
+            'inkflow_request_duration_seconds', 'Total time to handle a request.', ('route',))
+        self.request_phase = Histogram(
+            'inkflow_request_phase_seconds',
+            'Time spent per request phase (read, parse, preprocess, upstream, write).', ('route', 'phase'))
+        self.upstream_phase = Histogram(
+            'inkflow_upstream_phase_seconds',
+            'n8n call phases: connect and time to first response byte.', ('endpoint', 'phase'))
+        self.responses = Counter(
+            'inkflow_responses_total', 'Responses sent, by route and status code.', ('route', 'status'))
+        self.first_token = Histogram(
+            'inkflow_time_to_first_token_seconds',
+            'Streamed chat requests: time from the request to the first relayed n8n byte.', ())
+        self.admission_wait = Histogram(
+            'inkflow_admission_wait_seconds', 'Time requests waited in the admission queue, by lane.', ('lane',))
+        self.admission_rejected = Counter(
+            'inkflow_admission_rejected_total', 'Requests answered 503 by admission control.', ('lane', 'reason'))
+        self.rate_limited = Counter(
+            'inkflow_rate_limited_total', 'Chat messages answered 429, by limit (ip or session).', ('scope',))
+        self.collectors = [self.request_duration, self.request_phase, self.upstream_phase, self.first_token,
+                           self.responses, self.admission_wait, self.admission_rejected, self.rate_limited]
+
+    def observe_phase(self, route, phase, seconds):
+        self.request_phase.observe(seconds, route, phase)
+
+    def observe_upstream(self, endpoint, phase, seconds):
+        self.upstream_phase.observe(seconds, endpoint, phase)
+
+    def observe_first_token(self, seconds):
+        self.first_token.observe(seconds)
+
+    def observe_request(self, route, status, seconds):
+        self.request_duration.observe(seconds, route)
+        self.responses.inc(route, str(status))
+
+    def observe_admission_wait(self, lane, seconds):
+        self.admission_wait.observe(seconds, lane)
+
+    def count_admission_rejected(self, lane, reason):
+        self.admission_rejected.inc(lane, reason)
+
+    def count_rate_limited(self, scope):
+        self.rate_limited.inc(scope)
+
+    def register(self, collector):
+        """Add a collector owned by another module (e.g. a Gauge over its state)"""
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for collector in self.collectors:
+            lines.extend(collector.render())
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def route_for(path):
+    """Low-cardinality route label for a request path"""
+    path = path.split('?', 1)[0]
+    if path.startswith('/api/chat/jobs/'):
+        return 'chat_jobs'
+    if path.startswith('/api/chat'):
+        return 'chat'
+    if path in ('/api/health', '/api/health/live', '/api/health/ready', '/api/metrics'):
+        return path[len('/api/'):]
+    if path.startswith('/api/'):
+        return 'api_other'
+    return 'static'
+
+
+# Shared registry for both serving engines and the upstream client
+metrics = MetricsRegistry()
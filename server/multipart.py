@@ -0,0 +1,271 @@
+"""Incremental multipart/form-data parser.
+
+The body is fed in chunks and each part is handed back as soon as its
+closing boundary has been seen. Text fields are kept in memory up to a
+small cap; file parts are written to spooled temporary files, so memory
+per upload is bounded by the chunk size rather than the payload size.
+
+With UploadLimits the parser also polices file parts while they stream
+in: too many files, a file over the size cap, or content whose magic bytes
+are not an allowed type (the declared Content-Type is not trusted) raise
+PartRejected at once, before the rest of the body is read.
+"""
+import os
+import re
+import tempfile
+
+MULTIPART_CHUNK_SIZE = int(os.getenv('MULTIPART_CHUNK_SIZE', str(64 * 1024)))
+MAX_FIELD_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+UPLOAD_ALLOWED_TYPES = [t.strip() for t in os.getenv(
+    'UPLOAD_ALLOWED_TYPES', 'image/jpeg,image/png,image/gif,image/webp,image/heic,image/heif,image/avif'
+).split(',') if t.strip()]
+# Enough for every signature in sniff_type()
+SNIFF_BYTES = 16
+
+_PARAM_RE = re.compile(r';\s*([\w*-]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;\s]*))')
+
+
+class MultipartError(ValueError):
+    """Malformed or truncated multipart body"""
+
+
+class PartRejected(MultipartError):
+    """A well-formed part that breaks the upload limits; status is the HTTP answer (413 or 415)"""
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def sniff_type(head):
+    """MIME type from a file's first bytes, or None if it is not a known image format"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in (b'avif', b'avis'):
+            return 'image/avif'
+        if brand in (b'heic', b'heix', b'hevc', b'hevx'):
+            return 'image/heic'
+        if brand in (b'mif1', b'msf1'):
+            return 'image/heif'
+    return None
+
+
+class UploadLimits:
+    """Per-request caps on file parts, checked as the body streams"""
+    def __init__(self, max_files, max_file_size, allowed_types=UPLOAD_ALLOWED_TYPES):
+        self.max_files = max_files
+        self.max_file_size = max_file_size
+        self.allowed_types = frozenset(allowed_types)
+
+
+def parse_boundary(content_type):
+    """Extract the boundary from a multipart Content-Type header"""
+    for match in _PARAM_RE.finditer(content_type):
+        if match.group(1).lower() == 'boundary':
+            boundary = match.group(2) if match.group(2) is not None else match.group(3)
+            if boundary and len(boundary) <= 200:
+                return boundary.encode('latin-1')
+    raise MultipartError("Missing multipart boundary")
+
+
+def _parse_part_headers(raw):
+    headers = {}
+    for line in raw.decode('utf-8', errors='replace').split('\r\n'):
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    params = {}
+    for match in _PARAM_RE.finditer(headers.get('content-disposition', '')):
+        value = match.group(2) if match.group(2) is not None else match.group(3)
+        params[match.group(1).lower()] = value.replace('\\"', '"')
+    return headers, params
+
+
+class MultipartPart:
+    """One finished form field or uploaded file"""
+    def __init__(self, headers, params, spool_size, limits=None):
+        self.headers = headers
+        self.limits = limits
+        self.name = params.get('name', '')
+        self.filename = params.get('filename')
+        self.content_type = headers.get('content-type', 'text/plain' if self.filename is None else 'application/octet-stream')
+        self.size = 0
+        self.value = bytearray() if self.filename is None else None
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size) if self.filename is not None else None
+        # First bytes of a file, kept until its type has been checked
+        self.head = bytearray() if self.file is not None and limits is not None else None
+        # Base64 of the file when it is already known (set from the image cache), else None
+        self.encoded = None
+
+    @property
+    def is_file(self):
+        return self.filename is not None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.file is not None:
+            if self.limits is not None:
+                self.check_limits(data)
+            self.file.write(data)
+        else:
+            if self.size > MAX_FIELD_SIZE:
+                raise MultipartError(f"Form field '{self.name}' exceeds {MAX_FIELD_SIZE} bytes")
+            self.value += data
+
+    def check_limits(self, data):
+        if self.size > self.limits.max_file_size:
+            raise PartRejected(f"File '{self.filename}' exceeds {self.limits.max_file_size} bytes", 413)
+        if self.head is not None:
+            self.head += data[:SNIFF_BYTES]
+            if len(self.head) >= SNIFF_BYTES:
+                self.check_type()
+
+    def check_type(self):
+        sniffed = sniff_type(bytes(self.head))
+        self.head = None
+        if sniffed not in self.limits.allowed_types:
+            raise PartRejected(f"File '{self.filename}' is not an allowed type ({sniffed or 'unknown'})", 415)
+        # Trust the content over what the client declared
+        self.content_type = sniffed
+
+    def finish(self):
+        if self.file is not None:
+            # Files shorter than SNIFF_BYTES (empty picker entries carry no filename checks)
+            if self.head is not None and self.size and self.filename:
+                self.check_type()
+            self.file.seek(0)
+        else:
+            self.value = bytes(self.value)
+
+    def text(self, encoding='utf-8'):
+        return self.value.decode(encoding, errors='replace') if self.value is not None else ''
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class MultipartParser:
+    """Push parser: feed() body chunks, get back the parts completed so far"""
+    PREAMBLE, HEADERS, BODY, DONE = range(4)
+
+    def __init__(self, boundary, spool_size=MULTIPART_CHUNK_SIZE, limits=None):
+        # The first boundary may not be preceded by CRLF; prime the buffer with one
+        self.delimiter = b'\r\n--' + boundary
+        self.buffer = bytearray(b'\r\n')
+        self.state = self.PREAMBLE
+        self.spool_size = spool_size
+        self.limits = limits
+        self.file_count = 0
+        self.part = None
+
+    def feed(self, data):
+        finished = []
+        try:
+            return self._feed(data, finished)
+        except MultipartError:
+            # Parts completed in this chunk were never handed out
+            for part in finished:
+                part.close()
+            self.abort()
+            raise
+
+    def _feed(self, data, finished):
+        self.buffer += data
+        while True:
+            if self.state == self.PREAMBLE:
+                index = self.buffer.find(self.delimiter)
+                if index == -1:
+                    # Keep just enough to match a boundary split across chunks
+                    del self.buffer[:max(0, len(self.buffer) - len(self.delimiter))]
+                    return finished
+                del self.buffer[:index + len(self.delimiter)]
+                if not self._after_delimiter():
+                    return finished
+            elif self.state == self.HEADERS:
+                index = self.buffer.find(b'\r\n\r\n')
+                if index == -1:
+                    if len(self.buffer) > MAX_HEADER_SIZE:
+                        raise MultipartError("Part headers too large")
+                    return finished
+                headers, params = _parse_part_headers(bytes(self.buffer[:index]))
+                del self.buffer[:index + 4]
+                self.part = MultipartPart(headers, params, self.spool_size, self.limits)
+                if self.limits is not None and self.part.filename:
+                    self.file_count += 1
+                    if self.file_count > self.limits.max_files:
+                        raise PartRejected(f"More than {self.limits.max_files} files", 413)
+                self.state = self.BODY
+            elif self.state == self.BODY:
+                index = self.buffer.find(self.delimiter)
+                if index == -1:
+                    safe = len(self.buffer) - len(self.delimiter)
+                    if safe > 0:
+                        self.part.write(bytes(self.buffer[:safe]))
+                        del self.buffer[:safe]
+                    return finished
+                self.part.write(bytes(self.buffer[:index]))
+                del self.buffer[:index + len(self.delimiter)]
+                self.part.finish()
+                finished.append(self.part)
+                self.part = None
+                if not self._after_delimiter():
+                    return finished
+            else:
+                # Epilogue after the closing boundary is ignored
+                self.buffer.clear()
+                return finished
+
+    def _after_delimiter(self):
+        """Consume the '--' or CRLF following a boundary; False if more data is needed"""
+        if len(self.buffer) < 2:
+            # Re-insert the delimiter so the boundary is matched again on the next feed
+            self.buffer[:0] = self.delimiter
+            self.state = self.PREAMBLE
+            return False
+        if self.buffer[:2] == b'--':
+            self.state = self.DONE
+        else:
+            # Skip transport padding up to the end of the boundary line
+            line_end = self.buffer.find(b'\r\n')
+            if line_end == -1:
+                self.buffer[:0] = self.delimiter
+                self.state = self.PREAMBLE
+                return False
+            del self.buffer[:line_end + 2]
+            self.state = self.HEADERS
+        return True
+
+    def abort(self):
+        """Drop the part being received"""
+        if self.part is not None:
+            self.part.close()
+            self.part = None
+
+    def close(self):
+        """Finish parsing; raises MultipartError if the body was truncated"""
+        if self.state != self.DONE:
+            self.abort()
+            raise MultipartError("Multipart body ended before the closing boundary")
+
+
+def iter_multipart(stream, boundary, content_length=None, chunk_size=MULTIPART_CHUNK_SIZE, limits=None):
+    """Read a multipart body from a blocking stream, yielding parts as they finish"""
+    parser = MultipartParser(boundary, spool_size=chunk_size, limits=limits)
+    remaining = content_length
+    while remaining is None or remaining > 0:
+        chunk = stream.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield from parser.feed(chunk)
+    parser.close()
@@ -0,0 +1,214 @@
+"""Pre-fork supervisor: N worker processes sharing the listening port.
+
+With WORKERS > 1 the supervisor forks that many copies of the server.
+Each worker binds its own socket with SO_REUSEPORT and the kernel spreads
+incoming connections across them, so JSON parsing, multipart scanning and
+base64 work use every core instead of one GIL. Workers that die are
+restarted, with a back-off when they crash right after starting. SIGTERM
+or SIGINT is passed on to the workers, which stop accepting, finish their
+in-flight requests and exit; stragglers are killed after
+WORKER_DRAIN_SECONDS.
+
+Each worker writes a small stats file every WORKER_STATS_INTERVAL seconds
+into a directory the supervisor creates before forking, and /api/health
+of any worker aggregates them.
+"""
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv('WORKERS', '1'))
+WORKER_DRAIN_SECONDS = float(os.getenv('WORKER_DRAIN_SECONDS', '30'))
+WORKER_STATS_INTERVAL = float(os.getenv('WORKER_STATS_INTERVAL', '2'))
+# A worker exiting sooner than this after starting counts as a crash loop
+MIN_WORKER_LIFETIME = 5.0
+MAX_RESTART_DELAY = 30.0
+
+
+def prefork_supported():
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+class WorkerStats:
+    """Per-worker stats files in a shared directory"""
+    def __init__(self, directory=''):
+        self.directory = directory
+        self.collect = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def start(self, collect, interval=WORKER_STATS_INTERVAL):
+        """Publish collect() every interval seconds from a daemon thread"""
+        if not self.enabled or self.thread is not None:
+            return
+        self.collect = collect
+
+        def loop():
+            while True:
+                self.publish()
+                if self.stop_event.wait(interval):
+                    break
+
+        self.thread = threading.Thread(target=loop, daemon=True, name='worker-stats')
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def publish(self):
+        if not self.enabled or self.collect is None:
+            return
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        try:
+            data = dict(self.collect(), pid=os.getpid(), updated=time.time())
+            with open(path + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            logger.debug("Worker stats publish failed: %s", e)
+
+    def snapshot(self):
+        """Every worker's latest stats plus totals, or None outside pre-fork mode"""
+        if not self.enabled:
+            return None
+        # Our own entry is refreshed now; the others are at most one interval old
+        self.publish()
+        workers = []
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError:
+            return None
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    workers.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        totals = {}
+        for worker in workers:
+            for key, value in worker.items():
+                if key not in ('pid', 'updated', 'uptime') and isinstance(value, (int, float)):
+                    totals[key] = totals.get(key, 0) + value
+        return {'count': len(workers), 'totals': totals, 'per_worker': workers}
+
+
+class Supervisor:
+    """Forks and babysits worker processes; run_worker() returns a worker's exit code"""
+    def __init__(self, worker_count, run_worker, drain_seconds=WORKER_DRAIN_SECONDS):
+        self.worker_count = worker_count
+        self.run_worker = run_worker
+        self.drain_seconds = drain_seconds
+        self.workers = {}  # pid -> (slot, started)
+        self.failures = [0] * worker_count
+        self.stopping = False
+        self.stats_dir = None
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            # Own process group, so the image pool's children can be cleaned up with the worker
+            os.setpgid(0, 0)
+            # Worker: default signal dispositions until the server installs its own
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 1
+            try:
+                code = self.run_worker() or 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 0
+            except BaseException:
+                logger.error(f"Worker {os.getpid()} failed", exc_info=True)
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self.workers[pid] = (slot, time.monotonic())
+        logger.info(f"Started worker {pid} (slot {slot})")
+
+    def stop(self, signum=None, frame=None):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info(f"Supervisor stopping: draining {len(self.workers)} workers")
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        timer = threading.Timer(self.drain_seconds + 5, self.kill_remaining)
+        timer.daemon = True
+        timer.start()
+
+    def kill_remaining(self):
+        for pid in list(self.workers):
+            logger.warning(f"Worker {pid} did not drain in time, killing it")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def reap(self, pid, status):
+        slot, started = self.workers.pop(pid)
+        # Orphaned pool processes would keep the dead worker's listening socket open
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        if self.stats_dir:
+            try:
+                os.remove(os.path.join(self.stats_dir, f'{pid}.json'))
+            except OSError:
+                pass
+        if self.stopping:
+            return
+        code = os.waitstatus_to_exitcode(status)
+        logger.warning(f"Worker {pid} (slot {slot}) exited with {code}; restarting")
+        if time.monotonic() - started < MIN_WORKER_LIFETIME:
+            self.failures[slot] += 1
+            delay = min(MAX_RESTART_DELAY, 0.5 * 2 ** self.failures[slot])
+            logger.warning(f"Worker slot {slot} is crash-looping, waiting {delay:.1f}s")
+            time.sleep(delay)
+        else:
+            self.failures[slot] = 0
+        if not self.stopping:
+            self.spawn(slot)
+
+    def run(self):
+        """Start the workers and supervise them until they have all exited; returns an exit code"""
+        self.stats_dir = tempfile.mkdtemp(prefix='inkflow-workers-')
+        # Inherited by every fork
+        worker_stats.directory = self.stats_dir
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(f"Pre-fork supervisor {os.getpid()} starting {self.worker_count} workers")
+        try:
+            for slot in range(self.worker_count):
+                self.spawn(slot)
+            while self.workers:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                if pid in self.workers:
+                    self.reap(pid, status)
+        finally:
+            shutil.rmtree(self.stats_dir, ignore_errors=True)
+        logger.info("All workers stopped")
+        return 0
+
+
+# Stats publisher for this process (inactive unless started by the supervisor)
+worker_stats = WorkerStats()
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
+import asyncio
+import html
+import http.client
 import http.server
+import email.utils
+import io
 import socketserver
-import urllib.request
+import ssl
 import urllib.parse
 import json
 import os
@@ -14,32 +19,61 @@ import threading
 import tempfile
 import weakref
 import gc
+import hashlib
 from urllib.error import URLError, HTTPError
-from contextlib import contextmanager
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
+from image_processing import image_preprocessor
+from multipart import (MULTIPART_CHUNK_SIZE, MultipartError, MultipartParser, PartRejected, UploadLimits,
+                       iter_multipart, parse_boundary)
+from upload_body import Base64DataURI, StreamingJSONBody
+from response_cache import response_cache
+from single_flight import request_coalescer
+from session_dispatch import SessionQueueFull, session_dispatcher
+from upstream import upstream_pool
+from hedging import fallback_forwarder
+from metrics import PROMETHEUS_CONTENT_TYPE, TimedReader, metrics, route_for
+from static_assets import static_assets
+from job_queue import CHAT_JOB_MAX_WAIT_SECONDS, CHAT_JOBS_ENABLED, DONE, FAILED, QueueFull, chat_jobs, wants_async
+from rate_limit import SESSION_HEADER, rate_limiter
+from traffic_capture import traffic_capture
+from log_pipeline import REQUEST_LOGGER, log_pipeline
+from health import HEALTH_PATH, LIVE_PATH, READY_PATH, health_monitor
+from deadline import REQUEST_DEADLINE_SECONDS, Deadline, DeadlineExceeded
+from admission import ADMISSION_MAX_ACTIVE, LANES, Overloaded, admission, lane_for
+from prefork import WORKER_DRAIN_SECONDS, WORKERS, Supervisor, prefork_supported, worker_stats
+
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('proxy_server.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# Configure logging: records are queued and written by a background thread (see log_pipeline.py).
+# Not when image pool workers import this module as __mp_main__: they keep default logging
+if __name__ == '__main__':
+    log_pipeline.configure()
 logger = logging.getLogger(__name__)
+# Per-request lines, which LOG_SAMPLE_RATES can thin out
+request_log = logging.getLogger(REQUEST_LOGGER)
 
 # Server configuration from environment variables with defaults
 MAX_FILE_SIZE = int(os.getenv('MAX_FILE_SIZE_MB', '10')) * 1024 * 1024
 MAX_FILES_PER_REQUEST = int(os.getenv('MAX_FILES_PER_REQUEST', '5'))
 MAX_CONCURRENT_CONNECTIONS = int(os.getenv('MAX_CONCURRENT_CONNECTIONS', '50'))
+# File count, size and sniffed type are enforced per part while an upload streams in
+UPLOAD_LIMITS = UploadLimits(MAX_FILES_PER_REQUEST, MAX_FILE_SIZE)
+# Pending connections the kernel holds before accept(); admission control queues the rest
+LISTEN_BACKLOG = int(os.getenv('LISTEN_BACKLOG', '1024'))
+# Handler threads of the threaded engine, idle keep-alive connections included (0 = admission capacity)
+MAX_CONNECTION_THREADS = int(os.getenv('MAX_CONNECTION_THREADS', '0'))
 REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT_SECONDS', '30'))
 MEMORY_CLEANUP_INTERVAL = 300  # 5 minutes
 
+# HTTP/1.1 keep-alive (threaded engine)
+KEEPALIVE_TIMEOUT = float(os.getenv('KEEPALIVE_TIMEOUT_SECONDS', '5'))
+KEEPALIVE_MAX_REQUESTS = int(os.getenv('KEEPALIVE_MAX_REQUESTS', '100'))
+# An unread request body up to this size is discarded so the connection survives an early error reply
+KEEPALIVE_DRAIN_LIMIT = 64 * 1024
+
 # n8n webhook configuration
 N8N_BASE_URL = os.getenv('N8N_WEBHOOK_BASE_URL', 'http://localhost:5678')
 WEBHOOK_PATH_PRIMARY = os.getenv('WEBHOOK_PATH_PRIMARY', '/webhook/tattoo-chat')
@@ -58,47 +92,531 @@ ALLOWED_ORIGINS = os.getenv('ALLOWED_ORIGINS', 'http://localhost:8000,http://127
 PORT = int(os.getenv('PORT', '8000'))
 HOST = os.getenv('HOST', '')
 
+# Serving engine: 'threaded' (one thread per connection) or 'asyncio' (single event loop)
+SERVER_ENGINE = os.getenv('SERVER_ENGINE', 'threaded').strip().lower()
+ASYNC_MAX_INFLIGHT = int(os.getenv('ASYNC_MAX_INFLIGHT', '4096'))
+
+# Chat endpoint that relays the n8n answer incrementally instead of buffering it
+CHAT_STREAM_PATH = '/api/chat/stream'
+# GET <prefix><job id> reports on a message queued with Prefer: respond-async
+CHAT_JOBS_PATH = '/api/chat/jobs/'
+
+# Several processes share the port when WORKERS > 1 (see prefork.py)
+PREFORK = WORKERS > 1 and prefork_supported()
+
 # Global connection tracking
 active_connections = weakref.WeakSet()
 connection_count_lock = threading.Lock()
+# Set on SIGTERM: in-flight requests finish, but no connection is kept alive
+server_draining = threading.Event()
+
+
+def cors_headers(origin):
+    """Build the CORS headers for a request Origin"""
+    # Check if origin is in allowed list
+    if origin in ALLOWED_ORIGINS or '*' in ALLOWED_ORIGINS:
+        allow_origin = origin if origin else '*'
+    else:
+        # Default to first allowed origin if no match
+        allow_origin = ALLOWED_ORIGINS[0] if ALLOWED_ORIGINS else '*'
+
+    return [
+        ('Access-Control-Allow-Origin', allow_origin),
+        ('Access-Control-Allow-Methods', 'GET, POST, OPTIONS'),
+        ('Access-Control-Allow-Headers', f'Content-Type, X-Requested-With, Cache-Control, Prefer, {SESSION_HEADER}'),
+        ('Access-Control-Allow-Credentials', 'true'),
+        ('Access-Control-Max-Age', '3600'),
+    ]
+
+
+def rate_limited_response(scope, retry_after):
+    """429 status, body and headers for a chat message over its rate limit"""
+    body = json.dumps({'error': 'Too many messages, please slow down', 'limit': scope}).encode('utf-8')
+    return 429, body, [('Retry-After', str(retry_after))]
+
+
+def merged_reply(batch_size):
+    """(status, body, headers) for a message whose text went to n8n in a later message's turn"""
+    return 200, b'{"status": "merged", "merged": true}', [('X-Session-Merged', str(batch_size))]
+
+
+def session_busy_reply():
+    """(status, body, headers) when too many messages of the session are already waiting"""
+    return 429, b'{"error": "Too many pending messages for this session"}', [('Retry-After', '2')]
+
+
+def collect_upload(parts):
+    """Split streamed multipart parts into chatInput, sessionId and uploaded files"""
+    chat_input = ''
+    session_id = 'default'
+    uploaded_files = []
+    try:
+        for part in parts:
+            if part.is_file:
+                # Browsers send an empty file part when no file was picked
+                if part.filename and part.size and len(uploaded_files) < MAX_FILES_PER_REQUEST:
+                    uploaded_files.append(part)
+                else:
+                    part.close()
+            elif part.name == 'chatInput':
+                chat_input = part.text().strip()[:1000]
+            elif part.name == 'sessionId':
+                session_id = part.text().strip()[:100]
+    except BaseException:
+        for part in uploaded_files:
+            part.close()
+        raise
+    return chat_input, session_id, uploaded_files
+
+
+def build_upload_payload(chat_input, session_id, uploaded_files, client_ip):
+    """Build the payload n8n receives for a multipart chat message (send as StreamingJSONBody)"""
+    # Create safe payload for n8n; image bytes are base64-encoded while the body is sent
+    file_info = [{
+        'filename': f.filename,
+        'size': f.size,
+        'content_type': f.content_type,
+        'dataUri': Base64DataURI(f.file, f.size, f.content_type, encoded=f.encoded)
+    } for f in uploaded_files]
+
+    return {
+        'chatInput': chat_input + (f" [עם {len(uploaded_files)} קבצים]" if uploaded_files else ""),
+        'sessionId': session_id,
+        'hasFiles': len(uploaded_files) > 0,
+        'fileCount': len(uploaded_files),
+        'files': file_info,
+        'timestamp': datetime.now().isoformat(),
+        'client_ip': client_ip
+    }
+
+
+def coalescing_key(payload_data, post_data):
+    """Key under which concurrent identical chat messages share one n8n call"""
+    # Stateless opener/FAQ messages match across sessions; anything else only
+    # when byte-identical (e.g. a client retry of the same turn)
+    stateless_key = response_cache.stateless_key(payload_data)
+    if stateless_key:
+        return 'stateless:' + stateless_key
+    return 'body:' + hashlib.sha256(post_data).hexdigest()
+
+
+def job_wait_seconds(query):
+    """Long-poll time requested with ?wait=<seconds>, capped at CHAT_JOB_MAX_WAIT_SECONDS"""
+    for pair in query.split('&'):
+        name, _, value = pair.partition('=')
+        if name == 'wait':
+            try:
+                return max(0.0, min(float(value), CHAT_JOB_MAX_WAIT_SECONDS))
+            except ValueError:
+                return 0.0
+    return 0.0
+
+
+def job_status_response(job_id, job):
+    """(status, body, headers) answering GET /api/chat/jobs/<id>"""
+    if job is None:
+        return 404, json.dumps({'jobId': job_id, 'error': 'Unknown or expired job'}).encode('utf-8'), []
+    if job['status'] == DONE:
+        # The n8n answer itself, exactly as /api/chat would have returned it
+        return 200, job['result'] or b'{"status": "success"}', [('X-Job-Status', DONE)]
+    if job['status'] == FAILED:
+        body = json.dumps({'jobId': job_id, 'status': FAILED, 'error': job['error']})
+        return 502, body.encode('utf-8'), [('X-Job-Status', FAILED)]
+    body = json.dumps({'jobId': job_id, 'status': job['status'], 'attempts': job['attempts']})
+    return 202, body.encode('utf-8'), [('X-Job-Status', job['status']), ('Retry-After', '1')]
+
+
+def job_accepted_response(job_id, prefer):
+    """(status, body, headers) for a chat message that was queued as a job"""
+    status_url = CHAT_JOBS_PATH + job_id
+    body = json.dumps({'jobId': job_id, 'status': 'queued', 'statusUrl': status_url}).encode('utf-8')
+    headers = [('Location', status_url)]
+    if 'respond-async' in (prefer or '').lower():
+        headers.append(('Preference-Applied', 'respond-async'))
+    return 202, body, headers
+
+
+def forward_to_n8n(body, content_type, label, deadline=None):
+    """Send a body to the n8n webhook URLs (with fallback/hedging); returns the response body or None
+
+    With a Deadline every attempt gets only the time left, and n8n is told how much that is.
+    """
+    def attempt(url, cancel_token):
+        headers = {
+            'Content-Type': content_type,
+            'User-Agent': 'InkFlow-Proxy/1.1'
+        }
+        timeout = REQUEST_TIMEOUT
+        if deadline is not None:
+            timeout = deadline.timeout(REQUEST_TIMEOUT)
+            headers = deadline.headers(headers)
+        # Send request to n8n over a pooled keep-alive connection
+        response = upstream_pool.post(
+            url,
+            body,
+            headers=headers,
+            timeout=timeout,
+            cancel_token=cancel_token
+        )
+        request_log.info("Successfully proxied %s to %s", label, url)
+        return response.body
+
+    # Streamed upload bodies can only be sent to one URL at a time
+    response_data, last_error = fallback_forwarder.call(
+        N8N_WEBHOOK_URLS, attempt, label,
+        hedge=isinstance(body, bytes),
+        max_delay=REQUEST_TIMEOUT if deadline is None else deadline.remaining(),
+        deadline=deadline
+    )
+    if last_error is None:
+        return response_data
+
+    # If we get here, all URLs failed
+    logger.error("All n8n URLs failed for %s. Last error: %s", label, last_error)
+    return None
+
+
+def upstream_failure(deadline):
+    """(status, message) for a chat message n8n did not answer: 504 once its deadline ran out, else 502"""
+    if deadline is not None and deadline.expired:
+        return 504, "Request deadline exceeded"
+    return 502, "Backend service unavailable"
+
+
+def build_health_data(connection_count):
+    """Collect the /api/health document; the health monitor rebuilds it on its own thread"""
+    monitor = health_monitor.snapshot()
+    health_data = {
+        'status': 'healthy' if monitor['ready'] else 'degraded',
+        'timestamp': time.time(),
+        'proxy_version': '2.0',
+        'uptime': health_monitor.uptime(),
+        'active_connections': connection_count,
+        'n8n_endpoints': monitor['n8n_endpoints'],
+        'upstream_pool': upstream_pool.stats(),
+        'image_preprocessing': image_preprocessor.stats(),
+        'response_cache': response_cache.stats(),
+        'coalescing': request_coalescer.stats(),
+        'session_dispatch': session_dispatcher.stats(),
+        'n8n_fallback': fallback_forwarder.stats(),
+        'static_assets': static_assets.stats(),
+        'chat_jobs': chat_jobs.stats(),
+        'admission': admission.stats(),
+        'rate_limits': rate_limiter.stats(),
+        'traffic_capture': traffic_capture.stats(),
+        'logging': log_pipeline.stats(),
+    }
+    workers = worker_stats.snapshot()
+    if workers:
+        health_data['workers'] = workers
+    system = monitor['system']
+    if not system:
+        health_data['message'] = 'Basic health check (psutil not available)'
+        return health_data
+
+    health_data.update({
+        'memory_usage': {
+            'rss': system['rss'],
+            'vms': system['vms'],
+            'percent': system['memory_percent']
+        },
+        'cpu_percent': system['cpu_percent'],
+        'sampled_at': system['sampled_at'],
+        'config': {
+            'max_file_size': MAX_FILE_SIZE,
+            'max_files_per_request': MAX_FILES_PER_REQUEST,
+            'max_concurrent_connections': MAX_CONCURRENT_CONNECTIONS,
+            'request_timeout': REQUEST_TIMEOUT,
+            'request_deadline': REQUEST_DEADLINE_SECONDS,
+            'server_engine': SERVER_ENGINE
+        }
+    })
+    return health_data
+
+
+def worker_summary(connection_count):
+    """This process's entry in the pre-fork 'workers' health view"""
+    summary = {
+        'engine': SERVER_ENGINE,
+        'uptime': health_monitor.uptime(),
+        'active_connections': connection_count,
+        'requests': sum(metrics.responses.snapshot().values()),
+        'queued_requests': admission.waiting_count(),
+    }
+    system = health_monitor.system
+    if system:
+        summary.update({
+            'rss': system['rss'],
+            'cpu_seconds': system['cpu_seconds'],
+            'threads': system['threads'],
+        })
+    return summary
+
+class RequestBody:
+    """Reads at most Content-Length bytes, so a kept-alive socket's next request is never consumed"""
+    def __init__(self, stream, length, sock=None, deadline=None):
+        self.stream = stream
+        self.remaining = length
+        self.sock = sock
+        self.deadline = deadline
+    
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b''
+        if self.deadline is None:
+            data = self.stream.read(size)
+        else:
+            data = self.read_within_deadline(size)
+        self.remaining -= len(data)
+        return data
+    
+    def read_within_deadline(self, size):
+        """read(size) with the socket timeout re-armed per recv(), so the whole body fits the deadline"""
+        pieces = []
+        while size > 0:
+            self.sock.settimeout(self.deadline.timeout())
+            piece = self.stream.read1(min(size, MULTIPART_CHUNK_SIZE))
+            if not piece:
+                break
+            pieces.append(piece)
+            size -= len(piece)
+        return b''.join(pieces)
+
 
 class ProxyHandler(http.server.SimpleHTTPRequestHandler):
+    # Persistent connections: one handler instance serves every request on a socket
+    protocol_version = 'HTTP/1.1'
+    
     def __init__(self, *args, **kwargs):
-        self.start_time = time.time()
-        self.temp_files = []
-        # Serve from parent directory's src folder
-        serve_dir = os.path.join(os.path.dirname(os.getcwd()), 'src')
-        super().__init__(*args, directory=serve_dir, **kwargs)
+        # Files come from the static asset cache; its root is resolved once at import
+        super().__init__(*args, directory=static_assets.root, **kwargs)
+    
+    def setup(self):
+        super().setup()
+        self.requests_handled = 0
         
-        # Track this connection
+        # Track this connection (once per socket, not per request)
         with connection_count_lock:
             active_connections.add(self)
             if len(active_connections) > MAX_CONCURRENT_CONNECTIONS:
-                logger.warning(f"High connection count: {len(active_connections)}")
+                logger.warning("High connection count: %d", len(active_connections))
+    
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            with connection_count_lock:
+                active_connections.discard(self)
+    
+    def handle_one_request(self):
+        """Wait (bounded by the idle timeout) for the next request on the socket and handle it"""
+        # Per-request state; everything else lives as long as the connection
+        self.temp_files = []
+        self.response_status = 0
+        self._headers_sent = False
+        self.request_body = None
+        self.deadline = None
+        self.headers = None
+        self.admitted = None
+        self.expect_continue = False
+        if self.requests_handled:
+            if server_draining.is_set():
+                self.close_connection = True
+                return
+            self.connection.settimeout(KEEPALIVE_TIMEOUT)
+            try:
+                if not self.rfile.peek(1):
+                    self.close_connection = True
+                    return
+            except OSError:
+                # Idle timeout or the client went away between requests
+                self.close_connection = True
+                return
+        self.connection.settimeout(REQUEST_TIMEOUT)
+        try:
+            super().handle_one_request()
+        finally:
+            if self.admitted:
+                admission.release(*self.admitted)
+        self.requests_handled += 1
+        self.finish_request_body()
+    
+    def parse_request(self):
+        """Parse the request head, then wait in the admission queue for a slot"""
+        if not super().parse_request():
+            return False
+        lane = lane_for(self.command, self.path)
+        try:
+            self.admitted = (lane, admission.acquire(lane))
+        except Overloaded as e:
+            logger.warning("Rejecting %s %s from %s: admission %s (%s lane)",
+                           self.command, self.path, self.client_address[0], e.reason, lane)
+            self.send_json(503, b'{"error": "Server busy, please retry"}', [('Retry-After', str(e.retry_after))])
+            metrics.observe_request(route_for(self.path), 503, 0.0)
+            return False
+        return True
+    
+    def handle_expect_100(self):
+        """Hold back 100 Continue until the chat checks pass; see send_continue()"""
+        self.expect_continue = True
+        return True
+    
+    def send_continue(self):
+        """Ask an Expect: 100-continue client for its body"""
+        if self.expect_continue:
+            self.expect_continue = False
+            self.send_response_only(100)
+            self.end_headers()
+    
+    def unread_body_length(self):
+        """Bytes of the current request body not read yet, or None if the framing is unknown"""
+        if self.expect_continue:
+            # The client may or may not send the body it was never asked for
+            return None
+        if self.request_body is not None:
+            return self.request_body.remaining
+        if self.headers is None or self.headers.get('Transfer-Encoding'):
+            return None
+        try:
+            return int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            return None
+    
+    def finish_request_body(self):
+        """Discard what the handler left of the request body, or give up on the connection"""
+        if self.close_connection:
+            return
+        unread = self.unread_body_length()
+        if unread is None or unread > KEEPALIVE_DRAIN_LIMIT:
+            self.close_connection = True
+            return
+        body = self.request_body or RequestBody(self.rfile, unread)
+        try:
+            while body.remaining:
+                if not body.read(min(MULTIPART_CHUNK_SIZE, body.remaining)):
+                    self.close_connection = True
+                    return
+        except OSError:
+            self.close_connection = True
     
     def do_GET(self):
+        started = time.perf_counter()
+        try:
+            self.route_get()
+        finally:
+            self.observe_request(started)
+    
+    def do_HEAD(self):
+        started = time.perf_counter()
+        try:
+            # Same routes as GET, so load balancers can HEAD the health endpoints
+            self.route_get(head_only=True)
+        finally:
+            self.observe_request(started)
+    
+    def route_get(self, head_only=False):
         # Handle health check endpoint
-        if self.path == '/api/health':
-            self.handle_health_check()
+        if self.path == HEALTH_PATH:
+            self.handle_health_check(head_only)
+        elif self.path in (LIVE_PATH, READY_PATH):
+            # Precomputed by the health monitor: no work per probe
+            self.send_json(*health_monitor.reply(self.path), headers=[('Cache-Control', 'no-store')],
+                           head_only=head_only)
+        elif self.path == '/api/metrics':
+            self.handle_metrics(head_only)
+        elif self.path.startswith(CHAT_JOBS_PATH):
+            self.handle_job_status(head_only)
         else:
-            # Serve static files
-            super().do_GET()
+            # Serve static files from the in-memory asset cache
+            self.serve_static(head_only)
     
     def do_POST(self):
-        # Handle chat proxy requests
-        if self.path.startswith('/api/chat'):
-            self.handle_chat_proxy()
-        else:
-            self.send_error(404, "Not Found")
+        started = time.perf_counter()
+        try:
+            # Handle chat proxy requests
+            if self.path.startswith('/api/chat'):
+                self.handle_chat_proxy()
+            else:
+                self.send_error(404, "Not Found")
+        finally:
+            self.observe_request(started)
     
     def do_OPTIONS(self):
+        started = time.perf_counter()
         # Handle preflight CORS requests
         self.send_response(200)
         self.add_cors_headers()
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.observe_request(started)
+    
+    def send_response(self, code, message=None):
+        # Remember the status for the request metrics
+        self.response_status = code
+        super().send_response(code, message)
+        unread = self.unread_body_length()
+        if (self.close_connection or unread is None or unread > KEEPALIVE_DRAIN_LIMIT
+                or self.requests_handled + 1 >= KEEPALIVE_MAX_REQUESTS or server_draining.is_set()):
+            # send_header() also sets close_connection
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Keep-Alive', f'timeout={int(KEEPALIVE_TIMEOUT)}, max={KEEPALIVE_MAX_REQUESTS}')
+            if self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+    
+    def send_error(self, code, message=None, explain=None):
+        """Error page like BaseHTTPRequestHandler.send_error, minus its unconditional Connection: close"""
+        try:
+            shortmsg, longmsg = self.responses[code]
+        except KeyError:
+            shortmsg, longmsg = '???', '???'
+        if message is None:
+            message = shortmsg
+        if explain is None:
+            explain = longmsg
+        self.log_error("code %d, message %s", code, message)
+        # send_response() decides whether the connection can stay open
+        self.send_response(code, message)
+        
+        body = None
+        if code >= 200 and code not in (204, 205, 304):
+            body = (self.error_message_format % {
+                'code': code,
+                'message': html.escape(message, quote=False),
+                'explain': html.escape(explain, quote=False),
+            }).encode('UTF-8', 'replace')
+            self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Content-Length', str(len(body) if body else 0))
         self.end_headers()
+        if self.command != 'HEAD' and body:
+            self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        """Access log through the logging pipeline instead of a blocking stderr write"""
+        request_log.info("%s - " + format, self.client_address[0], *args)
+    
+    def log_error(self, format, *args):
+        request_log.warning("%s - " + format, self.client_address[0], *args)
+    
+    def observe_request(self, started):
+        """Record total duration and status for the request just handled"""
+        metrics.observe_request(route_for(self.path), getattr(self, 'response_status', 0),
+                                time.perf_counter() - started)
     
     def handle_chat_proxy(self):
         request_start = time.time()
+        # POST /api/chat/stream relays the n8n answer as it is generated
+        path, _, query = self.path.partition('?')
+        self.streaming = path == CHAT_STREAM_PATH
+        # Prefer: respond-async queues the message and answers 202 with a job id
+        self.async_job = (CHAT_JOBS_ENABLED and chat_jobs.running and not self.streaming
+                          and wants_async(self.headers.get('Prefer'), query))
+        self.chat_started = time.perf_counter()
+        # One time budget for the body read, every n8n attempt and the response write
+        self.deadline = Deadline()
+        self.capture = None
         try:
             # Log request details for debugging
             client_ip = self.client_address[0]
@@ -106,13 +624,35 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
             content_type = self.headers.get('Content-Type', '')
             content_length = int(self.headers.get('Content-Length', 0))
             
-            logger.info(f"Chat request from {client_ip} - {user_agent[:50]} - {content_type} - {content_length} bytes")
+            request_log.info("Chat request from %s - %s - %s - %d bytes",
+                             client_ip, user_agent[:50], content_type, content_length)
+            # Shape and timing only, when TRAFFIC_CAPTURE is on
+            self.capture = traffic_capture.begin(self.path, content_type, content_length,
+                                                 self.headers.get(SESSION_HEADER), self.async_job)
+            
+            # Rate limits before reading the body, so floods never cost a full upload
+            self.session_checked = bool(self.headers.get(SESSION_HEADER))
+            if self.rate_limited(client_ip, self.headers.get(SESSION_HEADER)):
+                return
+            
+            # Chunked uploads are not supported; without Content-Length the body cannot be framed
+            if self.headers.get('Transfer-Encoding'):
+                self.send_error(411, "Length Required")
+                return
             
             # Validate request size
             if content_length > MAX_FILE_SIZE * MAX_FILES_PER_REQUEST:
-                logger.warning(f"Request too large: {content_length} bytes from {client_ip}")
+                logger.warning("Request too large: %d bytes from %s", content_length, client_ip)
                 self.send_error(413, "Request too large")
                 return
+            if not content_type.startswith('multipart/form-data') and content_length > MAX_FILE_SIZE:
+                logger.warning("JSON payload too large: %d bytes", content_length)
+                self.send_error(413, "Payload too large")
+                return
+            
+            # Everything that can be decided from the headers passed: now let the body come
+            self.send_continue()
+            self.request_body = RequestBody(self.rfile, content_length, self.connection, self.deadline)
             
             if content_type.startswith('multipart/form-data'):
                 # Handle file upload with resource management
@@ -122,26 +662,33 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
                 self.handle_json_request_safe()
                 
         except Exception as e:
-            logger.error(f"Proxy error from {self.client_address[0]}: {e}", exc_info=True)
+            logger.error("Proxy error from %s: %s", self.client_address[0], e, exc_info=True)
+            # A response may be half written: do not reuse the connection
+            self.close_connection = True
             try:
                 self.send_error(500, "Internal Server Error")
             except:
                 logger.error("Failed to send error response", exc_info=True)
         finally:
+            traffic_capture.finish(self.capture, self.response_status)
             # Clean up any temporary files
             self.cleanup_temp_files()
             request_duration = time.time() - request_start
-            logger.info(f"Request completed in {request_duration:.2f}s")
+            request_log.info("Request completed in %.2fs", request_duration)
     
-    @contextmanager
-    def timeout_context(self, timeout_seconds=REQUEST_TIMEOUT):
-        """Context manager for request timeout handling"""
-        old_timeout = socket.getdefaulttimeout()
-        try:
-            socket.setdefaulttimeout(timeout_seconds)
-            yield
-        finally:
-            socket.setdefaulttimeout(old_timeout)
+    def rate_limited(self, client_ip=None, session_id=None, ip_taken=None):
+        """Answer 429 and return True if the message is over a rate limit"""
+        limited = rate_limiter.check(client_ip, session_id, ip_taken)
+        if limited is None:
+            return False
+        logger.warning("Rate limited chat message from %s (%s limit)", self.client_address[0], limited[0])
+        self.send_json(*rate_limited_response(*limited))
+        return True
+    
+    def session_rate_limited(self, session_id):
+        """Session limit for clients that did not send the session header"""
+        return not self.session_checked and self.rate_limited(session_id=session_id,
+                                                              ip_taken=self.client_address[0])
     
     def cleanup_temp_files(self):
         """Clean up any temporary files created during request processing"""
@@ -149,22 +696,22 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
             try:
                 if os.path.exists(temp_file):
                     os.remove(temp_file)
-                    logger.debug(f"Cleaned up temporary file: {temp_file}")
+                    logger.debug("Cleaned up temporary file: %s", temp_file)
             except Exception as e:
-                logger.warning(f"Failed to clean up temp file {temp_file}: {e}")
+                logger.warning("Failed to clean up temp file %s: %s", temp_file, e)
         self.temp_files.clear()
     
     def handle_json_request_safe(self):
         """Handle JSON requests with proper resource management"""
-        data = None
         try:
-            with self.timeout_context():
-                self.handle_json_request_impl()
+            self.handle_json_request_impl()
         except socket.timeout:
             logger.error("JSON request timeout")
+            # The rest of the body may still be in flight: close after answering
+            self.close_connection = True
             self.send_error(408, "Request timeout")
         except Exception as e:
-            logger.error(f"JSON request error: {e}", exc_info=True)
+            logger.error("JSON request error: %s", e, exc_info=True)
             raise
     
     def handle_json_request_impl(self):
@@ -173,78 +720,96 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
             # Read the request body with size validation
             content_length = int(self.headers.get('Content-Length', 0))
             if content_length > MAX_FILE_SIZE:
-                logger.warning(f"JSON payload too large: {content_length} bytes")
+                logger.warning("JSON payload too large: %d bytes", content_length)
                 self.send_error(413, "Payload too large")
                 return
                 
-            post_data = self.rfile.read(content_length)
+            phase_start = time.perf_counter()
+            post_data = self.request_body.read(content_length)
+            metrics.observe_phase('chat', 'read', time.perf_counter() - phase_start)
             
             # Validate and log payload
             try:
+                phase_start = time.perf_counter()
                 payload_data = json.loads(post_data.decode('utf-8'))
-                logger.debug(f"JSON Payload keys: {list(payload_data.keys()) if isinstance(payload_data, dict) else 'non-dict'}")
+                metrics.observe_phase('chat', 'parse', time.perf_counter() - phase_start)
+                if request_log.isEnabledFor(logging.DEBUG):
+                    request_log.debug("JSON Payload keys: %s",
+                                      list(payload_data.keys()) if isinstance(payload_data, dict) else 'non-dict')
+                traffic_capture.note_message(self.capture, payload_data)
                 # Don't log full payload to avoid sensitive data in logs
             except json.JSONDecodeError as e:
-                logger.error(f"Invalid JSON payload: {e}")
+                logger.error("Invalid JSON payload: %s", e)
                 self.send_error(400, "Invalid JSON")
                 return
             except UnicodeDecodeError as e:
-                logger.error(f"Invalid UTF-8 in payload: {e}")
+                logger.error("Invalid UTF-8 in payload: %s", e)
                 self.send_error(400, "Invalid encoding")
                 return
             
-            # Use configured n8n webhook URLs with fallback
-            n8n_urls = N8N_WEBHOOK_URLS
+            session_id = payload_data.get('sessionId') if isinstance(payload_data, dict) else None
+            if session_id is not None and self.session_rate_limited(session_id):
+                return
             
-            last_error = None
+            # Answer stateless FAQ-style questions from the response cache
+            cache_key = response_cache.key_for(payload_data)
+            if cache_key:
+                cached_response = response_cache.get(cache_key)
+                if cached_response is not None:
+                    self.send_chat_response(cached_response, headers=[('X-Cache', 'HIT')])
+                    request_log.info("Answered JSON request from response cache")
+                    return
             
-            for url_index, url in enumerate(n8n_urls):
-                try:
-                    logger.info(f"Proxying JSON to: {url} (attempt {url_index + 1}/{len(n8n_urls)})")
-                    
-                    # Create request to n8n with timeout
-                    req = urllib.request.Request(
-                        url,
-                        data=post_data,
-                        headers={
-                            'Content-Type': 'application/json',
-                            'User-Agent': 'InkFlow-Proxy/1.1'
-                        }
-                    )
-                    
-                    # Send request to n8n with proper timeout
-                    with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-                        response_data = response.read()
-                        
-                        # Handle empty successful response from n8n
-                        if not response_data:
-                            logger.info(f"Empty but successful response from {url}")
-                            response_data = b'{"status": "success"}'
-                        
-                        # Send successful response back to client
-                        self.send_response(200)
-                        self.send_header('Content-Type', 'application/json')
-                        self.add_cors_headers()
-                        self.end_headers()
-                        self.wfile.write(response_data)
-                        
-                        logger.info(f"Successfully proxied JSON to {url}")
-                        return
-                        
-                except (URLError, HTTPError, ValueError) as e:
-                    logger.warning(f"Failed to connect to {url}: {e}")
-                    last_error = e
-                    # Add small delay between attempts
-                    if url_index < len(n8n_urls) - 1:
-                        time.sleep(0.5)
-                    continue
-            
-            # If we get here, all URLs failed
-            logger.error(f"All n8n URLs failed. Last error: {last_error}")
-            self.send_error(502, "Backend service unavailable")
+            if self.async_job:
+                self.submit_chat_job(post_data, 'application/json', session_id)
+                return
+            
+            if self.streaming:
+                # Streamed answers are neither coalesced nor cached, but wait for the session's turn
+                relayed, _answered, _batch_size = session_dispatcher.run(
+                    session_id, lambda _merged: self.stream_from_n8n(post_data, 'application/json', 'JSON'))
+                if relayed:
+                    response_cache.note_forwarded(session_id)
+                return
             
+            def send(merged):
+                if merged is not None:
+                    # A merged turn is this session's alone, so it is never shared
+                    body = json.dumps(merged, ensure_ascii=False).encode('utf-8')
+                    return forward_to_n8n(body, 'application/json', 'JSON', self.deadline), False
+                # Identical concurrent messages share one n8n call
+                return request_coalescer.run(
+                    coalescing_key(payload_data, post_data),
+                    lambda: forward_to_n8n(post_data, 'application/json', 'JSON', self.deadline)
+                )
+            
+            # A session's calls go one at a time; only the upstream call itself is coalesced
+            phase_start = time.perf_counter()
+            (response_data, shared), answered, batch_size = session_dispatcher.run(session_id, send, payload_data)
+            metrics.observe_phase('chat', 'upstream', time.perf_counter() - phase_start)
+            if response_data is None:
+                self.send_error(*upstream_failure(self.deadline))
+                return
+            if shared:
+                request_log.info("JSON request answered by a coalesced n8n call")
+            else:
+                response_cache.note_forwarded(session_id)
+                if cache_key and batch_size == 1:
+                    response_cache.put(cache_key, response_data)
+            if not answered:
+                request_log.info("JSON request merged into a %d-message n8n turn", batch_size)
+                self.send_json(*merged_reply(batch_size))
+                return
+            self.send_chat_response(response_data)
+            
+        except SessionQueueFull as e:
+            logger.warning("Rejecting chat request from %s: %s", self.client_address[0], e)
+            self.send_json(*session_busy_reply())
+        except socket.timeout:
+            # Answered with 408 by the caller
+            raise
         except Exception as e:
-            logger.error(f"JSON request processing error: {e}", exc_info=True)
+            logger.error("JSON request processing error: %s", e, exc_info=True)
             if not hasattr(self, '_headers_sent') or not self._headers_sent:
                 try:
                     self.send_error(500, "Internal server error")
@@ -255,77 +820,54 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
     def handle_file_upload_safe(self):
         """Handle file uploads with proper resource management and limits"""
         try:
-            with self.timeout_context():
-                self.handle_file_upload_impl()
+            self.handle_file_upload_impl()
         except socket.timeout:
             logger.error("File upload timeout")
+            # The rest of the body may still be in flight: close after answering
+            self.close_connection = True
             self.send_error(408, "Upload timeout")
         except Exception as e:
-            logger.error(f"File upload error: {e}", exc_info=True)
+            logger.error("File upload error: %s", e, exc_info=True)
             raise
     
     def handle_file_upload_impl(self):
-        import email.parser
-        import io
-        
-        temp_files = []
-        form = None
+        uploaded_files = []
         try:
-            logger.info("Processing file upload request...")
+            request_log.info("Processing file upload request...")
             
             # Validate content length
             content_length = int(self.headers.get('Content-Length', 0))
             if content_length > MAX_FILE_SIZE * MAX_FILES_PER_REQUEST:
-                logger.warning(f"Upload too large: {content_length} bytes")
+                logger.warning("Upload too large: %d bytes", content_length)
                 self.send_error(413, "Upload too large")
                 return
             
-            # Read the raw multipart data
-            raw_data = self.rfile.read(content_length)
-            
-            # Simple multipart parsing - for now, just extract text fields
-            # This is a simplified approach that works for basic FormData
-            data_str = raw_data.decode('utf-8', errors='ignore')
-            
-            # Extract basic form fields using simple string parsing
-            chat_input = ''
-            session_id = 'default'
-            
-            # Parse chatInput field
-            if 'name="chatInput"' in data_str:
-                start = data_str.find('name="chatInput"')
-                if start != -1:
-                    start = data_str.find('\r\n\r\n', start) + 4
-                    end = data_str.find('\r\n--', start)
-                    if end != -1:
-                        chat_input = data_str[start:end].strip()[:1000]
-            
-            # Parse sessionId field
-            if 'name="sessionId"' in data_str:
-                start = data_str.find('name="sessionId"')
-                if start != -1:
-                    start = data_str.find('\r\n\r\n', start) + 4
-                    end = data_str.find('\r\n--', start)
-                    if end != -1:
-                        session_id = data_str[start:end].strip()[:100]
-            
-            # For now, we'll inform about file uploads but not process the actual files
-            # This is a simplified approach until we implement proper multipart parsing
-            has_files = 'filename=' in data_str
-            file_count = data_str.count('filename=')
-            
-            uploaded_files = []
-            if has_files:
-                logger.info(f"File upload detected: {file_count} files (simplified processing)")
-                # Create placeholder file info
-                for i in range(min(file_count, MAX_FILES_PER_REQUEST)):
-                    uploaded_files.append({
-                        'filename': f'uploaded_image_{i+1}.jpg',
-                        'size': 0,
-                        'content_type': 'image/jpeg'
-                    })
-            
-            logger.info(f"Received message with {len(uploaded_files)} files from {self.client_address[0]}")
+            # Stream the multipart body in chunks; files are spooled, never held whole
+            try:
+                phase_start = time.perf_counter()
+                boundary = parse_boundary(self.headers.get('Content-Type', ''))
+                body_stream = TimedReader(self.request_body)
+                chat_input, session_id, uploaded_files = collect_upload(traffic_capture.watch_parts(
+                    self.capture, iter_multipart(body_stream, boundary, content_length, limits=UPLOAD_LIMITS)
+                ))
+                # Reading and parsing interleave; split them by the time spent blocked in read()
+                metrics.observe_phase('chat', 'read', body_stream.seconds)
+                metrics.observe_phase('chat', 'parse', time.perf_counter() - phase_start - body_stream.seconds)
+            except PartRejected as e:
+                # The rest of the body is never read; the connection closes after the answer
+                logger.warning("Rejected upload from %s: %s", self.client_address[0], e)
+                self.send_error(e.status, explain=str(e))
+                return
+            except MultipartError as e:
+                logger.warning("Malformed multipart body from %s: %s", self.client_address[0], e)
+                self.send_error(400, "Malformed multipart body")
+                return
+            
+            request_log.info("Received message with %d files from %s", len(uploaded_files), self.client_address[0])
+            traffic_capture.note_upload(self.capture, chat_input, session_id, uploaded_files)
+            
+            if self.session_rate_limited(session_id):
+                return
             
             # Validate we have some content
             if not chat_input.strip() and len(uploaded_files) == 0:
@@ -333,76 +875,48 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(400, "Empty request")
                 return
             
-            # Create safe payload for n8n
-            file_info = [{
-                'filename': f['filename'],
-                'size': f['size'],
-                'content_type': f['content_type']
-            } for f in uploaded_files]
-            
-            payload = {
-                'chatInput': chat_input + (f" [עם {len(uploaded_files)} קבצים]" if uploaded_files else ""),
-                'sessionId': session_id,
-                'hasFiles': len(uploaded_files) > 0,
-                'fileCount': len(uploaded_files),
-                'files': file_info,
-                'timestamp': datetime.now().isoformat(),
-                'client_ip': self.client_address[0]
-            }
+            # Downscale and recompress photos in the process pool before forwarding
+            if uploaded_files:
+                phase_start = time.perf_counter()
+                bytes_before, bytes_after = image_preprocessor.process(uploaded_files,
+                                                                     timeout=self.deadline.remaining())
+                metrics.observe_phase('chat', 'preprocess', time.perf_counter() - phase_start)
+                request_log.info("Image preprocessing: %d -> %d bytes", bytes_before, bytes_after)
             
-            # Send to n8n with fallback URLs
-            n8n_urls = N8N_WEBHOOK_URLS
+            payload = build_upload_payload(chat_input, session_id, uploaded_files, self.client_address[0])
+            payload_body = StreamingJSONBody(payload, ensure_ascii=False)
+            request_log.info("Upload payload: %d bytes (%d images)", payload_body.length, len(uploaded_files))
             
-            last_error = None
+            if self.async_job:
+                # The queue stores the finished body, images encoded
+                self.submit_chat_job(b''.join(payload_body), 'application/json; charset=utf-8', session_id)
+                return
             
-            for url_index, url in enumerate(n8n_urls):
-                try:
-                    logger.info(f"Proxying file upload to: {url} (attempt {url_index + 1}/{len(n8n_urls)})")
-                    
-                    # Send JSON payload to n8n
-                    payload_json = json.dumps(payload, ensure_ascii=False).encode('utf-8')
-                    req = urllib.request.Request(
-                        url,
-                        data=payload_json,
-                        headers={
-                            'Content-Type': 'application/json; charset=utf-8',
-                            'User-Agent': 'InkFlow-Proxy/1.1',
-                            'Content-Length': str(len(payload_json))
-                        }
-                    )
-                    
-                    # Send request to n8n with timeout
-                    with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-                        response_data = response.read()
-                        
-                        # Handle empty successful response from n8n
-                        if not response_data:
-                            logger.info(f"Empty but successful response from {url}")
-                            response_data = b'{"status": "success"}'
-                        
-                        # Send successful response back to client
-                        self.send_response(200)
-                        self.send_header('Content-Type', 'application/json')
-                        self.add_cors_headers()
-                        self.end_headers()
-                        self.wfile.write(response_data)
-                        
-                        logger.info(f"Successfully proxied file upload to {url}")
-                        return
-                        
-                except (URLError, HTTPError, ValueError) as e:
-                    logger.warning(f"Failed to connect to {url}: {e}")
-                    last_error = e
-                    if url_index < len(n8n_urls) - 1:
-                        time.sleep(0.5)
-                    continue
-            
-            # If we get here, all URLs failed
-            logger.error(f"All n8n URLs failed for file upload. Last error: {last_error}")
-            self.send_error(502, "Backend service unavailable")
+            # Send JSON payload to n8n, streaming the base64 image data, in the session's turn
+            if self.streaming:
+                relayed, _answered, _batch_size = session_dispatcher.run(session_id, lambda _merged: self.stream_from_n8n(
+                    payload_body, 'application/json; charset=utf-8', 'file upload'))
+                if relayed:
+                    response_cache.note_forwarded(session_id)
+                return
+            phase_start = time.perf_counter()
+            response_data, _answered, _batch_size = session_dispatcher.run(session_id, lambda _merged: forward_to_n8n(
+                payload_body, 'application/json; charset=utf-8', 'file upload', self.deadline))
+            metrics.observe_phase('chat', 'upstream', time.perf_counter() - phase_start)
+            if response_data is None:
+                self.send_error(*upstream_failure(self.deadline))
+                return
+            response_cache.note_forwarded(session_id)
+            self.send_chat_response(response_data)
             
+        except SessionQueueFull as e:
+            logger.warning("Rejecting upload from %s: %s", self.client_address[0], e)
+            self.send_json(*session_busy_reply())
+        except socket.timeout:
+            # Answered with 408 by the caller
+            raise
         except Exception as e:
-            logger.error(f"File upload processing error: {e}", exc_info=True)
+            logger.error("File upload processing error: %s", e, exc_info=True)
             if not hasattr(self, '_headers_sent') or not self._headers_sent:
                 try:
                     self.send_error(500, "Upload processing error")
@@ -410,72 +924,191 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
                     pass
             raise
         finally:
-            # Clean up form object
-            if form:
-                try:
-                    # Clean up any temporary files created by cgi.FieldStorage
-                    for key in form.keys():
-                        field = form[key]
-                        if hasattr(field, 'file') and hasattr(field.file, 'close'):
-                            try:
-                                field.file.close()
-                            except:
-                                pass
-                except:
-                    pass
+            # Release spooled upload files
+            for part in uploaded_files:
+                part.close()
     
-    def handle_health_check(self):
-        """Enhanced health check endpoint with system metrics"""
+    def submit_chat_job(self, body, content_type, session_id):
+        """Queue a chat message for the job workers and answer 202 with where to poll"""
         try:
-            # Get system metrics
-            import psutil
-            process = psutil.Process()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.add_cors_headers()
+            job_id = chat_jobs.submit(body, content_type, session_id)
+        except QueueFull as e:
+            logger.warning("Rejecting async chat request from %s: %s", self.client_address[0], e)
+            self.send_json(503, b'{"error": "Job queue full"}', [('Retry-After', '5')])
+            return
+        # The job's turn will reach n8n's memory for this session
+        response_cache.note_forwarded(session_id)
+        self.send_json(*job_accepted_response(job_id, self.headers.get('Prefer')))
+    
+    def handle_job_status(self, head_only=False):
+        """GET /api/chat/jobs/<id>[?wait=seconds]: a chat job's state, or n8n's answer once it is done"""
+        job_id, _, query = self.path[len(CHAT_JOBS_PATH):].partition('?')
+        if not chat_jobs.running:
+            self.send_error(404, "Not Found")
+            return
+        wait = job_wait_seconds(query)
+        job = chat_jobs.wait(job_id, wait) if wait else chat_jobs.get(job_id)
+        status, body, headers = job_status_response(job_id, job)
+        self.send_json(status, body, headers, head_only=head_only)
+    
+    def send_json(self, status, body, headers=(), head_only=False):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.add_cors_headers()
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+    
+    def stream_from_n8n(self, body, content_type, label):
+        """Relay an n8n answer to the client as its bytes arrive; returns True once it was relayed"""
+        def attempt(url, cancel_token):
+            stream = upstream_pool.stream(
+                url,
+                body,
+                headers=self.deadline.headers({
+                    'Content-Type': content_type,
+                    'User-Agent': 'InkFlow-Proxy/1.1'
+                }),
+                timeout=self.deadline.timeout(REQUEST_TIMEOUT),
+                cancel_token=cancel_token
+            )
+            request_log.info("Streaming %s from %s", label, url)
+            return stream
+        
+        # Fallback applies until the response head arrives; after that the bytes are the client's
+        phase_start = time.perf_counter()
+        stream, last_error = fallback_forwarder.call(N8N_WEBHOOK_URLS, attempt, label, hedge=False,
+                                                     deadline=self.deadline)
+        metrics.observe_phase('chat', 'upstream', time.perf_counter() - phase_start)
+        if last_error is not None:
+            logger.error("All n8n URLs failed for %s. Last error: %s", label, last_error)
+            self.send_error(*upstream_failure(self.deadline))
+            return False
+        
+        # The deadline ends with the response head: the answer may keep streaming, one idle timeout per read
+        stream.settimeout(REQUEST_TIMEOUT)
+        self.connection.settimeout(REQUEST_TIMEOUT)
+        write_start = time.perf_counter()
+        chunked = self.request_version != 'HTTP/1.0'
+        if not chunked:
+            # No chunked framing for HTTP/1.0: the body ends when the connection does
+            self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', stream.headers.get('Content-Type') or 'application/json')
+        self.send_header('Cache-Control', 'no-cache')
+        # Keep buffering reverse proxies (nginx) from holding the tokens back
+        self.send_header('X-Accel-Buffering', 'no')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.add_cors_headers()
+        self.end_headers()
+        
+        relayed = 0
+        try:
+            for chunk in stream.iter_chunks():
+                if not relayed:
+                    metrics.observe_first_token(time.perf_counter() - self.chat_started)
+                self.write_body_chunk(chunk, chunked)
+                relayed += len(chunk)
+            if not relayed:
+                request_log.info("Empty but successful response from n8n")
+                self.write_body_chunk(b'{"status": "success"}', chunked)
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except URLError as e:
+            # Too late for an error status: drop the connection so the client sees a truncated body
+            logger.error("n8n stream for %s failed after %d bytes: %s", label, relayed, e)
+            self.close_connection = True
+            return False
+        except OSError as e:
+            logger.warning("Client went away during streamed %s response: %s", label, e)
+            self.close_connection = True
+            return False
+        finally:
+            stream.close()
+            metrics.observe_phase('chat', 'write', time.perf_counter() - write_start)
+        request_log.info("Streamed %d bytes of %s response", relayed, label)
+        return True
+    
+    def write_body_chunk(self, data, chunked):
+        if chunked:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+    
+    def send_chat_response(self, response_data, headers=()):
+        """Send an n8n answer back to the client"""
+        # Handle empty successful response from n8n
+        if not response_data:
+            request_log.info("Empty but successful response from n8n")
+            response_data = b'{"status": "success"}'
+        
+        write_start = time.perf_counter()
+        if self.deadline is not None:
+            self.connection.settimeout(self.deadline.write_timeout())
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.add_cors_headers()
+        self.end_headers()
+        self.wfile.write(response_data)
+        metrics.observe_phase('chat', 'write', time.perf_counter() - write_start)
+    
+    def serve_static(self, head_only=False):
+        """Serve a landing page file with its cached compressed variant and validators"""
+        asset, redirect = static_assets.resolve(self.path)
+        if redirect:
+            self.send_response(301)
+            self.send_header('Location', redirect)
+            self.send_header('Content-Length', '0')
             self.end_headers()
-            
-            health_data = {
-                'status': 'healthy',
-                'timestamp': time.time(),
-                'proxy_version': '2.0',
-                'uptime': time.time() - self.start_time,
-                'active_connections': len(active_connections),
-                'memory_usage': {
-                    'rss': process.memory_info().rss,
-                    'vms': process.memory_info().vms,
-                    'percent': process.memory_percent()
-                },
-                'cpu_percent': process.cpu_percent(),
-                'n8n_endpoints': [
-                    'http://localhost:5678/webhook/tattoo-chat',
-                    'http://localhost:5678/webhook-test/tattoo-chat'
-                ],
-                'config': {
-                    'max_file_size': MAX_FILE_SIZE,
-                    'max_files_per_request': MAX_FILES_PER_REQUEST,
-                    'max_concurrent_connections': MAX_CONCURRENT_CONNECTIONS,
-                    'request_timeout': REQUEST_TIMEOUT
-                }
-            }
-            
-            self.wfile.write(json.dumps(health_data, indent=2).encode('utf-8'))
-            logger.info(f"Health check requested from {self.client_address[0]}")
-            
-        except ImportError:
-            # Fallback if psutil not available
-            health_data = {
-                'status': 'healthy',
-                'timestamp': time.time(),
-                'proxy_version': '2.0',
-                'active_connections': len(active_connections),
-                'message': 'Basic health check (psutil not available)'
-            }
-            self.wfile.write(json.dumps(health_data).encode('utf-8'))
+            return
+        if asset is None:
+            self.send_error(404, "File not found")
+            return
+        
+        status, headers, body, source = static_assets.respond(asset, self.headers, self.path)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if status == 304:
+            self.end_headers()
+            return
+        self.send_header('Content-Length', str(source.size if body is None else len(body)))
+        self.end_headers()
+        if head_only:
+            return
+        if body is not None:
+            self.wfile.write(body)
+            return
+        # Too large to keep in memory: let the kernel copy it straight from disk
+        with open(source.path, 'rb') as f:
+            self.connection.sendfile(f, count=source.size)
+    
+    def handle_metrics(self, head_only=False):
+        """Latency histograms in Prometheus text format"""
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+    
+    def handle_health_check(self, head_only=False):
+        """Enhanced health check endpoint with system metrics"""
+        try:
+            # Rebuilt by the health monitor's thread after each sample
+            self.send_json(*health_monitor.reply(HEALTH_PATH), head_only=head_only)
+            request_log.info("Health check requested from %s", self.client_address[0])
             
         except Exception as e:
-            logger.error(f"Health check error: {e}", exc_info=True)
+            logger.error("Health check error: %s", e, exc_info=True)
             try:
                 self.send_error(500, "Health check failed")
             except:
@@ -483,19 +1116,8 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
     
     def add_cors_headers(self):
         """Add CORS headers consistently"""
-        origin = self.headers.get('Origin', '')
-
-        # Check if origin is in allowed list
-        if origin in ALLOWED_ORIGINS or '*' in ALLOWED_ORIGINS:
-            self.send_header('Access-Control-Allow-Origin', origin if origin else '*')
-        else:
-            # Default to first allowed origin if no match
-            self.send_header('Access-Control-Allow-Origin', ALLOWED_ORIGINS[0] if ALLOWED_ORIGINS else '*')
-
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Requested-With, Cache-Control')
-        self.send_header('Access-Control-Allow-Credentials', 'true')
-        self.send_header('Access-Control-Max-Age', '3600')
+        for name, value in cors_headers(self.headers.get('Origin', '')):
+            self.send_header(name, value)
     
     def end_headers(self):
         # Mark that headers have been sent
@@ -517,6 +1139,11 @@ class MemoryCleanupThread(threading.Thread):
                     # Force garbage collection
                     gc.collect()
                     
+                    # Drop keep-alive connections to n8n that went idle
+                    evicted = upstream_pool.evict_idle()
+                    if evicted:
+                        logger.debug(f"Evicted {evicted} idle upstream connections")
+                    
                     # Log memory stats
                     try:
                         import psutil
@@ -536,91 +1163,844 @@ class MemoryCleanupThread(threading.Thread):
     def stop(self):
         self.running = False
 
-if __name__ == "__main__":
-    logger.info(f"Starting InkFlow Proxy Server v2.0")
-    logger.info(f"Configuration: Max file size={MAX_FILE_SIZE//1024//1024}MB, Max files={MAX_FILES_PER_REQUEST}, Max connections={MAX_CONCURRENT_CONNECTIONS}")
-    logger.info(f"n8n Backend: {N8N_BASE_URL}")
-    logger.info(f"Webhook URLs: {N8N_WEBHOOK_URLS}")
-    logger.info(f"Allowed Origins: {ALLOWED_ORIGINS}")
-    logger.info(f"Landing page: http://{HOST if HOST else 'localhost'}:{PORT}")
-    logger.info(f"Chat API: http://{HOST if HOST else 'localhost'}:{PORT}/api/chat")
-    logger.info(f"Health check: http://{HOST if HOST else 'localhost'}:{PORT}/api/health")
+class UpstreamHTTPError(Exception):
+    """Non-2xx answer from an n8n webhook (async engine counterpart of HTTPError)"""
+    def __init__(self, url, status, reason):
+        super().__init__(f"HTTP Error {status}: {reason}")
+        self.url = url
+        self.status = status
+        self.reason = reason
+
+
+async def read_http_head(reader):
+    """Read a status/request line plus headers from an asyncio stream"""
+    first_line = await reader.readline()
+    if not first_line:
+        return None, None
+    header_lines = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(b''.join(header_lines), None)
+        if line in (b'\r\n', b'\n'):
+            break
+        header_lines.append(line)
+        if len(header_lines) > 100:
+            raise ValueError("Too many headers")
+    headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines) + b'\r\n'))
+    return first_line.decode('latin-1').rstrip('\r\n'), headers
+
+
+async def iter_http_body(reader, headers):
+    """Yield a message body as it arrives, framed by Content-Length, chunked encoding or EOF"""
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                # Skip trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            yield await reader.readexactly(size)
+            await reader.readline()
+    content_length = headers.get('Content-Length')
+    if content_length is not None:
+        remaining = int(content_length)
+        while remaining > 0:
+            chunk = await reader.read(min(MULTIPART_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(chunk)
+            yield chunk
+        return
+    while True:
+        chunk = await reader.read(MULTIPART_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def read_http_body(reader, headers):
+    """Read a whole message body framed by Content-Length, chunked encoding or EOF"""
+    return b''.join([chunk async for chunk in iter_http_body(reader, headers)])
+
+
+async def async_http_open(url, data, headers):
+    """POST to an n8n webhook on asyncio streams; returns (status, headers, reader, writer) once the head arrived"""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise ValueError(f"Unsupported URL scheme: {url}")
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    ssl_context = ssl.create_default_context() if secure else None
+    endpoint = f"{parts.hostname}:{port}{parts.path}"
+
+    connect_start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=ssl_context)
+    metrics.observe_upstream(endpoint, 'connect', time.perf_counter() - connect_start)
+    try:
+        send_start = time.perf_counter()
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        lines = [
+            f"POST {target} HTTP/1.1",
+            f"Host: {parts.netloc.rsplit('@', 1)[-1]}",
+            f"Content-Length: {len(data)}",
+            "Connection: close",
+        ]
+        lines += [f"{name}: {value}" for name, value in headers.items()
+                  if name.lower() not in ('host', 'content-length', 'connection')]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if isinstance(data, (bytes, bytearray)):
+            writer.write(data)
+        else:
+            # Streamed body: write piece by piece so it is never materialized
+            for chunk in data:
+                writer.write(chunk)
+                await writer.drain()
+        await writer.drain()
+
+        status_line, response_headers = await read_http_head(reader)
+        metrics.observe_upstream(endpoint, 'ttfb', time.perf_counter() - send_start)
+        status_parts = (status_line or '').split(' ', 2)
+        if len(status_parts) < 2 or not status_parts[0].startswith('HTTP/'):
+            raise ValueError(f"Malformed upstream status line: {status_line!r}")
+        status = int(status_parts[1])
+        if status >= 400:
+            raise UpstreamHTTPError(url, status, status_parts[2] if len(status_parts) > 2 else '')
+        return status, response_headers, reader, writer
+    except BaseException:
+        writer.close()
+        raise
+
+
+async def async_http_post(url, data, headers):
+    """POST to an n8n webhook on asyncio streams, without tying up a thread"""
+    status, response_headers, reader, writer = await async_http_open(url, data, headers)
+    try:
+        return status, await read_http_body(reader, response_headers)
+    finally:
+        writer.close()
+
+
+class AsyncProxyServer:
+    """asyncio serving engine with the same routes and CORS behaviour as ProxyHandler.
     
-    # Start memory cleanup thread
-    cleanup_thread = MemoryCleanupThread()
-    cleanup_thread.start()
+    Each connection is a coroutine and n8n calls are awaited on the event loop,
+    so thousands of slow AI replies can be in flight without one thread each.
+    """
+    def __init__(self, host=HOST, port=PORT):
+        self.host = host
+        self.port = port
+        self.active_connections = 0
+        self.inflight = None
+        self.server = None
+    
+    async def serve_forever(self):
+        self.inflight = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host or None, self.port,
+            reuse_address=True, reuse_port=PREFORK or None, backlog=LISTEN_BACKLOG
+        )
+        async with self.server:
+            await self.server.serve_forever()
+    
+    def close(self):
+        if self.server:
+            self.server.close()
+    
+    async def drain(self, timeout=WORKER_DRAIN_SECONDS):
+        """Wait for in-flight connections after close(), up to timeout seconds"""
+        deadline = time.monotonic() + timeout
+        while self.active_connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.active_connections:
+            logger.warning("Stopping with %d connections still open", self.active_connections)
+    
+    async def handle_connection(self, reader, writer):
+        self.active_connections += 1
+        peer = writer.get_extra_info('peername') or ('unknown', 0)
+        client_ip = peer[0]
+        try:
+            try:
+                request_line, headers = await asyncio.wait_for(read_http_head(reader), REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                return
+            if not request_line:
+                return
+            words = request_line.split()
+            if len(words) != 3:
+                await self.send_error(writer, 400, "Bad request syntax")
+                return
+            method, path, version = words
+            started = time.perf_counter()
+            lane = lane_for(method, path)
+            try:
+                try:
+                    admitted_at = await admission.acquire_async(lane)
+                except Overloaded as e:
+                    logger.warning("Rejecting %s %s from %s: admission %s (%s lane)",
+                                   method, path, client_ip, e.reason, lane)
+                    await self.send_response(writer, 503, b'{"error": "Server busy, please retry"}',
+                                             origin=headers.get('Origin', ''),
+                                             headers=[('Retry-After', str(e.retry_after))])
+                    return
+                try:
+                    await self.dispatch(method, path, version, headers, reader, writer, client_ip)
+                finally:
+                    admission.release(lane, admitted_at)
+            finally:
+                metrics.observe_request(route_for(path), getattr(writer, 'response_status', 0),
+                                        time.perf_counter() - started)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            request_log.debug("Connection from %s closed early", client_ip)
+        except Exception as e:
+            logger.error("Async request error from %s: %s", client_ip, e, exc_info=True)
+            try:
+                await self.send_error(writer, 500, "Internal Server Error")
+            except Exception:
+                pass
+        finally:
+            self.active_connections -= 1
+            writer.close()
+    
+    async def dispatch(self, method, path, version, headers, reader, writer, client_ip):
+        origin = headers.get('Origin', '')
+        head_only = method == 'HEAD'
+        if method == 'OPTIONS':
+            # Handle preflight CORS requests
+            await self.send_response(writer, 200, b'', origin=origin, content_type=None)
+        elif method == 'POST':
+            if path.startswith('/api/chat'):
+                route, _, query = path.partition('?')
+                stream = route == CHAT_STREAM_PATH
+                async_job = (CHAT_JOBS_ENABLED and chat_jobs.running and not stream
+                             and wants_async(headers.get('Prefer'), query))
+                await self.handle_chat_proxy(headers, reader, writer, client_ip, stream=stream, async_job=async_job,
+                                             version=version)
+            else:
+                await self.send_error(writer, 404, "Not Found")
+        elif method in ('GET', 'HEAD'):
+            if path == HEALTH_PATH:
+                # Rebuilt by the health monitor's thread after each sample, never on the loop
+                status, body = health_monitor.reply(path)
+                await self.send_response(writer, status, body, origin=origin, head_only=head_only)
+                request_log.info("Health check requested from %s", client_ip)
+            elif path in (LIVE_PATH, READY_PATH):
+                # Precomputed by the health monitor: no work per probe
+                status, body = health_monitor.reply(path)
+                await self.send_response(writer, status, body, origin=origin, head_only=head_only,
+                                         headers=[('Cache-Control', 'no-store')])
+            elif path == '/api/metrics':
+                await self.send_response(writer, 200, metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE,
+                                         cors=False, head_only=head_only)
+            elif path.startswith(CHAT_JOBS_PATH) and chat_jobs.running:
+                await self.handle_job_status(path, writer, origin, head_only)
+            else:
+                await self.serve_static(path, headers, writer, head_only=head_only)
+        else:
+            await self.send_error(writer, 501, f"Unsupported method ({method!r})")
+    
+    async def handle_chat_proxy(self, headers, reader, writer, client_ip, stream=False, async_job=False,
+                                version='HTTP/1.1'):
+        request_start = time.time()
+        chat_started = time.perf_counter()
+        # One time budget for the body read, every n8n attempt and the response write
+        deadline = Deadline()
+        uploaded_files = []
+        capture = None
+        try:
+            user_agent = headers.get('User-Agent', 'Unknown')
+            content_type = headers.get('Content-Type', '')
+            content_length = int(headers.get('Content-Length', 0))
+            origin = headers.get('Origin', '')
+            
+            request_log.info("Chat request from %s - %s - %s - %d bytes",
+                             client_ip, user_agent[:50], content_type, content_length)
+            # Shape and timing only, when TRAFFIC_CAPTURE is on
+            capture = traffic_capture.begin(CHAT_STREAM_PATH if stream else '/api/chat', content_type, content_length,
+                                            headers.get(SESSION_HEADER), async_job)
+            
+            # Rate limits before reading the body, so floods never cost a full upload
+            session_header = headers.get(SESSION_HEADER)
+            if await self.rate_limited(writer, origin, client_ip, session_header):
+                return
+            
+            # Chunked uploads are not supported; without Content-Length the body cannot be framed
+            if headers.get('Transfer-Encoding'):
+                await self.send_error(writer, 411, "Length Required")
+                return
+            
+            # Validate request size
+            if content_length > MAX_FILE_SIZE * MAX_FILES_PER_REQUEST:
+                logger.warning("Request too large: %d bytes from %s", content_length, client_ip)
+                await self.send_error(writer, 413, "Request too large")
+                return
+            is_upload = content_type.startswith('multipart/form-data')
+            if not is_upload and content_length > MAX_FILE_SIZE:
+                logger.warning("JSON payload too large: %d bytes", content_length)
+                await self.send_error(writer, 413, "Payload too large")
+                return
+            
+            if headers.get('Expect', '').lower() == '100-continue':
+                # Everything that can be decided from the headers passed: now let the body come
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            
+            if is_upload:
+                try:
+                    parts = await asyncio.wait_for(
+                        self.read_multipart(reader, content_type, content_length), deadline.timeout()
+                    )
+                    chat_input, session_id, uploaded_files = collect_upload(traffic_capture.watch_parts(capture, parts))
+                except (asyncio.TimeoutError, DeadlineExceeded):
+                    logger.error("Upload read timeout")
+                    await self.send_error(writer, 408, "Upload timeout")
+                    return
+                except PartRejected as e:
+                    logger.warning("Rejected upload from %s: %s", client_ip, e)
+                    await self.send_error(writer, e.status, str(e))
+                    return
+                except MultipartError as e:
+                    logger.warning("Malformed multipart body from %s: %s", client_ip, e)
+                    await self.send_error(writer, 400, "Malformed multipart body")
+                    return
+                request_log.info("Received message with %d files from %s", len(uploaded_files), client_ip)
+                if capture is not None:
+                    # Hashing the photos reads them back: keep it off the event loop
+                    await asyncio.to_thread(traffic_capture.note_upload, capture, chat_input, session_id, uploaded_files)
+                if not session_header and await self.rate_limited(writer, origin, session_id=session_id,
+                                                                  ip_taken=client_ip):
+                    return
+                if not chat_input.strip() and len(uploaded_files) == 0:
+                    logger.warning("Empty request received")
+                    await self.send_error(writer, 400, "Empty request")
+                    return
+                if uploaded_files:
+                    phase_start = time.perf_counter()
+                    bytes_before, bytes_after = await image_preprocessor.process_async(uploaded_files,
+                                                                                 timeout=deadline.remaining())
+                    metrics.observe_phase('chat', 'preprocess', time.perf_counter() - phase_start)
+                    request_log.info("Image preprocessing: %d -> %d bytes", bytes_before, bytes_after)
+                payload = build_upload_payload(chat_input, session_id, uploaded_files, client_ip)
+                post_data = StreamingJSONBody(payload, ensure_ascii=False)
+                upstream_type = 'application/json; charset=utf-8'
+                cache_key = None
+            else:
+                try:
+                    phase_start = time.perf_counter()
+                    post_data = await asyncio.wait_for(reader.readexactly(content_length), deadline.timeout())
+                    metrics.observe_phase('chat', 'read', time.perf_counter() - phase_start)
+                except (asyncio.TimeoutError, DeadlineExceeded):
+                    logger.error("Request body read timeout")
+                    await self.send_error(writer, 408, "Request timeout")
+                    return
+                try:
+                    phase_start = time.perf_counter()
+                    payload = json.loads(post_data.decode('utf-8'))
+                    metrics.observe_phase('chat', 'parse', time.perf_counter() - phase_start)
+                    traffic_capture.note_message(capture, payload)
+                except json.JSONDecodeError as e:
+                    logger.error("Invalid JSON payload: %s", e)
+                    await self.send_error(writer, 400, "Invalid JSON")
+                    return
+                except UnicodeDecodeError as e:
+                    logger.error("Invalid UTF-8 in payload: %s", e)
+                    await self.send_error(writer, 400, "Invalid encoding")
+                    return
+                if (not session_header and isinstance(payload, dict)
+                        and await self.rate_limited(writer, origin, session_id=payload.get('sessionId'),
+                                                    ip_taken=client_ip)):
+                    return
+                upstream_type = 'application/json'
+                
+                # Answer stateless FAQ-style questions from the response cache
+                cache_key = response_cache.key_for(payload)
+                if cache_key:
+                    cached_response = response_cache.get(cache_key)
+                    if cached_response is not None:
+                        await self.send_response(writer, 200, cached_response, origin=origin,
+                                                 headers=[('X-Cache', 'HIT')])
+                        request_log.info("Answered JSON request from response cache")
+                        return
+            
+            session_id = payload.get('sessionId') if isinstance(payload, dict) else None
+            if async_job:
+                if not isinstance(post_data, bytes):
+                    # The queue stores the finished body, images encoded
+                    post_data = await asyncio.to_thread(b''.join, post_data)
+                try:
+                    job_id = await asyncio.to_thread(chat_jobs.submit, post_data, upstream_type, session_id)
+                except QueueFull as e:
+                    logger.warning("Rejecting async chat request from %s: %s", client_ip, e)
+                    await self.send_response(writer, 503, b'{"error": "Job queue full"}', origin=origin,
+                                             headers=[('Retry-After', '5')])
+                    return
+                # The job's turn will reach n8n's memory for this session
+                response_cache.note_forwarded(session_id)
+                status, body, response_headers = job_accepted_response(job_id, headers.get('Prefer'))
+                await self.send_response(writer, status, body, origin=origin, headers=response_headers)
+                return
+            
+            async def send(merged):
+                if merged is not None:
+                    # A merged turn is this session's alone, so it is never shared
+                    body = json.dumps(merged, ensure_ascii=False).encode('utf-8')
+                    return await self.forward_to_n8n(body, upstream_type, deadline), False
+                if is_upload:
+                    return await self.forward_to_n8n(post_data, upstream_type, deadline), False
+                # Identical concurrent messages share one n8n call
+                return await request_coalescer.run_async(
+                    coalescing_key(payload, post_data),
+                    lambda: self.forward_to_n8n(post_data, upstream_type, deadline)
+                )
+            
+            try:
+                if stream:
+                    # Streamed answers are neither coalesced nor cached, but wait for the session's turn
+                    relayed, _answered, _batch_size = await session_dispatcher.run_async(
+                        session_id, lambda _merged: self.stream_from_n8n(post_data, upstream_type, writer, origin,
+                                                                         chat_started, deadline, version))
+                    if relayed:
+                        response_cache.note_forwarded(session_id)
+                    return
+                
+                # A session's calls go one at a time; only the upstream call itself is coalesced
+                phase_start = time.perf_counter()
+                (response_data, shared), answered, batch_size = await session_dispatcher.run_async(
+                    session_id, send, None if is_upload else payload)
+            except SessionQueueFull as e:
+                logger.warning("Rejecting chat request from %s: %s", client_ip, e)
+                status, body, response_headers = session_busy_reply()
+                await self.send_response(writer, status, body, origin=origin, headers=response_headers)
+                return
+            metrics.observe_phase('chat', 'upstream', time.perf_counter() - phase_start)
+            if response_data is None:
+                await self.send_error(writer, *upstream_failure(deadline))
+                return
+            if shared:
+                request_log.info("Request answered by a coalesced n8n call")
+            else:
+                response_cache.note_forwarded(session_id)
+                if cache_key and batch_size == 1:
+                    response_cache.put(cache_key, response_data)
+            if not answered:
+                request_log.info("Request merged into a %d-message n8n turn", batch_size)
+                status, body, response_headers = merged_reply(batch_size)
+                await self.send_response(writer, status, body, origin=origin, headers=response_headers)
+                return
+            
+            # Handle empty successful response from n8n
+            if not response_data:
+                request_log.info("Empty but successful response from n8n")
+                response_data = b'{"status": "success"}'
+            phase_start = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.send_response(writer, 200, response_data, origin=origin),
+                                       deadline.write_timeout())
+            except asyncio.TimeoutError:
+                logger.error("Response write to %s timed out", client_ip)
+                return
+            metrics.observe_phase('chat', 'write', time.perf_counter() - phase_start)
+        finally:
+            traffic_capture.finish(capture, getattr(writer, 'response_status', 0))
+            # Release spooled upload files
+            for part in uploaded_files:
+                part.close()
+            request_duration = time.time() - request_start
+            request_log.info("Request completed in %.2fs", request_duration)
     
-    # Create server with enhanced connection handling
-    class ResilientTCPServer(socketserver.ThreadingTCPServer):
-        """Enhanced TCP server with connection limits and resource management"""
-        daemon_threads = True  # Ensure threads exit when main process exits
-        request_queue_size = 10  # Limit pending connections
+    async def rate_limited(self, writer, origin, client_ip=None, session_id=None, ip_taken=None):
+        """Answer 429 and return True if the message is over a rate limit"""
+        limited = rate_limiter.check(client_ip, session_id, ip_taken)
+        if limited is None:
+            return False
+        logger.warning("Rate limited chat message (%s limit)", limited[0])
+        status, body, response_headers = rate_limited_response(*limited)
+        await self.send_response(writer, status, body, origin=origin, headers=response_headers)
+        return True
+    
+    async def read_multipart(self, reader, content_type, content_length):
+        """Feed the request body to the multipart parser chunk by chunk"""
+        parser = MultipartParser(parse_boundary(content_type), limits=UPLOAD_LIMITS)
+        parts = []
+        remaining = content_length
+        started = time.perf_counter()
+        read_seconds = 0.0
+        try:
+            while remaining > 0:
+                read_start = time.perf_counter()
+                chunk = await reader.read(min(MULTIPART_CHUNK_SIZE, remaining))
+                read_seconds += time.perf_counter() - read_start
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                parts.extend(parser.feed(chunk))
+            parser.close()
+        except BaseException:
+            for part in parts:
+                part.close()
+            raise
+        metrics.observe_phase('chat', 'read', read_seconds)
+        metrics.observe_phase('chat', 'parse', time.perf_counter() - started - read_seconds)
+        return parts
+    
+    async def forward_to_n8n(self, post_data, content_type, deadline):
+        """Send a body to the n8n webhook URLs (with fallback/hedging); returns the raw response body or None"""
+        async def attempt(url):
+            async with self.inflight:
+                _status, response_data = await asyncio.wait_for(
+                    async_http_post(url, post_data, deadline.headers({
+                        'Content-Type': content_type,
+                        'User-Agent': 'InkFlow-Proxy/1.1'
+                    })),
+                    deadline.timeout(REQUEST_TIMEOUT)
+                )
+            request_log.info("Successfully proxied to %s", url)
+            return response_data
         
-        def __init__(self, *args, **kwargs):
-            super().__init__(*args, **kwargs)
-            # Allow socket reuse to prevent "Address already in use" errors
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            # Enable keep-alive to detect dead connections
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            # Set socket timeout to prevent hanging connections
-            self.socket.settimeout(60)
+        response_data, last_error = await fallback_forwarder.call_async(
+            N8N_WEBHOOK_URLS, attempt, 'chat',
+            hedge=isinstance(post_data, bytes), max_delay=deadline.remaining(), deadline=deadline
+        )
+        if last_error is None:
+            return response_data
         
-        def handle_timeout(self):
-            """Handle socket timeout gracefully"""
-            logger.debug("Server socket timeout occurred, continuing...")
+        # If we get here, all URLs failed
+        logger.error("All n8n URLs failed. Last error: %r", last_error)
+        return None
+    
+    async def handle_job_status(self, path, writer, origin, head_only=False):
+        """GET /api/chat/jobs/<id>[?wait=seconds], long-polled without blocking the loop"""
+        job_id, _, query = path[len(CHAT_JOBS_PATH):].partition('?')
+        deadline = time.monotonic() + job_wait_seconds(query)
+        while True:
+            # SQLite query under the queue's lock: off the event loop, like submit()
+            job = await asyncio.to_thread(chat_jobs.get, job_id)
+            if job is None or job['status'] in (DONE, FAILED) or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(0.25)
+        status, body, headers = job_status_response(job_id, job)
+        await self.send_response(writer, status, body, origin=origin, headers=headers, head_only=head_only)
+    
+    async def stream_from_n8n(self, post_data, content_type, writer, origin, chat_started, deadline,
+                              version='HTTP/1.1'):
+        """Relay an n8n answer to the client as its bytes arrive; returns True once it was relayed"""
+        async def attempt(url):
+            async with self.inflight:
+                opened = await asyncio.wait_for(
+                    async_http_open(url, post_data, deadline.headers({
+                        'Content-Type': content_type,
+                        'User-Agent': 'InkFlow-Proxy/1.1'
+                    })),
+                    deadline.timeout(REQUEST_TIMEOUT)
+                )
+            request_log.info("Streaming from %s", url)
+            return opened
         
-        def handle_error(self, request, client_address):
-            """Handle connection errors gracefully"""
-            logger.warning(f"Connection error from {client_address[0]}:{client_address[1]}")
-            # Don't print full traceback for connection errors
+        # Fallback applies until the response head arrives; after that the bytes are the client's
+        phase_start = time.perf_counter()
+        opened, last_error = await fallback_forwarder.call_async(
+            N8N_WEBHOOK_URLS, attempt, 'chat stream', hedge=False, deadline=deadline
+        )
+        metrics.observe_phase('chat', 'upstream', time.perf_counter() - phase_start)
+        if last_error is not None:
+            logger.error("All n8n URLs failed. Last error: %r", last_error)
+            await self.send_error(writer, *upstream_failure(deadline))
+            return False
         
-        def verify_request(self, request, client_address):
-            """Check connection limits before processing"""
-            with connection_count_lock:
-                if len(active_connections) >= MAX_CONCURRENT_CONNECTIONS:
-                    logger.warning(f"Rejecting connection from {client_address[0]}: too many active connections ({len(active_connections)})")
-                    return False
-            return True
+        _status, response_headers, upstream_reader, upstream_writer = opened
+        write_start = time.perf_counter()
+        relayed = 0
+        # No chunked framing for HTTP/1.0: the body ends when the connection does
+        chunked = version != 'HTTP/1.0'
+        try:
+            await self.send_response(writer, 200, b'', origin=origin,
+                                     content_type=response_headers.get('Content-Type') or 'application/json',
+                                     headers=[('Cache-Control', 'no-cache'), ('X-Accel-Buffering', 'no')],
+                                     chunked=chunked, close_delimited=not chunked)
+            body = iter_http_body(upstream_reader, response_headers)
+            while True:
+                chunk = await asyncio.wait_for(anext(body, None), REQUEST_TIMEOUT)
+                if chunk is None:
+                    break
+                if not relayed:
+                    metrics.observe_first_token(time.perf_counter() - chat_started)
+                relayed += len(chunk)
+                writer.write(self.body_chunk(chunk, chunked))
+                await writer.drain()
+            if not relayed:
+                request_log.info("Empty but successful response from n8n")
+                writer.write(self.body_chunk(b'{"status": "success"}', chunked))
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+            # Too late for an error status: the connection closes without the final chunk
+            logger.error("Streamed response failed after %d bytes: %r", relayed, e)
+            return False
+        finally:
+            upstream_writer.close()
+            metrics.observe_phase('chat', 'write', time.perf_counter() - write_start)
+        request_log.info("Streamed %d bytes of chat response", relayed)
+        return True
+    
+    @staticmethod
+    def body_chunk(data, chunked):
+        return b'%x\r\n%s\r\n' % (len(data), data) if chunked else data
+    
+    async def serve_static(self, path, headers, writer, head_only=False):
+        """Serve a landing page file with its cached compressed variant and validators"""
+        asset, redirect = static_assets.resolve(path)
+        if redirect:
+            await self.send_response(writer, 301, b'', content_type=None, cors=False,
+                                     headers=[('Location', redirect)])
+            return
+        if asset is None:
+            await self.send_error(writer, 404, "File not found", head_only=head_only)
+            return
         
-        def process_request(self, request, client_address):
-            """Process request with connection tracking"""
-            try:
-                super().process_request(request, client_address)
-            except Exception as e:
-                logger.error(f"Error processing request from {client_address}: {e}")
+        status, response_headers, body, source = static_assets.respond(asset, headers, path)
+        if body is not None or status == 304:
+            await self.send_response(writer, status, body, content_type=None, cors=False,
+                                     head_only=head_only or status == 304, headers=response_headers)
+            return
+        # Too large to keep in memory: let the kernel copy it straight from disk
+        await self.send_response(writer, status, b'', content_type=None, cors=False,
+                                 headers=response_headers, content_length=source.size)
+        if not head_only:
+            with open(source.path, 'rb') as f:
+                await asyncio.get_running_loop().sendfile(writer.transport, f, count=source.size)
+    
+    async def send_response(self, writer, status, body, origin='', content_type='application/json',
+                            cors=True, head_only=False, headers=(), content_length=None, chunked=False,
+                            close_delimited=False):
+        lines = [
+            f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}",
+            f"Server: InkFlow-Proxy/2.0 asyncio",
+            f"Date: {email.utils.formatdate(usegmt=True)}",
+        ]
+        if content_type:
+            lines.append(f"Content-Type: {content_type}")
+        if chunked:
+            # The caller writes the body as chunks
+            lines.append("Transfer-Encoding: chunked")
+        elif status != 304 and not close_delimited:
+            lines.append(f"Content-Length: {len(body) if content_length is None else content_length}")
+        lines.append("Connection: close")
+        if cors:
+            lines += [f"{name}: {value}" for name, value in cors_headers(origin)]
+        lines += [f"{name}: {value}" for name, value in headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        # Picked up by handle_connection for the request metrics
+        writer.response_status = status
+        if body and not head_only:
+            writer.write(body)
+        await writer.drain()
+    
+    async def send_error(self, writer, status, message, head_only=False):
+        """Error page matching BaseHTTPRequestHandler.send_error"""
+        body = (http.server.DEFAULT_ERROR_MESSAGE % {
+            'code': status,
+            'message': html.escape(message, quote=False),
+            'explain': http.HTTPStatus(status).description,
+        }).encode('utf-8', 'replace')
+        await self.send_response(writer, status, body, content_type=http.server.DEFAULT_ERROR_CONTENT_TYPE,
+                                 cors=False, head_only=head_only)
+
+
+class ResilientTCPServer(socketserver.ThreadingTCPServer):
+    """Enhanced TCP server with resource management; ProxyHandler does admission control
+
+    At most max_threads connections have a handler thread. The accept loop
+    waits for one to close before taking the next socket, so the excess
+    waits in the listen backlog instead of costing a thread each.
+    """
+    daemon_threads = True  # Ensure threads exit when main process exits
+    request_queue_size = LISTEN_BACKLOG
+    # Set before bind() so a restart does not hit "Address already in use"
+    allow_reuse_address = True
+    # Pre-fork workers each bind their own socket to the same port
+    allow_reuse_port = PREFORK
+    
+    def __init__(self, *args, max_threads=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Room for every request admission control may hold, running or queued
+        self.max_threads = max_threads or MAX_CONNECTION_THREADS or (
+            admission.max_active + admission.queue_size * len(LANES))
+        self.thread_slots = threading.BoundedSemaphore(self.max_threads)
+        # Enable keep-alive to detect dead connections
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Set socket timeout to prevent hanging connections
+        self.socket.settimeout(60)
+    
+    def handle_timeout(self):
+        """Handle socket timeout gracefully"""
+        logger.debug("Server socket timeout occurred, continuing...")
+    
+    def handle_error(self, request, client_address):
+        """Handle connection errors gracefully"""
+        logger.warning(f"Connection error from {client_address[0]}:{client_address[1]}")
+        # Don't print full traceback for connection errors
+    
+    def process_request(self, request, client_address):
+        """Start a handler thread for the connection once one of the max_threads slots is free"""
+        if not self.thread_slots.acquire(blocking=False):
+            logger.warning(f"All {self.max_threads} connection threads busy; new connections wait in the backlog")
+            while not self.thread_slots.acquire(timeout=0.5):
+                if server_draining.is_set():
+                    self.shutdown_request(request)
+                    return
+        try:
+            super().process_request(request, client_address)
+        except Exception as e:
+            self.thread_slots.release()
+            logger.error(f"Error processing request from {client_address}: {e}")
+    
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.thread_slots.release()
+
+
+def run_threaded_server():
+    """Run the threaded engine until SIGINT/SIGTERM, then let in-flight requests finish"""
+    httpd = ResilientTCPServer((HOST, PORT), ProxyHandler)
+    logger.info(f"Connection threads: up to {httpd.max_threads}, listen backlog {LISTEN_BACKLOG}")
+    worker_stats.start(lambda: worker_summary(len(active_connections)))
+    health_monitor.describe(lambda: build_health_data(len(active_connections)))
     
     def signal_handler(signum, frame):
         """Handle shutdown signals gracefully"""
         logger.info(f"Received signal {signum}, shutting down server...")
-        
-        # Stop cleanup thread
-        cleanup_thread.stop()
-        
-        # Shutdown server
-        httpd.shutdown()
-        httpd.server_close()
-        
-        logger.info("Server stopped gracefully")
-        sys.exit(0)
+        server_draining.set()
+        # shutdown() blocks until serve_forever() returns, and that runs on this thread
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
     
     # Set up signal handlers
     signal.signal(signal.SIGINT, signal_handler)
     if hasattr(signal, 'SIGTERM'):
         signal.signal(signal.SIGTERM, signal_handler)
     
-    # Create and start server
-    httpd = ResilientTCPServer((HOST, PORT), ProxyHandler)
-    server_start_time = time.time()
-    
     try:
         logger.info("InkFlow Proxy Server started successfully with enhanced stability features")
         logger.info("Press Ctrl+C to stop the server")
         httpd.serve_forever()
+    finally:
+        # Stop accepting, then wait for the handler threads
+        httpd.server_close()
+        deadline = time.monotonic() + WORKER_DRAIN_SECONDS
+        while len(active_connections) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if len(active_connections):
+            logger.warning(f"Stopping with {len(active_connections)} connections still open")
+
+
+def run_async_server():
+    """Run the asyncio engine until SIGINT/SIGTERM, then let in-flight requests finish"""
+    server = AsyncProxyServer()
+    worker_stats.start(lambda: worker_summary(server.active_connections))
+    health_monitor.describe(lambda: build_health_data(server.active_connections))
+    
+    def stop():
+        server_draining.set()
+        server.close()
+    
+    async def main():
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, getattr(signal, 'SIGTERM', None)):
+            if signum is None:
+                continue
+            try:
+                loop.add_signal_handler(signum, stop)
+            except NotImplementedError:
+                # Windows: fall back to KeyboardInterrupt
+                pass
+        try:
+            await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        await server.drain()
+    
+    asyncio.run(main())
+
+
+def serve():
+    """Run one server process (the only one, or a pre-fork worker); returns its exit code"""
+    # Start memory cleanup thread
+    cleanup_thread = MemoryCleanupThread()
+    cleanup_thread.start()
+    
+    # System metrics and n8n reachability for the health endpoints, sampled in the background
+    health_monitor.start(N8N_WEBHOOK_URLS, draining=server_draining.is_set)
+    
+    # Load the landing page into memory; SIGHUP or the watcher picks up edits
+    static_assets.load()
+    static_assets.start_watcher()
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=static_assets.reload, daemon=True).start())
+    
+    # Async chat jobs are forwarded by worker threads in every engine
+    if CHAT_JOBS_ENABLED:
+        chat_jobs.start(lambda body, content_type: forward_to_n8n(body, content_type, 'chat job'))
+    
+    engine = SERVER_ENGINE
+    if engine not in ('asyncio', 'threaded'):
+        logger.warning(f"Unknown SERVER_ENGINE '{engine}', using threaded server")
+        engine = 'threaded'
+    if engine == 'asyncio':
+        logger.info(f"Serving engine: asyncio (up to {ASYNC_MAX_INFLIGHT} in-flight n8n calls)")
+    else:
+        logger.info("Serving engine: threaded")
+    # A request costs a thread in the threaded engine but only a coroutine in asyncio
+    admission.max_active = ADMISSION_MAX_ACTIVE or (
+        ASYNC_MAX_INFLIGHT if engine == 'asyncio' else MAX_CONCURRENT_CONNECTIONS)
+    logger.info(f"Admission control: {admission.max_active} concurrent requests, "
+                f"{admission.queue_size} queued per lane for up to {admission.timeout:g}s")
+    
+    server_start_time = time.time()
+    exit_code = 0
+    try:
+        if engine == 'asyncio':
+            run_async_server()
+        else:
+            run_threaded_server()
     except KeyboardInterrupt:
         logger.info("Server interrupted by user")
     except Exception as e:
         logger.error(f"Server error: {e}", exc_info=True)
+        exit_code = 1
     finally:
+        worker_stats.stop()
+        health_monitor.stop()
+        chat_jobs.stop()
         cleanup_thread.stop()
-        httpd.server_close()
-        logger.info(f"Server stopped after running for {time.time() - server_start_time:.1f} seconds")
\ No newline at end of file
+        static_assets.stop_watcher()
+        upstream_pool.close_all()
+        image_preprocessor.shutdown()
+        fallback_forwarder.shutdown()
+        logger.info(f"Server stopped after running for {time.time() - server_start_time:.1f} seconds")
+    return exit_code
+
+
+if __name__ == "__main__":
+    logger.info(f"Starting InkFlow Proxy Server v2.0")
+    logger.info(f"Configuration: Max file size={MAX_FILE_SIZE//1024//1024}MB, Max files={MAX_FILES_PER_REQUEST}, Max connections={MAX_CONCURRENT_CONNECTIONS}")
+    logger.info(f"n8n Backend: {N8N_BASE_URL}")
+    logger.info(f"Webhook URLs: {N8N_WEBHOOK_URLS}")
+    logger.info(f"Allowed Origins: {ALLOWED_ORIGINS}")
+    logger.info(f"Landing page: http://{HOST if HOST else 'localhost'}:{PORT}")
+    logger.info(f"Chat API: http://{HOST if HOST else 'localhost'}:{PORT}/api/chat")
+    logger.info(f"Health check: http://{HOST if HOST else 'localhost'}:{PORT}/api/health")
+    
+    if WORKERS > 1 and not PREFORK:
+        logger.warning(f"WORKERS={WORKERS} needs fork() and SO_REUSEPORT; running a single process")
+    if PREFORK:
+        # Forked before serve() starts any server thread. The log writer thread is already
+        # running, but log_pipeline's after-fork hook gives each worker a fresh one.
+        # Each worker runs serve() on its own socket
+        sys.exit(Supervisor(WORKERS, serve).run())
+    sys.exit(serve())
@@ -0,0 +1,139 @@
+"""Token-bucket rate limits for chat messages, per client IP and per session.
+
+Every chat message ends up as a paid LLM call in n8n, so one client (or bot)
+must not be able to send them as fast as it likes. Each key gets a bucket
+of RATE_LIMIT_*_BURST tokens refilled at RATE_LIMIT_*_PER_MINUTE; a message
+spends one token and is answered 429 with Retry-After when none is left.
+A message refused by its session limit gets its IP token back, so a
+client's IP budget only pays for messages that are actually sent.
+
+A bucket is two numbers, and buckets are kept in least-recently-used order.
+A bucket idle long enough to have refilled completely is the same as no
+bucket, so it is dropped; RATE_LIMIT_MAX_KEYS caps the table during a flood
+of distinct keys. Limits apply per process, so with pre-fork workers a
+client can get up to WORKERS times the configured rate.
+"""
+import collections
+import math
+import os
+import threading
+import time
+
+from metrics import metrics
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+RATE_LIMIT_IP_BURST = float(os.getenv('RATE_LIMIT_IP_BURST', '20'))
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv('RATE_LIMIT_IP_PER_MINUTE', '30'))
+RATE_LIMIT_SESSION_BURST = float(os.getenv('RATE_LIMIT_SESSION_BURST', '5'))
+RATE_LIMIT_SESSION_PER_MINUTE = float(os.getenv('RATE_LIMIT_SESSION_PER_MINUTE', '10'))
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000'))
+
+# Sent by the chat widget so the session can be checked before the body is read
+SESSION_HEADER = 'X-Session-Id'
+# collect_upload's placeholder when a form has no sessionId: shared, so not a real key
+ANONYMOUS_SESSIONS = ('', 'default')
+
+
+class TokenBuckets:
+    """One token bucket per key, evicted once idle long enough to be full again"""
+    def __init__(self, burst, per_minute, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.burst = burst
+        self.rate = per_minute / 60.0
+        self.max_keys = max_keys
+        self.enabled = burst > 0 and self.rate > 0
+        self.idle_seconds = burst / self.rate if self.enabled else 0
+        # key -> [tokens, last update], least recently used first
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+        self.evicted = 0
+
+    def take(self, key):
+        """Spend a token for key; returns 0 if allowed, else seconds until a token is available"""
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self.buckets.move_to_end(key)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.allowed += 1
+                wait = 0
+            else:
+                self.limited += 1
+                wait = (1 - bucket[0]) / self.rate
+            self.evict(now)
+        return wait
+
+    def refund(self, key):
+        """Give back the token take() spent for key (the message was refused by another limit)"""
+        if not self.enabled:
+            return
+        with self.lock:
+            bucket = self.buckets.get(key)
+            # An evicted bucket is full already
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + 1)
+                self.allowed -= 1
+
+    def evict(self, now):
+        """Drop buckets from the idle end (called with the lock held)"""
+        while self.buckets:
+            key, (tokens, updated) = next(iter(self.buckets.items()))
+            if now - updated < self.idle_seconds and len(self.buckets) <= self.max_keys:
+                break
+            del self.buckets[key]
+            self.evicted += 1
+
+    def stats(self):
+        return {
+            'burst': self.burst,
+            'per_minute': self.rate * 60,
+            'keys': len(self.buckets),
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'evicted': self.evicted,
+        }
+
+
+class RateLimiter:
+    """Per-IP and per-session buckets for chat messages"""
+    def __init__(self):
+        self.ip = TokenBuckets(RATE_LIMIT_IP_BURST, RATE_LIMIT_IP_PER_MINUTE)
+        self.session = TokenBuckets(RATE_LIMIT_SESSION_BURST, RATE_LIMIT_SESSION_PER_MINUTE)
+
+    def check(self, client_ip=None, session_id=None, ip_taken=None):
+        """None if the message may go on, else (scope, Retry-After seconds)
+
+        ip_taken is the client IP whose token an earlier check() already spent
+        on this message (before its body was read); it is refunded if the
+        session limit refuses the message, as is a token spent in this call.
+        """
+        if not RATE_LIMIT_ENABLED:
+            return None
+        spent = [(self.ip, ip_taken)] if isinstance(ip_taken, str) else []
+        for scope, buckets, key in (('ip', self.ip, client_ip), ('session', self.session, session_id)):
+            if not isinstance(key, str) or key in ANONYMOUS_SESSIONS:
+                continue
+            wait = buckets.take(key)
+            if wait:
+                for refunded, refunded_key in spent:
+                    refunded.refund(refunded_key)
+                metrics.count_rate_limited(scope)
+                return scope, max(1, math.ceil(wait))
+            spent.append((buckets, key))
+        return None
+
+    def stats(self):
+        return {'enabled': RATE_LIMIT_ENABLED, 'ip': self.ip.stats(), 'session': self.session.stats()}
+
+
+# Shared limiter for both serving engines
+rate_limiter = RateLimiter()
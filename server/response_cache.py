@@ -0,0 +1,184 @@
+"""Optional response cache for FAQ-style chat questions.
+
+Questions about prices, opening hours, aftercare and booking make up a
+large share of chat traffic and get the same answer every time. When
+RESPONSE_CACHE_ENABLED is set, a message is answered from memory if:
+
+- its normalized chatInput matches one of the stateless rules,
+- it carries no image, files or sender details, and
+- its session has no history in n8n yet (no turn of it was forwarded),
+
+because only then can the agent's answer not depend on conversation state.
+Entries expire after RESPONSE_CACHE_TTL_SECONDS and the cache is bounded
+by RESPONSE_CACHE_MAX_ENTRIES with LRU eviction. The same stateless key
+also lets request coalescing share one n8n call between identical messages.
+
+Which sessions have history is only known per process. Pre-fork workers
+(WORKERS > 1) cannot see each other's turns, so there both the cache and
+stateless coalescing are switched off.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from prefork import WORKERS, prefork_supported
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '600'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '500'))
+RESPONSE_CACHE_MAX_INPUT_CHARS = int(os.getenv('RESPONSE_CACHE_MAX_INPUT_CHARS', '120'))
+# Optional file with one regex per line ('#' comments), replacing the default rules
+RESPONSE_CACHE_RULES_FILE = os.getenv('RESPONSE_CACHE_RULES_FILE', '')
+# How many sessions with n8n history to remember
+RESPONSE_CACHE_SESSION_TRACKING = int(os.getenv('RESPONSE_CACHE_SESSION_TRACKING', '10000'))
+
+# Session history tracked in one process cannot cover its pre-fork siblings
+HISTORY_PER_PROCESS = WORKERS > 1 and prefork_supported()
+
+# Matched against the normalized chatInput (lowercase, no punctuation or niqqud)
+DEFAULT_RULES = [
+    r'^(היי|הי|שלום|hi|hello|hey)$',
+    r'(מחיר|מחירים|כמה עולה|כמה זה עולה|עלות|price|prices|cost|how much)',
+    r'(שעות פתיחה|שעות|מתי אתם פתוחים|פתוחים|opening hours|open hours|when are you open)',
+    r'(טיפול אחרי|טיפול בקעקוע|אפטרקר|החלמה|aftercare|after care|healing)',
+    r'(לקבוע תור|קביעת תור|איך קובעים|booking|book an appointment|appointment)',
+]
+
+# Payload keys that carry no conversation context
+STATELESS_KEYS = {'chatInput', 'sessionId', 'senderName', 'senderPhone', 'timestamp',
+                  'userAgent', 'connectionStatus', 'hasFiles'}
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s]', re.UNICODE)
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_chat_input(text):
+    """Lowercase, drop niqqud/punctuation and collapse whitespace"""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    text = _PUNCTUATION_RE.sub(' ', text.lower())
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+
+def load_rules(path=RESPONSE_CACHE_RULES_FILE):
+    if not path:
+        return [re.compile(rule) for rule in DEFAULT_RULES]
+    rules = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                rules.append(re.compile(line))
+    return rules
+
+
+class ResponseCache:
+    """TTL + LRU cache of n8n answers for stateless FAQ messages"""
+    def __init__(self, enabled=RESPONSE_CACHE_ENABLED, ttl=RESPONSE_CACHE_TTL_SECONDS,
+                 max_entries=RESPONSE_CACHE_MAX_ENTRIES, rules=None, per_process=HISTORY_PER_PROCESS):
+        # Nothing is stateless when a session's earlier turns may have gone through another worker
+        self.stateless = not per_process
+        self.enabled = enabled and self.stateless
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.rules = rules if rules is not None else load_rules()
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.sessions_with_history = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    def key_for(self, payload):
+        """Cache key for a JSON chat payload, or None if it must go to n8n"""
+        if not self.enabled:
+            return None
+        key = self.stateless_key(payload)
+        if key is None:
+            with self.lock:
+                self.bypasses += 1
+        return key
+
+    def stateless_key(self, payload):
+        """Key for a payload whose answer cannot depend on conversation state, else None"""
+        if not self.stateless or not isinstance(payload, dict):
+            return None
+        chat_input = payload.get('chatInput')
+        if not isinstance(chat_input, str) or not self._is_stateless(payload):
+            return None
+        normalized = normalize_chat_input(chat_input)
+        if not normalized or len(normalized) > RESPONSE_CACHE_MAX_INPUT_CHARS:
+            return None
+        if not any(rule.search(normalized) for rule in self.rules):
+            return None
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def _is_stateless(self, payload):
+        if set(payload) - STATELESS_KEYS:
+            # imageUrl, files, hasImage or anything else we don't know about
+            return False
+        if payload.get('hasFiles') or payload.get('senderName') or payload.get('senderPhone'):
+            return False
+        session_id = payload.get('sessionId')
+        with self.lock:
+            return not session_id or session_id not in self.sessions_with_history
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, response_data):
+        if not response_data:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, response_data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def note_forwarded(self, session_id):
+        """Record that n8n now holds memory for this session"""
+        if not session_id:
+            return
+        with self.lock:
+            self.sessions_with_history[session_id] = True
+            self.sessions_with_history.move_to_end(session_id)
+            while len(self.sessions_with_history) > RESPONSE_CACHE_SESSION_TRACKING:
+                self.sessions_with_history.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'stateless': self.stateless,
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypasses': self.bypasses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'ttl': self.ttl,
+            }
+
+
+# Shared cache used by the chat forwarding paths
+response_cache = ResponseCache()
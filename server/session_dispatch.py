@@ -0,0 +1,217 @@
+"""Per-session ordering of n8n calls.
+
+The workflow's chat memory is keyed by sessionId. Two messages of one
+session sent to n8n at the same time (a double-send, or text followed by a
+photo) run the agent twice on the same history, and the second run does
+not see the first. The dispatcher queues a session's calls and sends them
+one at a time in arrival order; other sessions are unaffected. At most
+SESSION_QUEUE_MAX messages of a session may wait; more are refused.
+
+With SESSION_MERGE_WINDOW_MS > 0, plain text messages of a session that
+arrive within that window of each other, or pile up while an earlier call
+is running, are merged into a single n8n turn. The latest message answers
+with the agent's reply; the earlier ones get a short "merged" note.
+
+Messages without a real session (the 'default' placeholder of uploads
+without a sessionId) are sent straight away, as the rate limiter does.
+Ordering is per process: pre-fork workers each keep their own queues.
+Works for both the threaded handler (run) and the asyncio engine
+(run_async).
+"""
+import asyncio
+import collections
+import os
+import threading
+import time
+
+from rate_limit import ANONYMOUS_SESSIONS
+
+SESSION_ORDERING = os.getenv('SESSION_ORDERING', 'true').lower() in ('1', 'true', 'yes')
+SESSION_QUEUE_MAX = int(os.getenv('SESSION_QUEUE_MAX', '4'))
+SESSION_MERGE_WINDOW = float(os.getenv('SESSION_MERGE_WINDOW_MS', '0')) / 1000
+
+
+class SessionQueueFull(Exception):
+    """Raised when SESSION_QUEUE_MAX messages of the session are already waiting"""
+
+
+def mergeable_message(payload):
+    """Only plain text chat messages can share a turn"""
+    return (isinstance(payload, dict) and isinstance(payload.get('chatInput'), str)
+            and not payload.get('hasFiles'))
+
+
+def merge_messages(payloads):
+    """One n8n turn for several messages: the latest message carrying every chatInput"""
+    merged = dict(payloads[-1])
+    merged['chatInput'] = '\n'.join(p['chatInput'] for p in payloads if p['chatInput'].strip())
+    merged['mergedMessages'] = len(payloads)
+    return merged
+
+
+class _Batch:
+    """One n8n call, for a single message or for several merged ones"""
+    def __init__(self, mergeable):
+        self.mergeable = mergeable
+        self.opened = time.monotonic()
+        self.payloads = []
+        self.started = False
+        self.done = False
+        self.result = None
+        self.error = None
+        self.task = None
+
+
+class _Session:
+    def __init__(self, lock):
+        # Threaded: batches waiting or running, oldest first
+        self.batches = collections.deque()
+        self.cond = threading.Condition(lock)
+        # asyncio: FIFO turn lock, the batch still open for merging, live batch count
+        self.turn = None
+        self.open = None
+        self.pending = 0
+        # Messages not started yet
+        self.queued = 0
+
+
+class SessionDispatcher:
+    """Serialize calls per session key, optionally merging queued text messages"""
+    def __init__(self, enabled=SESSION_ORDERING, max_queued=SESSION_QUEUE_MAX, merge_window=SESSION_MERGE_WINDOW):
+        self.enabled = enabled
+        self.max_queued = max(1, max_queued)
+        self.merge_window = merge_window
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.async_sessions = {}
+        self.calls = 0
+        self.waited = 0
+        self.merged = 0
+        self.rejected = 0
+
+    def ordered(self, session_id):
+        """Whether the message waits for its session's turn (anonymous ones share no history)"""
+        return self.enabled and isinstance(session_id, str) and session_id not in ANONYMOUS_SESSIONS
+
+    def admit(self, session):
+        if session.queued >= self.max_queued:
+            self.rejected += 1
+            raise SessionQueueFull(f"{session.queued} messages of this session already waiting")
+        session.queued += 1
+
+    def run(self, session_id, fn, payload=None):
+        """Call fn(merged_payload or None) in the session's turn; returns (result, answered, batch_size)
+
+        answered is False for a message merged into a later one's turn.
+        """
+        if not self.ordered(session_id):
+            return fn(None), True, 1
+        mergeable = self.merge_window > 0 and mergeable_message(payload)
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = _Session(self.lock)
+            self.admit(session)
+            last = session.batches[-1] if session.batches else None
+            if mergeable and last is not None and last.mergeable and not last.started:
+                batch = last
+                self.merged += 1
+            else:
+                batch = _Batch(mergeable)
+                session.batches.append(batch)
+                if last is not None:
+                    self.waited += 1
+            batch.payloads.append(payload)
+            index = len(batch.payloads) - 1
+            if index:
+                while not batch.done:
+                    session.cond.wait()
+                if batch.error is not None:
+                    raise batch.error
+                return batch.result, index == len(batch.payloads) - 1, len(batch.payloads)
+            while session.batches[0] is not batch:
+                session.cond.wait()
+            # Hold the turn open for messages still on their way
+            while mergeable and (remaining := batch.opened + self.merge_window - time.monotonic()) > 0:
+                session.cond.wait(remaining)
+            batch.started = True
+            session.queued -= len(batch.payloads)
+            self.calls += 1
+
+        payloads = batch.payloads
+        try:
+            batch.result = fn(merge_messages(payloads) if len(payloads) > 1 else None)
+        except BaseException as e:
+            batch.error = e
+            raise
+        finally:
+            with self.lock:
+                batch.done = True
+                session.batches.popleft()
+                if not session.batches:
+                    del self.sessions[session_id]
+                session.cond.notify_all()
+        return batch.result, len(payloads) == 1, len(payloads)
+
+    async def run_async(self, session_id, coro_fn, payload=None):
+        """Event-loop variant of run(); coro_fn(merged_payload or None) returns an awaitable"""
+        if not self.ordered(session_id):
+            return await coro_fn(None), True, 1
+        mergeable = self.merge_window > 0 and mergeable_message(payload)
+        session = self.async_sessions.get(session_id)
+        if session is None:
+            session = self.async_sessions[session_id] = _Session(self.lock)
+            session.turn = asyncio.Lock()
+        with self.lock:
+            self.admit(session)
+            batch = session.open if mergeable else None
+            if batch is not None:
+                self.merged += 1
+            elif session.pending:
+                self.waited += 1
+        if batch is None:
+            batch = _Batch(mergeable)
+            session.open = batch if mergeable else None
+            session.pending += 1
+            batch.task = asyncio.ensure_future(self.run_batch(session_id, session, batch, coro_fn))
+        batch.payloads.append(payload)
+        index = len(batch.payloads) - 1
+        # shield: a caller disconnecting must not cancel the call the others wait for
+        result = await asyncio.shield(batch.task)
+        return result, index == len(batch.payloads) - 1, len(batch.payloads)
+
+    async def run_batch(self, session_id, session, batch, coro_fn):
+        try:
+            # asyncio.Lock hands the turn out in FIFO order
+            async with session.turn:
+                if batch.mergeable:
+                    await asyncio.sleep(max(0.0, batch.opened + self.merge_window - time.monotonic()))
+                if session.open is batch:
+                    session.open = None
+                with self.lock:
+                    session.queued -= len(batch.payloads)
+                    self.calls += 1
+                payloads = batch.payloads
+                return await coro_fn(merge_messages(payloads) if len(payloads) > 1 else None)
+        finally:
+            session.pending -= 1
+            if not session.pending:
+                self.async_sessions.pop(session_id, None)
+
+    def stats(self):
+        with self.lock:
+            sessions = list(self.sessions.values()) + list(self.async_sessions.values())
+            return {
+                'enabled': self.enabled,
+                'merge_window_ms': self.merge_window * 1000,
+                'active_sessions': len(sessions),
+                'queued_messages': sum(session.queued for session in sessions),
+                'upstream_calls': self.calls,
+                'waited_for_turn': self.waited,
+                'merged': self.merged,
+                'rejected': self.rejected,
+            }
+
+
+# Shared dispatcher for the chat forwarding layer
+session_dispatcher = SessionDispatcher()
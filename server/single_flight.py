@@ -0,0 +1,97 @@
+"""Single-flight coalescing of identical upstream calls.
+
+When several requests with the same key arrive while a call for that key
+is already running, they wait for it and share its result instead of
+starting their own n8n execution. Works for both the threaded handler
+(run) and the asyncio engine (run_async).
+"""
+import asyncio
+import os
+import threading
+
+REQUEST_COALESCING = os.getenv('REQUEST_COALESCING', 'true').lower() in ('1', 'true', 'yes')
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Share one in-flight call among concurrent callers with the same key"""
+    def __init__(self, enabled=REQUEST_COALESCING):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.async_calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def run(self, key, fn):
+        """Run fn() once per key at a time; returns (result, shared)"""
+        if not self.enabled or key is None:
+            return fn(), False
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result, False
+
+    async def run_async(self, key, coro_fn):
+        """Event-loop variant of run(); coro_fn() returns an awaitable"""
+        if not self.enabled or key is None:
+            return await coro_fn(), False
+        future = self.async_calls.get(key)
+        if future is not None:
+            with self.lock:
+                self.coalesced += 1
+            # shield: a follower disconnecting must not cancel the shared call
+            return await asyncio.shield(future), True
+
+        future = asyncio.ensure_future(coro_fn())
+        self.async_calls[key] = future
+        with self.lock:
+            self.leaders += 1
+        try:
+            return await asyncio.shield(future), False
+        finally:
+            if future.done():
+                self.async_calls.pop(key, None)
+            else:
+                # Leader went away first; drop the entry once the call settles
+                future.add_done_callback(lambda _f: self.async_calls.pop(key, None))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'in_flight': len(self.calls) + len(self.async_calls),
+                'upstream_calls': self.leaders,
+                'coalesced': self.coalesced,
+            }
+
+
+# Shared coalescer for the chat forwarding layer
+request_coalescer = SingleFlight()
@@ -0,0 +1,421 @@
+"""In-memory cache for the landing page assets under src/.
+
+Every file is read once at startup and kept with precompressed gzip (and,
+when the brotli package is installed, brotli) variants, a strong ETag per
+encoding and a Cache-Control policy. A request then costs a dict lookup
+and a buffer write instead of a stat, open and uncompressed copy, and
+repeat visitors get 304 Not Modified. Files over STATIC_CACHE_MAX_FILE_MB,
+or past the STATIC_CACHE_MAX_MB budget, keep only their metadata and are
+sent with sendfile.
+
+When build_assets.py has produced _optimized/manifest.json, requests for
+an original image are answered with its best AVIF/WebP variant for the
+client's Accept header and width hints (Sec-CH-Width, Sec-CH-Viewport-Width
+with Sec-CH-DPR, or ?w=). The hashed variant files are also reachable
+directly and are cached as immutable.
+
+A watcher thread re-scans the tree every STATIC_RELOAD_INTERVAL seconds
+(0 disables it); reload() can also be called directly, e.g. on SIGHUP.
+"""
+import email.utils
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import threading
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Same location the stock handler served from: ../src relative to the working directory
+STATIC_DIR = os.getenv('STATIC_DIR', os.path.join(os.path.dirname(os.getcwd()), 'src'))
+STATIC_CACHE_MAX_MB = float(os.getenv('STATIC_CACHE_MAX_MB', '64'))
+STATIC_CACHE_MAX_FILE_MB = float(os.getenv('STATIC_CACHE_MAX_FILE_MB', '8'))
+STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', '3600'))
+STATIC_RELOAD_INTERVAL = float(os.getenv('STATIC_RELOAD_INTERVAL', '2'))
+STATIC_IMAGE_VARIANTS = os.getenv('STATIC_IMAGE_VARIANTS', 'true').lower() in ('1', 'true', 'yes')
+# Written by build_assets.py, relative to the static directory
+IMAGE_MANIFEST_PATH = '_optimized/manifest.json'
+IMMUTABLE_PREFIX = '_optimized/'
+# Preferred order when the client accepts several formats
+IMAGE_FORMAT_PREFERENCE = ('image/avif', 'image/webp')
+# Client hints the landing page asks for, so variant widths can follow the viewport
+IMAGE_CLIENT_HINTS = 'Sec-CH-Width, Sec-CH-Viewport-Width, Sec-CH-DPR'
+
+# Already-compressed formats gain nothing from gzip/brotli
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml',
+                      'image/svg+xml', 'application/manifest+json')
+# Smaller than this, compression does not pay for the extra header bytes
+MIN_COMPRESS_SIZE = 256
+
+
+def is_compressible(content_type):
+    return any(content_type.startswith(prefix) for prefix in COMPRESSIBLE_TYPES)
+
+
+def accepted_encodings(accept_encoding):
+    """Encodings (or media types) the client accepts with a non-zero q-value"""
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            accepted.add(coding)
+    return accepted
+
+
+class StaticAsset:
+    """One file with its encoded variants: {encoding: (body, etag)}"""
+    def __init__(self, path, content_type, size, mtime, cache_control):
+        self.path = path
+        self.content_type = content_type
+        self.size = size
+        self.mtime = mtime
+        self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+        self.cache_control = cache_control
+        self.variants = {}
+        self.etag = None
+        self.vary = False
+        # (media type, width, StaticAsset) from the build_assets.py manifest
+        self.image_variants = []
+
+    @property
+    def in_memory(self):
+        return 'identity' in self.variants
+
+    def memory_size(self):
+        return sum(len(body) for body, _etag in self.variants.values())
+
+    def select(self, accept_encoding):
+        """Pick the smallest acceptable variant; returns (encoding, body, etag)"""
+        accepted = accepted_encodings(accept_encoding) if self.vary else ()
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.variants:
+                body, etag = self.variants[encoding]
+                return encoding, body, etag
+        body, etag = self.variants.get('identity', (None, self.etag))
+        return 'identity', body, etag
+
+    def not_modified(self, etag, if_none_match, if_modified_since):
+        """Conditional GET check; If-None-Match takes precedence over If-Modified-Since"""
+        if if_none_match:
+            if if_none_match.strip() == '*':
+                return True
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            # Weak comparison, as RFC 9110 requires for If-None-Match
+            return etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            return int(self.mtime) <= since
+        return False
+
+    def select_image(self, headers, url_path):
+        """Best prebuilt variant for the client's Accept header and width, or self"""
+        accepted = accepted_encodings(headers.get('Accept', ''))
+        formats = [mime for mime in IMAGE_FORMAT_PREFERENCE if mime in accepted]
+        if not formats:
+            return self
+        for mime in formats:
+            candidates = sorted(((width, asset) for kind, width, asset in self.image_variants if kind == mime),
+                                key=lambda candidate: candidate[0])
+            if not candidates:
+                continue
+            wanted = requested_width(headers, url_path)
+            if wanted is None:
+                return candidates[-1][1]
+            # Smallest variant that still covers the displayed width
+            for width, asset in candidates:
+                if width >= wanted:
+                    return asset
+            return candidates[-1][1]
+        return self
+
+
+def requested_width(headers, url_path):
+    """Display width in device pixels from ?w=, Sec-CH-Width or the viewport hints"""
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url_path).query)
+    try:
+        if 'w' in query:
+            return int(query['w'][0])
+        width = headers.get('Sec-CH-Width') or headers.get('Width')
+        if width:
+            return int(float(width))
+        viewport = headers.get('Sec-CH-Viewport-Width') or headers.get('Viewport-Width')
+        if viewport:
+            dpr = float(headers.get('Sec-CH-DPR') or headers.get('DPR') or 1)
+            return int(float(viewport) * max(1.0, min(dpr, 4.0)))
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+class StaticAssetCache:
+    """Snapshot of a directory tree served from memory"""
+    def __init__(self, root=STATIC_DIR, max_bytes=int(STATIC_CACHE_MAX_MB * 1024 * 1024),
+                 max_file_bytes=int(STATIC_CACHE_MAX_FILE_MB * 1024 * 1024)):
+        self.root = os.path.realpath(root)
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.lock = threading.Lock()
+        self.assets = {}
+        self.directories = set()
+        self.signature = None
+        self.loaded = False
+        self.memory_bytes = 0
+        self.reloads = 0
+        self.hits = 0
+        self.not_modified_count = 0
+        self.image_variant_count = 0
+        self.variants_served = 0
+        self.variant_bytes_saved = 0
+        self.watcher = None
+
+    def scan(self):
+        """(relative path, absolute path, stat) for every servable file under root"""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for filename in sorted(filenames):
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                relative = os.path.relpath(path, self.root).replace(os.sep, '/')
+                yield relative, path, stat
+
+    def load(self):
+        """(Re)build the cache from disk and swap it in atomically"""
+        assets = {}
+        directories = {''}
+        memory_bytes = 0
+        signature = []
+        for relative, path, stat in self.scan():
+            signature.append((relative, stat.st_mtime_ns, stat.st_size))
+            parent = posixpath.dirname(relative)
+            while parent and parent not in directories:
+                directories.add(parent)
+                parent = posixpath.dirname(parent)
+            asset = self.build_asset(path, relative, stat, memory_bytes)
+            if asset is None:
+                continue
+            assets[relative] = asset
+            memory_bytes += asset.memory_size()
+        if STATIC_IMAGE_VARIANTS:
+            self.attach_image_variants(assets)
+        with self.lock:
+            self.image_variant_count = sum(1 for asset in assets.values() if asset.image_variants)
+            self.assets = assets
+            self.directories = directories
+            self.memory_bytes = memory_bytes
+            self.signature = signature
+            self.loaded = True
+            self.reloads += 1
+        logger.info(f"Static assets loaded from {self.root}: {len(assets)} files, {memory_bytes} bytes in memory")
+
+    def build_asset(self, path, relative, stat, memory_bytes):
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=utf-8'
+        # HTML is revalidated on every visit so deploys show up at once
+        if content_type.startswith('text/html'):
+            cache_control = 'no-cache'
+        elif relative.startswith(IMMUTABLE_PREFIX):
+            # Content-hashed file names never change meaning
+            cache_control = 'public, max-age=31536000, immutable'
+        else:
+            cache_control = f'public, max-age={STATIC_MAX_AGE}'
+        asset = StaticAsset(path, content_type, stat.st_size, stat.st_mtime, cache_control)
+
+        if stat.st_size > self.max_file_bytes or memory_bytes + stat.st_size > self.max_bytes:
+            # Served from disk; the validator comes from size and mtime instead of content
+            asset.etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+            return asset
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except OSError as e:
+            logger.warning(f"Could not cache static file {path}: {e}")
+            return None
+
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        asset.etag = f'"{digest}"'
+        asset.variants['identity'] = (body, asset.etag)
+        if is_compressible(content_type) and len(body) >= MIN_COMPRESS_SIZE:
+            asset.vary = True
+            # Each encoding is a different representation, so it gets its own strong ETag
+            gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gzipped) < len(body):
+                asset.variants['gzip'] = (gzipped, f'"{digest}-gz"')
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    asset.variants['br'] = (compressed, f'"{digest}-br"')
+        return asset
+
+    def attach_image_variants(self, assets):
+        """Link originals to the variants listed in the build manifest, if it is current"""
+        manifest = assets.get(IMAGE_MANIFEST_PATH)
+        if manifest is None:
+            return
+        try:
+            if manifest.in_memory:
+                data = manifest.variants['identity'][0]
+            else:
+                with open(manifest.path, 'rb') as f:
+                    data = f.read()
+            images = json.loads(data.decode('utf-8')).get('images', {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable image manifest: {e}")
+            return
+        stale = 0
+        for relative, entry in images.items():
+            original = assets.get(relative)
+            if original is None:
+                continue
+            # The original was edited after the last build: its variants would show the old image
+            if original.in_memory:
+                current = original.etag == '"' + entry.get('hash', '')[:20] + '"'
+            else:
+                current = original.size == entry.get('bytes')
+            if not current:
+                stale += 1
+                continue
+            for variant in entry.get('variants', []):
+                variant_asset = assets.get(variant['path'])
+                if variant_asset is not None:
+                    original.image_variants.append((variant['type'], variant['width'], variant_asset))
+        if stale:
+            logger.warning(f"{stale} images changed since build_assets.py last ran; serving their originals")
+
+    def changed(self):
+        signature = [(relative, stat.st_mtime_ns, stat.st_size) for relative, _path, stat in self.scan()]
+        with self.lock:
+            return signature != self.signature
+
+    def reload(self):
+        try:
+            self.load()
+        except Exception as e:
+            logger.error(f"Static asset reload failed: {e}", exc_info=True)
+
+    def start_watcher(self, interval=STATIC_RELOAD_INTERVAL):
+        """Poll the tree for changes in a daemon thread"""
+        if interval <= 0 or self.watcher is not None:
+            return
+        stop = threading.Event()
+
+        def watch():
+            while not stop.wait(interval):
+                try:
+                    if self.changed():
+                        logger.info("Static files changed on disk, reloading")
+                        self.reload()
+                except Exception as e:
+                    logger.error(f"Static asset watcher error: {e}", exc_info=True)
+
+        self.watcher = (threading.Thread(target=watch, daemon=True, name='static-watcher'), stop)
+        self.watcher[0].start()
+
+    def stop_watcher(self):
+        if self.watcher is not None:
+            self.watcher[1].set()
+            self.watcher = None
+
+    def resolve(self, url_path):
+        """Map a request path to (asset, redirect_location); both None means 404"""
+        if not self.loaded:
+            self.load()
+        path = urllib.parse.urlsplit(url_path).path
+        relative = posixpath.normpath(urllib.parse.unquote(path)).lstrip('/')
+        if relative in ('.', ''):
+            relative = ''
+        with self.lock:
+            assets = self.assets
+            directories = self.directories
+        if relative in directories:
+            if not path.endswith('/'):
+                # Like SimpleHTTPRequestHandler: directories need a trailing slash
+                return None, path + '/'
+            relative = posixpath.join(relative, 'index.html') if relative else 'index.html'
+        asset = assets.get(relative)
+        if asset is not None:
+            with self.lock:
+                self.hits += 1
+        return asset, None
+
+    def respond(self, asset, headers, url_path=''):
+        """Status, response headers, body and the asset actually sent.
+
+        The body is None when the file must be sent from disk (source.path).
+        """
+        vary = []
+        source = asset
+        if asset.image_variants:
+            source = asset.select_image(headers, url_path)
+            vary.append('Accept')
+            vary.append(IMAGE_CLIENT_HINTS)
+            if source is not asset:
+                with self.lock:
+                    self.variants_served += 1
+                    self.variant_bytes_saved += max(0, asset.size - source.size)
+        encoding, body, etag = source.select(headers.get('Accept-Encoding', ''))
+        response_headers = [
+            ('Content-Type', source.content_type),
+            ('ETag', etag),
+            ('Last-Modified', source.last_modified),
+            # Negotiated images keep the original URL's policy, not the variant's immutable one
+            ('Cache-Control', asset.cache_control),
+        ]
+        if source.vary:
+            vary.insert(0, 'Accept-Encoding')
+        if vary:
+            response_headers.append(('Vary', ', '.join(vary)))
+        if asset.content_type.startswith('text/html') and self.image_variant_count:
+            response_headers.append(('Accept-CH', IMAGE_CLIENT_HINTS))
+        if source.not_modified(etag, headers.get('If-None-Match'), headers.get('If-Modified-Since')):
+            with self.lock:
+                self.not_modified_count += 1
+            return 304, response_headers, b'', source
+        if encoding != 'identity':
+            response_headers.append(('Content-Encoding', encoding))
+        return 200, response_headers, body, source
+
+    def stats(self):
+        with self.lock:
+            return {
+                'files': len(self.assets),
+                'in_memory': sum(1 for asset in self.assets.values() if asset.in_memory),
+                'memory_bytes': self.memory_bytes,
+                'brotli': brotli is not None,
+                'reloads': self.reloads,
+                'hits': self.hits,
+                'not_modified': self.not_modified_count,
+                'image_variants': self.image_variant_count,
+                'variants_served': self.variants_served,
+                'variant_bytes_saved': self.variant_bytes_saved,
+            }
+
+
+# Shared asset cache for both serving engines
+static_assets = StaticAssetCache()
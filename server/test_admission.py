@@ -0,0 +1,141 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+from admission import CHAT, PRIORITY, AdmissionController, Overloaded, lane_for
+from conftest import exchange, request
+
+
+def controller(**overrides):
+    settings = {'max_active': 3, 'reserved': 1, 'queue_size': 2, 'timeout': 0.05}
+    settings.update(overrides)
+    return AdmissionController(**settings)
+
+
+@pytest.mark.parametrize('method, path, lane', [
+    ('POST', '/api/chat', CHAT),
+    ('POST', '/api/chat/stream', CHAT),
+    ('GET', '/api/chat/jobs/abc?wait=20', CHAT),
+    ('OPTIONS', '/api/chat', PRIORITY),
+    ('GET', '/', PRIORITY),
+    ('GET', '/api/health', PRIORITY),
+    ('GET', '/api/metrics', PRIORITY),
+])
+def test_lane_for(method, path, lane):
+    assert lane_for(method, path) == lane
+
+
+def test_chat_cannot_take_reserved_slots():
+    admission = controller()
+    assert admission.enqueue(CHAT, lambda: None) is None
+    assert admission.enqueue(CHAT, lambda: None) is None
+    # Third slot is the priority lane's
+    ticket = admission.enqueue(CHAT, lambda: None)
+    assert ticket is not None
+    assert admission.enqueue(PRIORITY, lambda: None) is None
+    assert admission.active == {PRIORITY: 1, CHAT: 2}
+
+
+def test_freed_slot_goes_to_waiting_priority_first():
+    admission = controller(reserved=0)
+    for _ in range(3):
+        assert admission.enqueue(CHAT, lambda: None) is None
+    woken = []
+    chat_ticket = admission.enqueue(CHAT, lambda: woken.append(CHAT))
+    priority_ticket = admission.enqueue(PRIORITY, lambda: woken.append(PRIORITY))
+
+    admission.release(CHAT, 0)
+    assert woken == [PRIORITY]
+    assert priority_ticket.granted and not chat_ticket.granted
+
+    admission.release(CHAT, 0)
+    assert woken == [PRIORITY, CHAT]
+
+
+def test_queue_full_is_rejected_with_retry_after():
+    admission = controller()
+    admission.enqueue(CHAT, lambda: None)
+    admission.enqueue(CHAT, lambda: None)
+    admission.enqueue(CHAT, lambda: None)
+    admission.enqueue(CHAT, lambda: None)
+    with pytest.raises(Overloaded) as caught:
+        admission.enqueue(CHAT, lambda: None)
+    assert caught.value.reason == 'queue_full'
+    assert caught.value.retry_after >= 1
+    assert admission.rejected == {(CHAT, 'queue_full'): 1}
+
+
+def test_acquire_times_out_in_the_queue():
+    admission = controller()
+    admission.acquire(CHAT)
+    admission.acquire(CHAT)
+    with pytest.raises(Overloaded) as caught:
+        admission.acquire(CHAT)
+    assert caught.value.reason == 'timeout'
+    assert admission.waiting_count() == 0
+
+
+def test_acquire_async_is_granted_on_release():
+    admission = controller(timeout=5)
+
+    async def scenario():
+        first = await admission.acquire_async(CHAT)
+        await admission.acquire_async(CHAT)
+        waiter = asyncio.ensure_future(admission.acquire_async(CHAT))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        admission.release(CHAT, first)
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(scenario())
+    assert admission.active[CHAT] == 2
+
+
+def test_cancelled_async_waiter_leaves_the_queue():
+    admission = controller(timeout=5)
+
+    async def scenario():
+        await admission.acquire_async(CHAT)
+        await admission.acquire_async(CHAT)
+        waiter = asyncio.ensure_future(admission.acquire_async(CHAT))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(scenario())
+    assert admission.waiting_count() == 0
+    assert admission.active[CHAT] == 2
+
+
+@pytest.fixture
+def one_thread_server(proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'KEEPALIVE_TIMEOUT', 30)
+    httpd = proxy.ResilientTCPServer(('127.0.0.1', 0), proxy.ProxyHandler, max_threads=1)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_connections_over_the_thread_ceiling_wait_for_a_free_thread(one_thread_server):
+    idle = socket.create_connection(('127.0.0.1', one_thread_server), timeout=5)
+    idle.sendall(b'GET /api/health/live HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    assert idle.recv(65536).startswith(b'HTTP/1.1 200')
+
+    # The idle keep-alive connection holds the only handler thread
+    with pytest.raises(socket.timeout):
+        exchange(one_thread_server, request('GET', '/api/health/live'), timeout=0.5)
+    idle.close()
+    status, _headers, _body = exchange(one_thread_server, request('GET', '/api/health/live'))
+    assert status == 200
+
+
+def test_thread_ceiling_defaults_to_admission_capacity(proxy):
+    httpd = proxy.ResilientTCPServer(('127.0.0.1', 0), proxy.ProxyHandler)
+    try:
+        assert httpd.max_threads == proxy.admission.max_active + 2 * proxy.admission.queue_size
+    finally:
+        httpd.server_close()
@@ -0,0 +1,85 @@
+import json
+import os
+import random
+
+import pytest
+
+PIL = pytest.importorskip('PIL')
+
+import build_assets  # noqa: E402
+from PIL import Image  # noqa: E402
+from static_assets import StaticAssetCache  # noqa: E402
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    monkeypatch.setattr(build_assets, 'IMAGE_VARIANT_WIDTHS', [480, 960])
+    # WebP only, so the tests do not depend on the Pillow build's AVIF support
+    monkeypatch.setattr(build_assets, 'FORMATS', [fmt for fmt in build_assets.FORMATS if fmt[0] == 'webp'])
+    (tmp_path / 'images').mkdir()
+    # Noise: a PNG that every WebP variant beats
+    image = Image.frombytes('RGB', (1200, 800), random.Random(7).randbytes(1200 * 800 * 3))
+    image.save(tmp_path / 'images' / 'Hero Shot.png')
+    return tmp_path
+
+
+def manifest(site):
+    with open(site / '_optimized' / 'manifest.json', encoding='utf-8') as f:
+        return json.load(f)['images']
+
+
+def test_variant_widths_never_upscale(monkeypatch):
+    monkeypatch.setattr(build_assets, 'IMAGE_VARIANT_WIDTHS', [480, 960, 1600])
+    assert build_assets.variant_widths(1200) == [480, 960, 1200]
+    assert build_assets.variant_widths(300) == [300]
+
+
+def test_build_writes_hashed_variants_and_a_manifest(site):
+    build_assets.build(str(site))
+    entry = manifest(site)['images/Hero Shot.png']
+    assert (entry['width'], entry['height']) == (1200, 800)
+    assert [variant['width'] for variant in entry['variants']] == [480, 960]
+    for variant in entry['variants']:
+        assert variant['path'].startswith('_optimized/hero-shot-' + entry['hash'][:10])
+        assert variant['type'] == 'image/webp'
+        assert os.path.getsize(site / variant['path']) == variant['bytes'] < entry['bytes']
+
+
+def test_unchanged_sources_are_skipped(site, monkeypatch):
+    build_assets.build(str(site))
+    monkeypatch.setattr(build_assets, 'build_variants', lambda *args: pytest.fail('rebuilt an unchanged image'))
+    build_assets.build(str(site))
+
+
+def test_variants_of_changed_sources_are_removed(site):
+    build_assets.build(str(site))
+    old = {variant['path'] for variant in manifest(site)['images/Hero Shot.png']['variants']}
+    Image.new('RGB', (1200, 800), (10, 200, 30)).save(site / 'images' / 'Hero Shot.png')
+    build_assets.build(str(site))
+    for path in old:
+        assert not (site / path).exists()
+
+
+def test_server_negotiates_the_variants(site):
+    build_assets.build(str(site))
+    assets = StaticAssetCache(root=str(site))
+    assets.load()
+    original, _redirect = assets.resolve('/images/Hero%20Shot.png')
+
+    _status, headers, _body, source = assets.respond(original, {'Accept': 'image/webp,*/*', 'Sec-CH-Width': '700'})
+    assert source.content_type == 'image/webp'
+    assert source.path.endswith('-960w.webp')
+    assert dict(headers)['Cache-Control'] == original.cache_control
+    assert 'Accept' in dict(headers)['Vary']
+
+    _status, _headers, _body, source = assets.respond(original, {'Accept': 'image/png'})
+    assert source is original
+
+
+def test_edited_original_is_served_until_the_next_build(site):
+    build_assets.build(str(site))
+    Image.new('RGB', (1200, 800), (10, 200, 30)).save(site / 'images' / 'Hero Shot.png')
+    assets = StaticAssetCache(root=str(site))
+    assets.load()
+    original, _redirect = assets.resolve('/images/Hero%20Shot.png')
+    assert original.image_variants == []
@@ -0,0 +1,79 @@
+import socket
+
+import pytest
+
+import deadline as deadline_module
+from conftest import chat_message, exchange, request
+from deadline import DEADLINE_WRITE_FLOOR_SECONDS, REQUEST_DEADLINE_HEADER, Deadline, DeadlineExceeded
+
+
+@pytest.fixture
+def clock(monkeypatch, clock):
+    monkeypatch.setattr(deadline_module, 'time', clock)
+    return clock
+
+
+def test_remaining_counts_down(clock):
+    deadline = Deadline(10)
+    clock.advance(4)
+    assert deadline.remaining() == pytest.approx(6)
+    assert not deadline.expired
+    clock.advance(7)
+    assert deadline.remaining() == 0
+    assert deadline.expired
+
+
+def test_timeout_is_capped(clock):
+    deadline = Deadline(10)
+    assert deadline.timeout() == pytest.approx(10)
+    assert deadline.timeout(3) == 3
+    clock.advance(8)
+    assert deadline.timeout(3) == pytest.approx(2)
+
+
+def test_timeout_raises_once_spent(clock):
+    deadline = Deadline(1)
+    clock.advance(1)
+    with pytest.raises(DeadlineExceeded):
+        deadline.timeout()
+
+
+def test_exceeded_is_a_socket_timeout():
+    # Existing `except socket.timeout` handlers answer 408 for it
+    assert issubclass(DeadlineExceeded, socket.timeout)
+
+
+def test_write_timeout_has_a_floor(clock):
+    deadline = Deadline(5)
+    assert deadline.write_timeout() == pytest.approx(5)
+    clock.advance(10)
+    assert deadline.write_timeout() == DEADLINE_WRITE_FLOOR_SECONDS
+
+
+def test_headers_carry_the_time_left(clock):
+    deadline = Deadline(2.5)
+    clock.advance(1)
+    original = {'Content-Type': 'application/json'}
+    headers = deadline.headers(original)
+    assert headers == {'Content-Type': 'application/json', REQUEST_DEADLINE_HEADER: '1500'}
+    assert original == {'Content-Type': 'application/json'}
+
+
+def chat(port):
+    return exchange(port, request('POST', '/api/chat', chat_message(), headers=[('Content-Type', 'application/json')]))
+
+
+def test_n8n_is_told_the_time_left(engine_server, fake_n8n, proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'Deadline', lambda: Deadline(20))
+    status, _headers, _body = chat(engine_server)
+    assert status == 200
+    _path, headers, _body = fake_n8n.requests[0]
+    assert 0 < int(headers[REQUEST_DEADLINE_HEADER]) <= 20000
+
+
+def test_slow_n8n_answers_504_at_the_deadline(engine_server, fake_n8n, proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'Deadline', lambda: Deadline(0.5))
+    fake_n8n.delay = 2
+    status, _headers, _body = chat(engine_server)
+    assert status == 504
+    assert len(fake_n8n.requests) == 1
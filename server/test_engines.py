@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from conftest import chat_message, exchange, request
+
+
+def test_health_document(engine_server):
+    status, headers, body = exchange(engine_server, request('GET', '/api/health'))
+    assert status == 200
+    assert headers['content-type'] == 'application/json'
+    assert 'status' in json.loads(body)
+
+
+@pytest.mark.parametrize('path', ['/api/health', '/api/health/live', '/api/metrics'])
+def test_head_routes_like_get(engine_server, path):
+    status, headers, body = exchange(engine_server, request('HEAD', path))
+    assert status == 200
+    assert int(headers['content-length']) > 0
+    assert body == b''
+
+
+def test_head_of_unknown_path_is_404(engine_server):
+    status, _headers, body = exchange(engine_server, request('HEAD', '/no-such-file.txt'))
+    assert status == 404
+    assert body == b''
+
+
+def test_chunked_upload_needs_a_length(engine_server):
+    raw = (b'POST /api/chat HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+           b'Content-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n'
+           b'2\r\n{}\r\n0\r\n\r\n')
+    status, _headers, _body = exchange(engine_server, raw)
+    assert status == 411
+
+
+def test_chat_message_is_forwarded(engine_server, fake_n8n):
+    status, _headers, body = exchange(engine_server, request(
+        'POST', '/api/chat', chat_message(), headers=[('Content-Type', 'application/json')]))
+    assert status == 200
+    assert json.loads(body) == {'output': 'hi'}
+    _path, n8n_headers, n8n_body = fake_n8n.requests[0]
+    assert json.loads(n8n_body)['chatInput'] == 'hi'
+
+
+def test_stream_is_chunked_for_http_11(engine_server, fake_n8n):
+    fake_n8n.chunks = [b'{"output": ', b'"streamed"}']
+    status, headers, body = exchange(engine_server, request(
+        'POST', '/api/chat/stream', chat_message(), headers=[('Content-Type', 'application/json')]))
+    assert status == 200
+    assert headers['transfer-encoding'] == 'chunked'
+    assert body == b'b\r\n{"output": \r\nb\r\n"streamed"}\r\n0\r\n\r\n'
+
+
+def test_stream_is_close_delimited_for_http_10(engine_server, fake_n8n):
+    fake_n8n.chunks = [b'{"output": ', b'"streamed"}']
+    status, headers, body = exchange(engine_server, request(
+        'POST', '/api/chat/stream', chat_message(), version='HTTP/1.0',
+        headers=[('Content-Type', 'application/json')]))
+    assert status == 200
+    assert 'transfer-encoding' not in headers
+    assert 'content-length' not in headers
+    assert body == b'{"output": "streamed"}'
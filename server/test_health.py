@@ -0,0 +1,146 @@
+import http.server
+import json
+import socket
+import threading
+
+import pytest
+
+from conftest import exchange, request
+from health import DRAINING_REPLY, HEALTH_PATH, LIVE_PATH, READY_PATH, HealthMonitor, probe_url
+
+
+class GatewayHandler(http.server.BaseHTTPRequestHandler):
+    """A tunnel in front of a stopped n8n"""
+    def do_HEAD(self):
+        self.send_response(self.server.status)
+        for name, value in self.server.headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def gateway():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), GatewayHandler)
+    server.status = 502
+    server.headers = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_any_answer_from_n8n_is_reachable(fake_n8n):
+    entry = probe_url(fake_n8n.url)
+    # The webhook only takes POST, but it answered
+    assert entry['reachable'] is True
+    assert entry['status'] == 501
+    assert entry['latency_ms'] >= 0
+
+
+@pytest.mark.parametrize('status, headers, error', [
+    (502, [], 'gateway answered 502'),
+    (404, [('Ngrok-Error-Code', 'ERR_NGROK_3200')], 'tunnel error ERR_NGROK_3200'),
+])
+def test_gateway_answers_are_unreachable(gateway, status, headers, error):
+    gateway.status, gateway.headers = status, headers
+    entry = probe_url(f'http://127.0.0.1:{gateway.server_address[1]}/webhook/tattoo-chat')
+    assert entry['reachable'] is False
+    assert entry['error'] == error
+
+
+def test_connection_errors_are_unreachable():
+    entry = probe_url(f'http://127.0.0.1:{closed_port()}/webhook', timeout=1)
+    assert entry['reachable'] is False
+    assert entry['status'] is None and entry['error']
+
+
+def ready(monitor):
+    status, body = monitor.reply(READY_PATH)
+    return status, json.loads(body)['status']
+
+
+def test_readiness_follows_the_probes(gateway, fake_n8n):
+    monitor = HealthMonitor()
+    assert ready(monitor) == (503, 'starting')
+    monitor.urls = [f'http://127.0.0.1:{gateway.server_address[1]}/webhook']
+    monitor.probe()
+    assert ready(monitor) == (503, 'n8n_unreachable')
+    monitor.urls.append(fake_n8n.url)
+    monitor.probe()
+    assert ready(monitor) == (200, 'ready')
+    assert monitor.probes == 2
+
+
+def test_readiness_can_ignore_n8n():
+    monitor = HealthMonitor(requires_n8n=False)
+    monitor.refresh()
+    assert ready(monitor) == (200, 'ready')
+
+
+def test_draining_is_not_ready_but_still_live():
+    monitor = HealthMonitor(requires_n8n=False)
+    monitor.refresh()
+    monitor.draining = lambda: True
+    assert monitor.reply(READY_PATH) == DRAINING_REPLY
+    assert monitor.reply(LIVE_PATH)[0] == 200
+    assert monitor.snapshot()['ready'] is False
+
+
+def test_uptime_counts_from_start(monkeypatch, clock):
+    monitor = HealthMonitor()
+    monkeypatch.setattr('health.time', clock)
+    monitor.start([])
+    try:
+        clock.advance(42)
+        monitor.refresh()
+        assert json.loads(monitor.reply(LIVE_PATH)[1])['uptime'] == 42
+    finally:
+        monitor.stop()
+
+
+def test_health_document_is_built_on_refresh_only():
+    monitor = HealthMonitor()
+    calls = []
+    monitor.describe(lambda: calls.append(1) or {'status': 'healthy', 'builds': len(calls)})
+    assert json.loads(monitor.reply(HEALTH_PATH)[1]) == {'status': 'healthy', 'builds': 1}
+    monitor.reply(HEALTH_PATH)
+    assert len(calls) == 1
+    monitor.refresh()
+    assert json.loads(monitor.reply(HEALTH_PATH)[1])['builds'] == 2
+
+
+def test_failing_document_keeps_the_last_one():
+    monitor = HealthMonitor()
+    monitor.describe(lambda: {'status': 'healthy'})
+    monitor.describe(lambda: 1 / 0)
+    assert json.loads(monitor.reply(HEALTH_PATH)[1]) == {'status': 'healthy'}
+
+
+def test_engines_serve_the_sampled_document(engine_server, proxy, monkeypatch):
+    monitor = HealthMonitor()
+    monkeypatch.setattr(proxy, 'health_monitor', monitor)
+    built = []
+
+    def document():
+        built.append(1)
+        return proxy.build_health_data(3)
+
+    monitor.describe(document)
+    for _ in range(3):
+        status, headers, body = exchange(engine_server, request('GET', HEALTH_PATH))
+        assert status == 200
+        assert headers['content-type'] == 'application/json'
+    health = json.loads(body)
+    assert health['active_connections'] == 3
+    assert {'response_cache', 'admission', 'chat_jobs', 'logging'} <= set(health)
+    assert len(built) == 1
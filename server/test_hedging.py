@@ -0,0 +1,289 @@
+import threading
+
+import pytest
+
+import hedging
+from deadline import Deadline, DeadlineExceeded
+from hedging import EndpointState, FallbackForwarder
+
+PRIMARY, FALLBACK = 'http://n8n/webhook/chat', 'http://n8n/webhook-test/chat'
+
+
+@pytest.fixture(autouse=True)
+def breaker_settings(monkeypatch, clock):
+    monkeypatch.setattr(hedging, 'time', clock)
+    monkeypatch.setattr(hedging, 'CIRCUIT_FAILURE_THRESHOLD', 3)
+    monkeypatch.setattr(hedging, 'CIRCUIT_RESET_SECONDS', 30)
+
+
+def open_circuit(state):
+    for _ in range(hedging.CIRCUIT_FAILURE_THRESHOLD):
+        assert state.allow()
+        state.record_failure()
+    assert state.state == EndpointState.OPEN
+
+
+def half_open(forwarder, clock, *urls):
+    """Open each URL's breaker and let the reset time pass, so the next allow() is the trial"""
+    for url in urls:
+        open_circuit(forwarder.endpoint(url))
+    clock.advance(hedging.CIRCUIT_RESET_SECONDS)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    state = EndpointState(PRIMARY)
+    state.record_failure()
+    state.record_failure()
+    state.record_success(0.1)
+    assert state.consecutive_failures == 0
+    open_circuit(state)
+    assert not state.allow()
+    assert state.skipped == 1
+
+
+def test_breaker_half_open_trial_closes_on_success(clock):
+    state = EndpointState(PRIMARY)
+    open_circuit(state)
+    clock.advance(29)
+    assert not state.available()
+    clock.advance(1)
+    assert state.available()
+    assert state.allow()
+    assert state.state == EndpointState.HALF_OPEN
+    # One trial at a time
+    assert not state.available()
+    assert not state.allow()
+    state.record_success(0.2)
+    assert state.state == EndpointState.CLOSED
+    assert state.allow()
+
+
+def test_breaker_half_open_trial_failure_reopens(clock):
+    state = EndpointState(PRIMARY)
+    open_circuit(state)
+    clock.advance(30)
+    assert state.allow()
+    state.record_failure()
+    assert state.state == EndpointState.OPEN
+    assert not state.allow()
+
+
+def test_cancelled_trial_gives_the_slot_back(clock):
+    state = EndpointState(PRIMARY)
+    open_circuit(state)
+    clock.advance(30)
+    assert state.allow()
+    state.release_trial()
+    assert state.allow()
+
+
+def test_available_does_not_claim_the_trial(clock):
+    state = EndpointState(PRIMARY)
+    open_circuit(state)
+    clock.advance(30)
+    assert state.available()
+    assert state.available()
+    assert state.allow()
+
+
+def test_serial_fallback_after_primary_failure():
+    forwarder = FallbackForwarder(hedged=False)
+    tried = []
+
+    def attempt(url, cancel_token):
+        tried.append(url)
+        if url == PRIMARY:
+            raise OSError('connection refused')
+        return 'answer'
+
+    assert forwarder.call([PRIMARY, FALLBACK], attempt, 'test') == ('answer', None)
+    assert tried == [PRIMARY, FALLBACK]
+    assert forwarder.endpoint(PRIMARY).failures == 1
+
+
+def test_unused_half_open_fallback_keeps_its_trial_slot(clock):
+    forwarder = FallbackForwarder(hedged=False)
+    half_open(forwarder, clock, PRIMARY, FALLBACK)
+
+    assert forwarder.call([PRIMARY, FALLBACK], lambda url, token: url, 'test') == (PRIMARY, None)
+    assert forwarder.endpoint(PRIMARY).state == EndpointState.CLOSED
+    # The fallback was never tried: its trial is still there for the next request
+    fallback = forwarder.endpoint(FALLBACK)
+    assert not fallback.trial_in_flight
+    assert fallback.allow()
+
+
+def test_unlaunched_hedge_keeps_its_trial_slot(clock):
+    forwarder = FallbackForwarder(hedged=True)
+    half_open(forwarder, clock, PRIMARY, FALLBACK)
+    try:
+        assert forwarder.call([PRIMARY, FALLBACK], lambda url, token: url, 'test') == (PRIMARY, None)
+    finally:
+        forwarder.shutdown()
+    assert forwarder.endpoint(FALLBACK).allow()
+
+
+def test_hedge_fires_when_primary_is_slow(monkeypatch):
+    monkeypatch.setattr(hedging, 'HEDGE_MIN_DELAY', 0.01)
+    monkeypatch.setattr(hedging, 'HEDGE_DEFAULT_DELAY', 0.01)
+    forwarder = FallbackForwarder(hedged=True)
+    primary_cancelled = threading.Event()
+
+    def attempt(url, cancel_token):
+        if url == PRIMARY:
+            for _ in range(500):
+                if cancel_token.cancelled:
+                    primary_cancelled.set()
+                    raise OSError('cancelled')
+                threading.Event().wait(0.01)
+            return 'late'
+        return 'hedged answer'
+
+    try:
+        assert forwarder.call([PRIMARY, FALLBACK], attempt, 'test') == ('hedged answer', None)
+        assert primary_cancelled.wait(5)
+    finally:
+        forwarder.shutdown()
+    assert forwarder.hedges_fired == 1
+    assert forwarder.hedge_wins == 1
+    # The loser was cancelled, not failed
+    assert forwarder.endpoint(PRIMARY).failures == 0
+
+
+def test_expired_deadline_stops_the_fallback_loop(clock, monkeypatch):
+    import deadline as deadline_module
+    monkeypatch.setattr(deadline_module, 'time', clock)
+    forwarder = FallbackForwarder(hedged=False)
+    deadline = Deadline(5)
+    tried = []
+
+    def attempt(url, cancel_token):
+        tried.append(url)
+        clock.advance(6)
+        raise OSError('timed out')
+
+    result, error = forwarder.call([PRIMARY, FALLBACK], attempt, 'test', deadline=deadline)
+    assert result is None and isinstance(error, OSError)
+    assert tried == [PRIMARY]
+    assert forwarder.endpoint(FALLBACK).allow()
+
+
+def test_attempt_without_time_left_is_not_a_failure(clock, monkeypatch):
+    import deadline as deadline_module
+    monkeypatch.setattr(deadline_module, 'time', clock)
+    forwarder = FallbackForwarder(hedged=False)
+    deadline = Deadline(1)
+    clock.advance(2)
+
+    def attempt(url, cancel_token):
+        return deadline.timeout()
+
+    result, error = forwarder.call([PRIMARY], attempt, 'test', deadline=deadline)
+    assert isinstance(error, DeadlineExceeded)
+    assert forwarder.endpoint(PRIMARY).failures == 0
+
+
+def test_all_circuits_open():
+    forwarder = FallbackForwarder(hedged=False)
+    for url in (PRIMARY, FALLBACK):
+        open_circuit(forwarder.endpoint(url))
+    result, error = forwarder.call([PRIMARY, FALLBACK], lambda url, token: url, 'test')
+    assert result is None and isinstance(error, RuntimeError)
+
+
+def test_client_errors_do_not_open_the_breaker():
+    from urllib.error import HTTPError
+    forwarder = FallbackForwarder(hedged=False)
+
+    def attempt(url, cancel_token):
+        raise HTTPError(url, 404, 'Not Found', None, None)
+
+    for _ in range(hedging.CIRCUIT_FAILURE_THRESHOLD + 1):
+        result, error = forwarder.call([PRIMARY], attempt, 'test')
+        assert result is None and error.code == 404
+    state = forwarder.endpoint(PRIMARY)
+    assert state.state == EndpointState.CLOSED
+    assert state.failures == 0
+
+
+def test_server_errors_open_the_breaker():
+    from urllib.error import HTTPError
+    forwarder = FallbackForwarder(hedged=False)
+
+    def attempt(url, cancel_token):
+        raise HTTPError(url, 502, 'Bad Gateway', None, None)
+
+    for _ in range(hedging.CIRCUIT_FAILURE_THRESHOLD):
+        forwarder.call([PRIMARY], attempt, 'test')
+    assert forwarder.endpoint(PRIMARY).state == EndpointState.OPEN
+
+
+def test_async_client_errors_do_not_open_the_breaker():
+    import asyncio
+
+    class Rejected(Exception):
+        status = 422
+
+    forwarder = FallbackForwarder(hedged=False)
+
+    async def attempt(url):
+        raise Rejected()
+
+    for _ in range(hedging.CIRCUIT_FAILURE_THRESHOLD):
+        asyncio.run(forwarder.call_async([PRIMARY], attempt, 'test'))
+    assert forwarder.endpoint(PRIMARY).state == EndpointState.CLOSED
+
+
+def test_hedged_call_stops_at_the_deadline(clock, monkeypatch):
+    import deadline as deadline_module
+    monkeypatch.setattr(deadline_module, 'time', clock)
+    monkeypatch.setattr(hedging, 'HEDGE_MIN_DELAY', 0.01)
+    monkeypatch.setattr(hedging, 'HEDGE_DEFAULT_DELAY', 0.01)
+    forwarder = FallbackForwarder(hedged=True)
+    deadline = Deadline(5)
+    tried = []
+
+    def attempt(url, cancel_token):
+        tried.append(url)
+        clock.advance(6)
+        threading.Event().wait(0.1)
+        raise OSError('timed out')
+
+    try:
+        result, error = forwarder.call([PRIMARY, FALLBACK], attempt, 'test', deadline=deadline)
+    finally:
+        forwarder.shutdown()
+    assert result is None and isinstance(error, OSError)
+    assert tried == [PRIMARY]
+    assert forwarder.hedges_fired == 0
+
+
+def test_hedge_timer_starts_when_the_primary_runs(monkeypatch):
+    monkeypatch.setenv('HEDGE_WORKERS', '1')
+    monkeypatch.setattr(hedging, 'HEDGE_MIN_DELAY', 0.05)
+    monkeypatch.setattr(hedging, 'HEDGE_DEFAULT_DELAY', 0.05)
+    forwarder = FallbackForwarder(hedged=True)
+    # Another request holds the only hedge worker for longer than the hedge delay
+    busy = forwarder.get_executor().submit(threading.Event().wait, 0.3)
+    try:
+        assert forwarder.call([PRIMARY, FALLBACK], lambda url, token: url, 'test') == (PRIMARY, None)
+    finally:
+        busy.result()
+        forwarder.shutdown()
+    assert forwarder.hedges_fired == 0
+
+
+def test_deadline_passing_in_the_worker_queue_sends_nothing(monkeypatch):
+    monkeypatch.setenv('HEDGE_WORKERS', '1')
+    forwarder = FallbackForwarder(hedged=True)
+    busy = forwarder.get_executor().submit(threading.Event().wait, 0.3)
+    tried = []
+    try:
+        result, error = forwarder.call([PRIMARY, FALLBACK], lambda url, token: tried.append(url), 'test',
+                                       deadline=Deadline(0.05))
+        busy.result()
+    finally:
+        forwarder.shutdown()
+    assert result is None and isinstance(error, DeadlineExceeded)
+    assert tried == []
+    assert forwarder.endpoint(PRIMARY).allow()
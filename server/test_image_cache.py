@@ -0,0 +1,130 @@
+import base64
+import io
+import os
+
+import pytest
+
+from image_cache import ImageCache
+from image_processing import PIL_AVAILABLE, ImagePreprocessor
+from multipart import MultipartPart
+
+PHOTO = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 16
+
+
+def upload(data=PHOTO, filename='arm.png', content_type='image/png'):
+    part = MultipartPart({}, {'name': 'photo_0', 'filename': filename}, 1024, None)
+    part.content_type = content_type
+    part.file = io.BytesIO(data)
+    part.size = len(data)
+    return part
+
+
+def test_lru_evicts_by_entries_and_bytes():
+    cache = ImageCache(max_bytes=10, max_entries=2)
+    cache.put('a', ('image/png', '', b'1234'))
+    cache.put('b', ('image/png', '', b'1234'))
+    assert cache.get('a') is not None
+    cache.put('c', ('image/png', '', b'1234'))
+    assert cache.get('b') is None
+    cache.put('d', ('image/png', '', b'12345678'))
+    assert cache.stats()['entries'] == 1
+    assert cache.stats()['evictions'] == 3
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    cache = ImageCache(max_bytes=0, disk_dir=str(tmp_path))
+    cache.put('k', ('image/webp', '.webp', b'QUJD'))
+    cache.put('o', ('image/png', '', b'REVG'))
+    restarted = ImageCache(max_bytes=1024, disk_dir=str(tmp_path))
+    assert restarted.get('k') == ('image/webp', '.webp', b'QUJD')
+    assert restarted.get('o') == ('image/png', '', b'REVG')
+    assert restarted.stats()['disk_hits'] == 2
+    assert restarted.stats()['disk_bytes'] == cache.stats()['disk_bytes']
+
+
+def test_disk_total_is_kept_without_listing(tmp_path, monkeypatch):
+    cache = ImageCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    monkeypatch.setattr(cache, '_disk_entries', lambda: pytest.fail('listed the disk tier under budget'))
+    cache.put('a', ('image/png', '', b'x' * 100))
+    cache.put('a', ('image/png', '', b'x' * 50))
+    assert cache.stats()['disk_bytes'] == os.path.getsize(tmp_path / 'a')
+
+
+def test_disk_tier_is_trimmed_oldest_first(tmp_path):
+    cache = ImageCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=250)
+    for index, key in enumerate('abc'):
+        cache.put(key, ('image/png', '', b'x' * 100))
+        os.utime(tmp_path / key, (index, index))
+    cache.put('d', ('image/png', '', b'x' * 100))
+    assert sorted(os.listdir(tmp_path)) == ['c', 'd']
+    assert cache.stats()['disk_bytes'] <= 250
+
+
+def test_hit_reuses_the_encoded_payload_without_preprocessing():
+    cache = ImageCache(max_bytes=1 << 20)
+    preprocessor = ImagePreprocessor(workers=0, enabled=False, cache=cache)
+    first = upload()
+    preprocessor.process([first])
+    assert first.encoded == base64.b64encode(PHOTO)
+
+    second = upload()
+    preprocessor.process([second])
+    assert cache.stats()['hits'] == 1
+    assert second.encoded is first.encoded
+    assert second.size == len(PHOTO)
+
+
+def test_hit_skips_the_base64_pass(monkeypatch):
+    cache = ImageCache(max_bytes=1 << 20)
+    preprocessor = ImagePreprocessor(workers=0, enabled=False, cache=cache)
+    preprocessor.process([upload()])
+    monkeypatch.setattr(base64, 'b64encode', lambda data: pytest.fail('re-encoded a cached image'))
+    part = upload()
+    preprocessor.process([part])
+    assert part.encoded == cache.get(next(iter(cache.entries)))[2]
+
+
+def test_non_images_are_left_alone():
+    preprocessor = ImagePreprocessor(workers=0, enabled=False, cache=ImageCache(max_bytes=1 << 20))
+    part = upload(b'%PDF-1.4', 'brief.pdf', 'application/pdf')
+    assert preprocessor.process([part]) == (0, 0)
+    assert part.encoded is None
+
+
+def test_nothing_to_do_without_cache_or_preprocessing():
+    preprocessor = ImagePreprocessor(workers=0, enabled=False, cache=ImageCache(max_bytes=0))
+    part = upload()
+    assert preprocessor.process([part]) == (0, 0)
+    assert part.encoded is None
+
+
+@pytest.mark.skipif(not PIL_AVAILABLE, reason='Pillow not installed')
+def test_processed_result_is_cached_with_its_type():
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (3000, 2000), (200, 30, 30)).save(buffer, 'PNG')
+    cache = ImageCache(max_bytes=1 << 20)
+    preprocessor = ImagePreprocessor(workers=0, enabled=True, cache=cache)
+
+    first = upload(buffer.getvalue(), 'sleeve.png')
+    preprocessor.process([first])
+    second = upload(buffer.getvalue(), 'sleeve.png')
+    preprocessor.process([second])
+
+    assert cache.stats()['hits'] == 1
+    assert second.encoded == first.encoded
+    assert (second.content_type, second.filename) == (first.content_type, first.filename)
+    assert second.filename != 'sleeve.png'
+    assert second.size == len(base64.b64decode(second.encoded))
+
+
+def test_async_lookup_matches_the_threaded_path():
+    import asyncio
+    cache = ImageCache(max_bytes=1 << 20)
+    preprocessor = ImagePreprocessor(workers=0, enabled=False, cache=cache)
+    part = upload()
+    asyncio.run(preprocessor.process_async([part]))
+    again = upload()
+    asyncio.run(preprocessor.process_async([again]))
+    assert again.encoded == part.encoded == base64.b64encode(PHOTO)
+    assert cache.stats()['hits'] == 1
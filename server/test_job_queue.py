@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+import job_queue
+from conftest import chat_message, exchange, request
+from job_queue import DONE, FAILED, ChatJobQueue, QueueFull, wants_async
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    queue = ChatJobQueue(path=str(tmp_path / 'jobs.sqlite3'), workers=1, max_attempts=2, retry_seconds=0,
+                         max_queued=3)
+    queue.open()
+    yield queue
+    queue.stop()
+
+
+@pytest.mark.parametrize('prefer, query, expected', [
+    ('respond-async, wait=10', '', True),
+    ('', 'async=1', True),
+    ('', 'lang=he&async=true', True),
+    ('return=minimal', 'async=0', False),
+    (None, None, False),
+])
+def test_wants_async(prefer, query, expected):
+    assert wants_async(prefer, query) == expected
+
+
+def test_job_is_answered_by_a_worker(jobs):
+    jobs.start(lambda body, content_type: b'{"output": "' + body + b'"}')
+    job_id = jobs.submit(b'hi', 'application/json', 'chat_1')
+    job = jobs.wait(job_id, 5)
+    assert job['status'] == DONE
+    assert job['result'] == b'{"output": "hi"}'
+    assert jobs.stats()['completed'] == 1
+
+
+def test_failed_job_is_retried_then_given_up(jobs):
+    calls = []
+    jobs.start(lambda body, content_type: calls.append(body))
+    job_id = jobs.submit(b'hi', 'application/json')
+    job = jobs.wait(job_id, 5)
+    assert job['status'] == FAILED and job['attempts'] == 2
+    assert calls == [b'hi', b'hi']
+    assert jobs.stats()['retries'] == 1
+
+
+def test_full_queue_refuses_jobs(jobs):
+    for _ in range(3):
+        jobs.submit(b'hi', 'application/json')
+    with pytest.raises(QueueFull):
+        jobs.submit(b'hi', 'application/json')
+
+
+def test_one_job_per_session_at_a_time(jobs):
+    first = jobs.submit(b'1', 'application/json', 'chat_a')
+    jobs.submit(b'2', 'application/json', 'chat_a')
+    other = jobs.submit(b'3', 'application/json', 'chat_b')
+    assert jobs.claim()[0] == first
+    assert jobs.claim()[0] == other
+    assert jobs.claim() is None
+
+
+def test_expired_lease_is_claimed_again(jobs):
+    jobs.lease_seconds = 0
+    job_id = jobs.submit(b'1', 'application/json')
+    assert jobs.claim()[::3] == (job_id, 1)
+    assert jobs.claim()[::3] == (job_id, 2)
+
+
+def test_stats_use_the_workers_counts(jobs, monkeypatch):
+    jobs.submit(b'1', 'application/json', 'chat_a')
+    jobs.submit(b'2', 'application/json', 'chat_b')
+    jobs.claim()
+    jobs.refresh_counts(force=True)
+    monkeypatch.setattr(jobs, 'execute', lambda *args: pytest.fail('stats() queried the database'))
+    stats = jobs.stats()
+    assert (stats['queued'], stats['in_progress'], stats['done']) == (1, 1, 0)
+
+
+def test_counts_are_refreshed_at_most_every_interval(jobs, clock, monkeypatch):
+    monkeypatch.setattr(job_queue, 'time', clock)
+    jobs.refresh_counts(force=True)
+    jobs.submit(b'1', 'application/json')
+    jobs.refresh_counts()
+    assert jobs.stats()['queued'] == 0
+    clock.advance(job_queue.COUNTS_INTERVAL)
+    jobs.refresh_counts()
+    assert jobs.stats()['queued'] == 1
+
+
+def test_async_request_is_answered_through_the_job(engine_server, fake_n8n, proxy, jobs, monkeypatch):
+    monkeypatch.setattr(proxy, 'CHAT_JOBS_ENABLED', True)
+    monkeypatch.setattr(proxy, 'chat_jobs', jobs)
+    jobs.start(lambda body, content_type: proxy.forward_to_n8n(body, content_type, 'chat job'))
+
+    status, headers, body = exchange(engine_server, request(
+        'POST', '/api/chat?async=1', chat_message(), headers=[('Content-Type', 'application/json')]))
+    assert status == 202
+    accepted = json.loads(body)
+    assert headers['location'] == accepted['statusUrl']
+
+    status, headers, body = exchange(engine_server, request('GET', accepted['statusUrl'] + '?wait=5'))
+    assert status == 200 and headers['x-job-status'] == DONE
+    assert json.loads(body) == {'output': 'hi'}
+    assert jobs.stats()['completed'] == 1
@@ -0,0 +1,119 @@
+import json
+import socket
+import time
+
+import pytest
+
+from conftest import chat_message
+
+
+@pytest.fixture
+def connection(threaded_server):
+    sock = socket.create_connection(('127.0.0.1', threaded_server), timeout=5)
+    yield sock, sock.makefile('rb')
+    sock.close()
+
+
+def send(sock, method, path, body=b'', version='HTTP/1.1', headers=()):
+    lines = [f'{method} {path} {version}', 'Host: localhost']
+    if body or method == 'POST':
+        lines.append(f'Content-Length: {len(body)}')
+    lines += [f'{name}: {value}' for name, value in headers]
+    sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+
+def read_response(stream):
+    """(status, headers, body) of one Content-Length response on a persistent connection"""
+    status_line = stream.readline()
+    if not status_line:
+        return None
+    headers = {}
+    while True:
+        line = stream.readline().decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return int(status_line.split()[1]), headers, stream.read(int(headers.get('content-length', 0)))
+
+
+def test_requests_share_one_connection(connection):
+    sock, stream = connection
+    for _ in range(3):
+        send(sock, 'GET', '/api/health/live')
+        status, headers, _body = read_response(stream)
+        assert status == 200
+        assert headers['keep-alive'].startswith('timeout=')
+        assert 'connection' not in headers
+
+
+def test_pipelined_requests_are_answered_in_order(connection):
+    sock, stream = connection
+    send(sock, 'GET', '/api/health/live')
+    send(sock, 'GET', '/missing.css')
+    assert read_response(stream)[0] == 200
+    assert read_response(stream)[0] == 404
+
+
+def test_connection_close_is_honoured(connection):
+    sock, stream = connection
+    send(sock, 'GET', '/api/health/live', headers=[('Connection', 'close')])
+    _status, headers, _body = read_response(stream)
+    assert headers['connection'] == 'close'
+    assert stream.read() == b''
+
+
+def test_http_10_keep_alive_is_answered_in_kind(connection):
+    sock, stream = connection
+    send(sock, 'GET', '/api/health/live', version='HTTP/1.0', headers=[('Connection', 'keep-alive')])
+    _status, headers, _body = read_response(stream)
+    assert headers['connection'] == 'keep-alive'
+    send(sock, 'GET', '/api/health/live', version='HTTP/1.0')
+    _status, headers, _body = read_response(stream)
+    assert headers['connection'] == 'close'
+
+
+def test_connection_closes_after_max_requests(proxy, connection, monkeypatch):
+    monkeypatch.setattr(proxy, 'KEEPALIVE_MAX_REQUESTS', 2)
+    sock, stream = connection
+    send(sock, 'GET', '/api/health/live')
+    assert 'connection' not in read_response(stream)[1]
+    send(sock, 'GET', '/api/health/live')
+    assert read_response(stream)[1]['connection'] == 'close'
+    assert stream.read() == b''
+
+
+def test_idle_connection_is_closed(proxy, connection, monkeypatch):
+    monkeypatch.setattr(proxy, 'KEEPALIVE_TIMEOUT', 0.2)
+    sock, stream = connection
+    send(sock, 'GET', '/api/health/live')
+    read_response(stream)
+    started = time.monotonic()
+    assert stream.read() == b''
+    assert time.monotonic() - started < 3
+
+
+def test_small_unread_body_is_drained(connection):
+    sock, stream = connection
+    send(sock, 'POST', '/api/unknown', b'x' * 1000)
+    status, headers, _body = read_response(stream)
+    assert status == 404 and 'connection' not in headers
+    send(sock, 'GET', '/api/health/live')
+    assert read_response(stream)[0] == 200
+
+
+def test_large_unread_body_closes_the_connection(proxy, connection):
+    sock, stream = connection
+    size = proxy.KEEPALIVE_DRAIN_LIMIT + 1
+    send(sock, 'POST', '/api/unknown', b'x' * size)
+    status, headers, _body = read_response(stream)
+    assert status == 404 and headers['connection'] == 'close'
+
+
+def test_chat_then_health_on_one_connection(fake_n8n, connection):
+    sock, stream = connection
+    send(sock, 'POST', '/api/chat', chat_message(), headers=[('Content-Type', 'application/json')])
+    status, _headers, body = read_response(stream)
+    assert status == 200 and json.loads(body) == {'output': 'hi'}
+    send(sock, 'GET', '/api/health/live')
+    assert read_response(stream)[0] == 200
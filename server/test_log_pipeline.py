@@ -0,0 +1,113 @@
+import json
+import logging
+import queue
+import sys
+
+import pytest
+
+from log_pipeline import (REQUEST_LOGGER, JSONFormatter, LogPipeline, NonBlockingQueueHandler, SamplingFilter,
+                          parse_sample_rates)
+
+
+def make_record(level=logging.INFO, name=REQUEST_LOGGER, msg='hello %s', args=('world',), **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    """A pipeline writing to a temporary file; the root logger is restored afterwards"""
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    pipeline = LogPipeline()
+    yield lambda **kwargs: pipeline.configure(**dict({'path': str(tmp_path / 'proxy.log'), 'console': False,
+                                                      'sample_rates': '', 'level': 'INFO'}, **kwargs))
+    pipeline.stop()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+    if pipeline.file_handler:
+        pipeline.file_handler.close()
+
+
+def test_parse_sample_rates():
+    assert parse_sample_rates('INFO=0.1, debug=0.01,') == {logging.INFO: 0.1, logging.DEBUG: 0.01}
+    assert parse_sample_rates('') == {}
+
+
+def test_json_formatter_adds_extra_fields_and_traceback():
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        record = make_record(level=logging.ERROR, session='chat_1', status=502)
+        record.exc_info = sys.exc_info()
+    document = json.loads(JSONFormatter().format(record))
+    assert document['msg'] == 'hello world'
+    assert document['level'] == 'ERROR'
+    assert document['logger'] == REQUEST_LOGGER
+    assert document['session'] == 'chat_1' and document['status'] == 502
+    assert 'ValueError: boom' in document['exc']
+
+
+def test_json_formatter_keeps_hebrew_readable():
+    assert 'שלום' in JSONFormatter().format(make_record(msg='שלום', args=()))
+
+
+def test_sampling_thins_only_request_info_and_debug(monkeypatch):
+    sampler = SamplingFilter({logging.INFO: 0.25, logging.WARNING: 0.25})
+    monkeypatch.setattr('log_pipeline.random.random', lambda: 0.5)
+    assert not sampler.filter(make_record())
+    assert sampler.filter(make_record(level=logging.WARNING))
+    assert sampler.filter(make_record(name='proxy_server'))
+    assert sampler.filter(make_record(level=logging.DEBUG))
+    monkeypatch.setattr('log_pipeline.random.random', lambda: 0.1)
+    assert sampler.filter(make_record())
+    assert sampler.sampled_out == 1
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = NonBlockingQueueHandler(queue.Queue(2))
+    record = make_record(args=({'live': 'object'},))
+    for _ in range(5):
+        handler.handle(record)
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+    # Enqueued as is: formatting is left to the writer thread
+    assert handler.queue.get_nowait() is record and record.args == {'live': 'object'}
+
+
+def test_records_reach_the_file_as_json(pipeline, tmp_path):
+    pipeline()
+    logging.getLogger(REQUEST_LOGGER).info('chat from %s', '10.0.0.1', extra={'bytes': 12})
+    logging.getLogger(REQUEST_LOGGER).debug('not at INFO')
+    logging.getLogger('proxy_server').warning('slow upstream')
+    logging.getLogger().handlers[0].close()
+
+    lines = [json.loads(line) for line in (tmp_path / 'proxy.log').read_text(encoding='utf-8').splitlines()]
+    assert [(line['level'], line['msg']) for line in lines] == [('INFO', 'chat from 10.0.0.1'),
+                                                                 ('WARNING', 'slow upstream')]
+    assert lines[0]['bytes'] == 12
+
+
+def test_text_format_and_sampling(pipeline, tmp_path):
+    pipeline(file_format='text', sample_rates='INFO=0')
+    for _ in range(3):
+        logging.getLogger(REQUEST_LOGGER).info('sampled away')
+    logging.getLogger('proxy_server').info('kept')
+    logging.getLogger().handlers[0].close()
+
+    text = (tmp_path / 'proxy.log').read_text(encoding='utf-8')
+    assert ' - INFO - kept' in text and 'sampled away' not in text
+
+
+def test_stats(pipeline, tmp_path):
+    assert LogPipeline().stats() == {'enabled': False}
+    logs = pipeline(queue_size=4)
+    logging.getLogger(REQUEST_LOGGER).info('one')
+    stats = logs.stats()
+    assert stats['enabled'] is True
+    assert stats['file'] == str(tmp_path / 'proxy.log')
+    assert stats['dropped'] == 0 and stats['sampled_out'] == 0
@@ -0,0 +1,109 @@
+import io
+import threading
+
+import pytest
+
+from conftest import chat_message, exchange, request
+from metrics import Counter, Gauge, Histogram, MetricsRegistry, TimedReader, route_for
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram('t_seconds', 'Test.', ('route',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe(value, 'chat')
+    assert histogram.render() == [
+        '# HELP t_seconds Test.',
+        '# TYPE t_seconds histogram',
+        't_seconds_bucket{route="chat",le="0.1"} 1',
+        't_seconds_bucket{route="chat",le="1.0"} 3',
+        't_seconds_bucket{route="chat",le="+Inf"} 4',
+        't_seconds_sum{route="chat"} 4.05',
+        't_seconds_count{route="chat"} 4',
+    ]
+
+
+def test_shards_are_merged():
+    counter = Counter('t_total', 'Test.', ('route',))
+    histogram = Histogram('t_seconds', 'Test.', ())
+
+    def record():
+        for _ in range(100):
+            counter.inc('chat')
+            histogram.observe(0.002)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.snapshot() == {('chat',): 800}
+    counts, _total = histogram.snapshot()[()]
+    assert sum(counts) == 800
+
+
+def test_label_values_are_escaped():
+    counter = Counter('t_total', 'Test.', ('endpoint',))
+    counter.inc('a"b\\c\nd')
+    assert counter.render()[-1] == 't_total{endpoint="a\\"b\\\\c\\nd"} 1'
+
+
+def test_gauge_reads_its_callback():
+    gauge = Gauge('t_depth', 'Test.', ('lane',), lambda: {('chat',): 3, ('static',): 0.5})
+    assert gauge.render()[2:] == ['t_depth{lane="chat"} 3', 't_depth{lane="static"} 0.5']
+
+
+def test_disabled_metrics_record_nothing(monkeypatch):
+    import metrics as metrics_module
+    monkeypatch.setattr(metrics_module, 'METRICS_ENABLED', False)
+    counter = Counter('t_total', 'Test.', ())
+    counter.inc()
+    assert counter.snapshot() == {}
+
+
+def test_timed_reader_adds_up_read_time(clock, monkeypatch):
+    import metrics as metrics_module
+    monkeypatch.setattr(metrics_module, 'time', clock)
+
+    class Slow(io.BytesIO):
+        def read(self, size=-1):
+            clock.advance(0.25)
+            return super().read(size)
+
+    reader = TimedReader(Slow(b'abcdef'))
+    assert reader.read(3) + reader.read() == b'abcdef'
+    assert reader.seconds == 0.5
+
+
+@pytest.mark.parametrize('path, route', [
+    ('/api/chat', 'chat'),
+    ('/api/chat/stream?x=1', 'chat'),
+    ('/api/chat/jobs/abc', 'chat_jobs'),
+    ('/api/health/ready', 'health/ready'),
+    ('/api/metrics', 'metrics'),
+    ('/api/unknown', 'api_other'),
+    ('/assets/app.js', 'static'),
+])
+def test_route_labels(path, route):
+    assert route_for(path) == route
+
+
+def test_registry_renders_every_collector():
+    registry = MetricsRegistry()
+    registry.observe_request('chat', 200, 0.3)
+    registry.register(Gauge('t_depth', 'Test.', (), lambda: {(): 1}))
+    text = registry.render().decode('utf-8')
+    assert 'inkflow_responses_total{route="chat",status="200"} 1' in text
+    assert 'inkflow_request_duration_seconds_count{route="chat"} 1' in text
+    assert text.endswith('t_depth 1\n')
+
+
+def test_scrape_counts_the_chat_request(engine_server, fake_n8n, proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'metrics', MetricsRegistry())
+    exchange(engine_server, request('POST', '/api/chat', chat_message(),
+                                    headers=[('Content-Type', 'application/json')]))
+    status, headers, body = exchange(engine_server, request('GET', '/api/metrics'))
+    assert status == 200
+    assert headers['content-type'].startswith('text/plain; version=0.0.4')
+    text = body.decode('utf-8')
+    assert 'inkflow_responses_total{route="chat",status="200"} 1' in text
+    assert 'inkflow_request_phase_seconds_count{route="chat",phase="upstream"} 1' in text
@@ -0,0 +1,159 @@
+import io
+
+import pytest
+
+from conftest import exchange
+from multipart import (MultipartError, MultipartParser, PartRejected, UploadLimits, iter_multipart,
+                       parse_boundary, sniff_type)
+
+BOUNDARY = b'----InkFlowTestBoundary'
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 4
+JPEG = b'\xff\xd8\xff\xe0' + b'\x00\x10JFIF' + b'\xab' * 300
+
+
+def build_body(fields=(), files=(), preamble=b'', epilogue=b''):
+    """multipart/form-data body from (name, value) fields and (name, filename, content_type, data) files"""
+    body = bytearray(preamble)
+    for name, value in fields:
+        body += b'--' + BOUNDARY + b'\r\n'
+        body += f'Content-Disposition: form-data; name="{name}"\r\n\r\n'.encode()
+        body += value.encode('utf-8') + b'\r\n'
+    for name, filename, content_type, data in files:
+        body += b'--' + BOUNDARY + b'\r\n'
+        body += f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'.encode()
+        body += f'Content-Type: {content_type}\r\n\r\n'.encode()
+        body += data + b'\r\n'
+    body += b'--' + BOUNDARY + b'--\r\n' + epilogue
+    return bytes(body)
+
+
+def parse_chunks(chunks, limits=None):
+    parser = MultipartParser(BOUNDARY, spool_size=128, limits=limits)
+    parts = []
+    for chunk in chunks:
+        parts.extend(parser.feed(chunk))
+    parser.close()
+    return parts
+
+
+def summarize(parts):
+    return [(part.name, part.filename, part.content_type,
+             part.file.read() if part.is_file else part.text()) for part in parts]
+
+
+SAMPLE = build_body(fields=[('chatInput', 'שלום, מה המחיר?'), ('sessionId', 'chat_abc')],
+                    files=[('photo_0', 'arm.png', 'image/png', PNG)])
+EXPECTED = [
+    ('chatInput', None, 'text/plain', 'שלום, מה המחיר?'),
+    ('sessionId', None, 'text/plain', 'chat_abc'),
+    ('photo_0', 'arm.png', 'image/png', PNG),
+]
+
+
+def test_parses_fields_and_files_in_one_chunk():
+    assert summarize(parse_chunks([SAMPLE])) == EXPECTED
+
+
+def test_boundary_split_anywhere_across_two_chunks():
+    for split in range(1, len(SAMPLE)):
+        assert summarize(parse_chunks([SAMPLE[:split], SAMPLE[split:]])) == EXPECTED, split
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 31, 64, 1000])
+def test_small_chunks(size):
+    chunks = [SAMPLE[i:i + size] for i in range(0, len(SAMPLE), size)]
+    assert summarize(parse_chunks(chunks)) == EXPECTED
+
+
+def test_file_content_resembling_a_boundary_is_kept():
+    data = b'\x89PNG\r\n\x1a\n' + b'\r\n--' + BOUNDARY[:-1] + b'x\r\n--' + b'tail'
+    body = build_body(files=[('photo_0', 'a.png', 'image/png', data)])
+    parts = parse_chunks([body[i:i + 5] for i in range(0, len(body), 5)])
+    assert parts[0].file.read() == data
+
+
+def test_preamble_and_epilogue_are_ignored():
+    body = build_body(fields=[('chatInput', 'hi')], preamble=b'ignore me\r\n', epilogue=b'trailing junk')
+    assert summarize(parse_chunks([body])) == [('chatInput', None, 'text/plain', 'hi')]
+
+
+def test_truncated_body_raises_on_close():
+    parser = MultipartParser(BOUNDARY)
+    parser.feed(SAMPLE[:len(SAMPLE) // 2])
+    with pytest.raises(MultipartError):
+        parser.close()
+
+
+def test_oversized_part_headers_are_rejected():
+    body = b'--' + BOUNDARY + b'\r\nX-Filler: ' + b'a' * (20 * 1024)
+    with pytest.raises(MultipartError):
+        MultipartParser(BOUNDARY).feed(body)
+
+
+def test_too_many_files():
+    body = build_body(files=[('photo_%d' % i, 'p%d.png' % i, 'image/png', PNG) for i in range(3)])
+    with pytest.raises(PartRejected) as caught:
+        parse_chunks([body], limits=UploadLimits(max_files=2, max_file_size=10 ** 6))
+    assert caught.value.status == 413
+
+
+def test_file_over_size_cap_is_rejected_while_streaming():
+    body = build_body(files=[('photo_0', 'big.png', 'image/png', PNG)])
+    with pytest.raises(PartRejected) as caught:
+        parse_chunks([body], limits=UploadLimits(max_files=5, max_file_size=100))
+    assert caught.value.status == 413
+
+
+def test_type_is_sniffed_not_declared():
+    body = build_body(files=[('photo_0', 'photo.png', 'image/png', JPEG)])
+    parts = parse_chunks([body], limits=UploadLimits(max_files=5, max_file_size=10 ** 6))
+    assert parts[0].content_type == 'image/jpeg'
+
+
+def test_disallowed_type_is_rejected():
+    body = build_body(files=[('photo_0', 'evil.png', 'image/png', b'<html><script>alert(1)</script>')])
+    with pytest.raises(PartRejected) as caught:
+        parse_chunks([body], limits=UploadLimits(max_files=5, max_file_size=10 ** 6))
+    assert caught.value.status == 415
+
+
+def test_iter_multipart_stops_at_content_length():
+    stream = io.BytesIO(SAMPLE + b'next request on the same socket')
+    parts = list(iter_multipart(stream, BOUNDARY, content_length=len(SAMPLE), chunk_size=17))
+    assert summarize(parts) == EXPECTED
+    assert stream.read() == b'next request on the same socket'
+
+
+@pytest.mark.parametrize('content_type, boundary', [
+    ('multipart/form-data; boundary=abc123', b'abc123'),
+    ('multipart/form-data; charset=utf-8; boundary="quoted boundary"', b'quoted boundary'),
+])
+def test_parse_boundary(content_type, boundary):
+    assert parse_boundary(content_type) == boundary
+
+
+def test_parse_boundary_missing():
+    with pytest.raises(MultipartError):
+        parse_boundary('multipart/form-data')
+
+
+@pytest.mark.parametrize('head, mime_type', [
+    (PNG[:16], 'image/png'),
+    (JPEG[:16], 'image/jpeg'),
+    (b'GIF89a' + b'\x00' * 10, 'image/gif'),
+    (b'RIFF\x00\x00\x00\x00WEBPVP8 ', 'image/webp'),
+    (b'\x00\x00\x00\x1cftypheic\x00\x00\x00\x00', 'image/heic'),
+    (b'%PDF-1.7' + b'\x00' * 8, None),
+])
+def test_sniff_type(head, mime_type):
+    assert sniff_type(head) == mime_type
+
+
+def test_servers_refuse_a_disguised_upload(engine_server):
+    body = build_body(fields=[('sessionId', 'chat_upload')],
+                      files=[('photo_0', 'evil.png', 'image/png', b'<html><script>alert(1)</script>')])
+    raw = (b'POST /api/chat HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+           b'Content-Type: multipart/form-data; boundary=' + BOUNDARY + b'\r\n'
+           b'Content-Length: %d\r\n\r\n' % len(body)) + body
+    status, _headers, _body = exchange(engine_server, raw)
+    assert status == 415
@@ -0,0 +1,83 @@
+import json
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import prefork
+from prefork import Supervisor, WorkerStats
+
+
+def test_snapshot_aggregates_worker_files(tmp_path):
+    stats = WorkerStats(str(tmp_path))
+    stats.collect = lambda: {'requests': 5, 'uptime': 10, 'engine': 'threaded'}
+    (tmp_path / '111.json').write_text(json.dumps({'pid': 111, 'requests': 7, 'uptime': 99, 'updated': 1}))
+    (tmp_path / '222.json').write_text('{not json')
+    (tmp_path / '333.json.tmp').write_text('{}')
+
+    snapshot = stats.snapshot()
+    assert snapshot['count'] == 2
+    assert snapshot['totals'] == {'requests': 12}
+    assert sorted(worker['pid'] for worker in snapshot['per_worker']) == sorted([111, os.getpid()])
+
+
+def test_disabled_outside_prefork():
+    stats = WorkerStats()
+    stats.start(lambda: {'requests': 1})
+    assert stats.thread is None
+    assert stats.snapshot() is None
+
+
+def test_publisher_thread_stops(tmp_path):
+    stats = WorkerStats(str(tmp_path))
+    stats.start(lambda: {'requests': 1}, interval=0.01)
+    own = tmp_path / f'{os.getpid()}.json'
+    for _ in range(500):
+        if own.exists():
+            break
+        time.sleep(0.01)
+    stats.stop()
+    stats.thread.join(5)
+    assert json.loads(own.read_text())['requests'] == 1
+
+
+@pytest.fixture
+def supervisor_process(monkeypatch):
+    """Restores what Supervisor.run() changes in this process"""
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    monkeypatch.setattr(prefork.worker_stats, 'directory', '')
+    monkeypatch.setattr(prefork, 'MIN_WORKER_LIFETIME', 0)
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+@pytest.mark.skipif(not prefork.prefork_supported(), reason='needs fork() and SO_REUSEPORT')
+def test_supervisor_restarts_a_dead_worker_and_drains(tmp_path, supervisor_process):
+    def run_worker():
+        if not (tmp_path / 'crashed').exists():
+            (tmp_path / 'crashed').touch()
+            return 3
+        (tmp_path / f'worker-{os.getpid()}').touch()
+        # Inherited stats directory, published like serve() does
+        assert prefork.worker_stats.enabled
+        while True:
+            time.sleep(0.05)
+
+    supervisor = Supervisor(1, run_worker, drain_seconds=1)
+
+    def stop_when_running():
+        for _ in range(500):
+            if any(path.name.startswith('worker-') for path in tmp_path.iterdir()):
+                break
+            time.sleep(0.01)
+        supervisor.stop()
+
+    threading.Thread(target=stop_when_running, daemon=True).start()
+    assert supervisor.run() == 0
+    assert (tmp_path / 'crashed').exists()
+    assert len([path for path in tmp_path.iterdir() if path.name.startswith('worker-')]) == 1
+    assert supervisor.workers == {}
+    assert not os.path.exists(supervisor.stats_dir)
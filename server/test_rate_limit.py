@@ -0,0 +1,137 @@
+import pytest
+
+import rate_limit
+from conftest import chat_message, exchange, request
+from rate_limit import RateLimiter, TokenBuckets
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(rate_limit, 'time', clock)
+
+
+def test_burst_then_limited():
+    buckets = TokenBuckets(burst=3, per_minute=60)
+    assert [buckets.take('1.2.3.4') for _ in range(3)] == [0, 0, 0]
+    assert buckets.take('1.2.3.4') == pytest.approx(1.0)
+    assert buckets.limited == 1
+    # Other keys have their own bucket
+    assert buckets.take('5.6.7.8') == 0
+
+
+def test_refill_over_time(clock):
+    buckets = TokenBuckets(burst=2, per_minute=30)
+    buckets.take('k')
+    buckets.take('k')
+    assert buckets.take('k') == pytest.approx(2.0)
+    clock.advance(1)
+    assert buckets.take('k') == pytest.approx(1.0)
+    clock.advance(1)
+    assert buckets.take('k') == 0
+
+
+def test_refill_is_capped_at_burst(clock):
+    buckets = TokenBuckets(burst=2, per_minute=60)
+    buckets.take('k')
+    clock.advance(1)
+    buckets.take('other')
+    clock.advance(0.5)
+    assert [buckets.take('k') for _ in range(2)] == [0, 0]
+    assert buckets.take('k') > 0
+
+
+def test_full_idle_buckets_are_evicted(clock):
+    buckets = TokenBuckets(burst=2, per_minute=60)
+    buckets.take('old')
+    clock.advance(2)
+    buckets.take('new')
+    assert list(buckets.buckets) == ['new']
+    assert buckets.evicted == 1
+
+
+def test_max_keys_drops_least_recently_used():
+    buckets = TokenBuckets(burst=5, per_minute=1, max_keys=2)
+    for key in ('a', 'b', 'a', 'c'):
+        buckets.take(key)
+    assert list(buckets.buckets) == ['a', 'c']
+
+
+def test_zero_rate_disables_the_limit():
+    buckets = TokenBuckets(burst=0, per_minute=0)
+    assert all(buckets.take('k') == 0 for _ in range(100))
+
+
+def test_limiter_reports_scope_and_retry_after(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'RATE_LIMIT_ENABLED', True)
+    limiter = RateLimiter()
+    limiter.ip = TokenBuckets(burst=100, per_minute=100)
+    limiter.session = TokenBuckets(burst=1, per_minute=6)
+    assert limiter.check('1.2.3.4', 'chat_a') is None
+    assert limiter.check('1.2.3.4', 'chat_a') == ('session', 10)
+
+
+@pytest.mark.parametrize('session_id', ['', 'default', None, ['not', 'a', 'string']])
+def test_anonymous_sessions_share_no_bucket(monkeypatch, session_id):
+    monkeypatch.setattr(rate_limit, 'RATE_LIMIT_ENABLED', True)
+    limiter = RateLimiter()
+    limiter.session = TokenBuckets(burst=1, per_minute=1)
+    assert all(limiter.check(None, session_id) is None for _ in range(5))
+
+
+def test_disabled_limiter(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'RATE_LIMIT_ENABLED', False)
+    limiter = RateLimiter()
+    limiter.ip = TokenBuckets(burst=1, per_minute=1)
+    assert all(limiter.check('1.2.3.4') is None for _ in range(5))
+
+
+def limiter_with(ip_burst, session_burst):
+    limiter = RateLimiter()
+    limiter.ip = TokenBuckets(burst=ip_burst, per_minute=1)
+    limiter.session = TokenBuckets(burst=session_burst, per_minute=1)
+    return limiter
+
+
+def test_session_refusal_refunds_the_ip_token(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'RATE_LIMIT_ENABLED', True)
+    limiter = limiter_with(ip_burst=3, session_burst=1)
+    assert limiter.check('1.2.3.4', 'chat_a') is None
+    for _ in range(5):
+        assert limiter.check('1.2.3.4', 'chat_a')[0] == 'session'
+    # Only the message that went through paid from the IP budget
+    assert limiter.check('1.2.3.4', 'chat_b') is None
+    assert limiter.check('1.2.3.4', 'chat_c') is None
+    assert limiter.check('1.2.3.4', 'chat_d')[0] == 'ip'
+    assert limiter.ip.allowed == 3
+
+
+def test_session_refusal_refunds_an_earlier_ip_check(monkeypatch):
+    """The IP is checked from the headers, the session only once the body is read"""
+    monkeypatch.setattr(rate_limit, 'RATE_LIMIT_ENABLED', True)
+    limiter = limiter_with(ip_burst=2, session_burst=1)
+    assert limiter.check('1.2.3.4') is None
+    assert limiter.check(session_id='chat_a', ip_taken='1.2.3.4') is None
+    for _ in range(3):
+        assert limiter.check('1.2.3.4') is None
+        assert limiter.check(session_id='chat_a', ip_taken='1.2.3.4')[0] == 'session'
+    assert limiter.ip.buckets['1.2.3.4'][0] == pytest.approx(1)
+
+
+def test_refund_never_exceeds_the_burst():
+    buckets = TokenBuckets(burst=2, per_minute=60)
+    buckets.take('k')
+    buckets.refund('k')
+    buckets.refund('k')
+    buckets.refund('missing')
+    assert buckets.buckets['k'][0] == 2
+    assert 'missing' not in buckets.buckets
+
+
+def test_session_limit_after_the_body_keeps_the_ip_budget(engine_server, fake_n8n, proxy, monkeypatch):
+    monkeypatch.setattr(rate_limit, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(proxy, 'rate_limiter', limiter_with(ip_burst=3, session_burst=1))
+    statuses = [exchange(engine_server, request('POST', '/api/chat', chat_message(session_id='chat_x'),
+                                                 headers=[('Content-Type', 'application/json')]))[0]
+                for _ in range(4)]
+    assert statuses == [200, 429, 429, 429]
+    assert proxy.rate_limiter.ip.buckets['127.0.0.1'][0] == pytest.approx(2)
@@ -0,0 +1,94 @@
+import json
+
+import pytest
+
+import response_cache as response_cache_module
+from conftest import chat_message, exchange, request
+from response_cache import ResponseCache, normalize_chat_input
+
+
+@pytest.fixture
+def cache(clock, monkeypatch):
+    monkeypatch.setattr(response_cache_module, 'time', clock)
+    return ResponseCache(enabled=True, ttl=60, max_entries=2, per_process=False)
+
+
+def test_normalize_drops_niqqud_punctuation_and_case():
+    assert normalize_chat_input('  שָׁלוֹם!!  ') == 'שלום'
+    assert normalize_chat_input('How   MUCH?') == 'how much'
+
+
+@pytest.mark.parametrize('payload', [
+    {'chatInput': 'כמה עולה קעקוע?', 'sessionId': 'chat_1'},
+    {'chatInput': 'Opening hours?'},
+    {'chatInput': 'hi', 'sessionId': 'chat_1', 'hasFiles': False, 'timestamp': '2024-01-01'},
+])
+def test_faq_messages_have_a_key(cache, payload):
+    assert cache.key_for(payload) is not None
+
+
+@pytest.mark.parametrize('payload', [
+    {'chatInput': 'I want a dragon on my back'},
+    {'chatInput': 'price', 'imageUrl': 'data:image/png;base64,AA=='},
+    {'chatInput': 'price', 'hasFiles': True},
+    {'chatInput': 'price', 'senderName': 'Dana'},
+    {'chatInput': 'price ' + 'x' * 200},
+    {'chatInput': 42},
+    'price',
+])
+def test_stateful_messages_bypass(cache, payload):
+    assert cache.key_for(payload) is None
+
+
+def test_same_question_shares_a_key(cache):
+    assert cache.key_for({'chatInput': 'Price?'}) == cache.key_for({'chatInput': 'price'})
+
+
+def test_session_with_history_bypasses(cache):
+    message = {'chatInput': 'price', 'sessionId': 'chat_1'}
+    cache.note_forwarded('chat_1')
+    assert cache.key_for(message) is None
+    assert cache.key_for({**message, 'sessionId': 'chat_2'}) is not None
+    assert cache.stats()['bypasses'] == 1
+
+
+def test_entries_expire(cache, clock):
+    cache.put('k', b'{"output": "100"}')
+    assert cache.get('k') == b'{"output": "100"}'
+    clock.advance(61)
+    assert cache.get('k') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_lru_eviction(cache):
+    cache.put('a', b'1')
+    cache.put('b', b'2')
+    cache.get('a')
+    cache.put('c', b'3')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_empty_answers_are_not_cached(cache):
+    cache.put('k', b'')
+    assert cache.get('k') is None
+
+
+def test_disabled_across_prefork_workers():
+    cache = ResponseCache(enabled=True, per_process=True)
+    assert not cache.enabled
+    assert cache.stateless_key({'chatInput': 'price'}) is None
+
+
+def test_faq_is_answered_from_the_cache(engine_server, fake_n8n, proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'response_cache', ResponseCache(enabled=True, per_process=False))
+    fake_n8n.chunks = [b'{"output": "from 300"}']
+    for session_id in ('chat_a', 'chat_b'):
+        status, _headers, body = exchange(engine_server, request(
+            'POST', '/api/chat', chat_message('כמה עולה?', session_id),
+            headers=[('Content-Type', 'application/json')]))
+        assert status == 200
+        assert json.loads(body) == {'output': 'from 300'}
+    assert len(fake_n8n.requests) == 1
+    assert proxy.response_cache.stats()['hits'] == 1
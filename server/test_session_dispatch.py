@@ -0,0 +1,177 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from session_dispatch import SessionDispatcher, SessionQueueFull, merge_messages, mergeable_message
+
+
+def message(text, session_id='chat_a', **extra):
+    return dict({'chatInput': text, 'sessionId': session_id}, **extra)
+
+
+def start(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.start()
+    return thread
+
+
+def wait_until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError('condition not reached')
+
+
+def test_merge_keeps_the_latest_message_with_every_text():
+    merged = merge_messages([message('hi', timestamp=1), message('  '), message('a rose', timestamp=3)])
+    assert merged == {'chatInput': 'hi\na rose', 'sessionId': 'chat_a', 'timestamp': 3, 'mergedMessages': 3}
+
+
+@pytest.mark.parametrize('payload, expected', [
+    (message('hi'), True),
+    (message('hi', hasFiles=True), False),
+    ({'chatInput': None}, False),
+    ('hi', False),
+])
+def test_only_plain_text_is_mergeable(payload, expected):
+    assert mergeable_message(payload) == expected
+
+
+def test_calls_of_one_session_run_one_at_a_time_in_order():
+    dispatcher = SessionDispatcher(enabled=True)
+    release = threading.Event()
+    running = []
+    order = []
+
+    def call(name):
+        def fn(_merged):
+            running.append(name)
+            assert len(running) == 1
+            if name == 'first':
+                release.wait(5)
+            order.append(name)
+            running.remove(name)
+            return name
+        return dispatcher.run('chat_a', fn, message(name))
+
+    threads = [start(call, 'first')]
+    wait_until(lambda: running)
+    threads += [start(call, 'second')]
+    wait_until(lambda: dispatcher.stats()['queued_messages'] == 1)
+    threads += [start(call, 'third')]
+    wait_until(lambda: dispatcher.stats()['queued_messages'] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert order == ['first', 'second', 'third']
+    assert dispatcher.stats()['waited_for_turn'] == 2
+    assert dispatcher.stats()['active_sessions'] == 0
+
+
+def test_other_sessions_do_not_wait():
+    dispatcher = SessionDispatcher(enabled=True)
+    release = threading.Event()
+    thread = start(dispatcher.run, 'chat_a', lambda _merged: release.wait(5))
+    wait_until(lambda: dispatcher.stats()['active_sessions'] == 1)
+    assert dispatcher.run('chat_b', lambda _merged: 'b') == ('b', True, 1)
+    release.set()
+    thread.join(5)
+
+
+@pytest.mark.parametrize('session_id', [None, '', 'default', 42])
+def test_anonymous_messages_are_sent_straight_away(session_id):
+    dispatcher = SessionDispatcher(enabled=True, max_queued=1)
+    assert dispatcher.run(session_id, lambda merged: merged) == (None, True, 1)
+    assert dispatcher.stats()['upstream_calls'] == 0
+
+
+def test_full_session_queue_is_refused():
+    dispatcher = SessionDispatcher(enabled=True, max_queued=1)
+    release = threading.Event()
+    running = start(dispatcher.run, 'chat_a', lambda _merged: release.wait(5))
+    wait_until(lambda: dispatcher.stats()['active_sessions'] == 1)
+    waiting = start(dispatcher.run, 'chat_a', lambda _merged: None)
+    wait_until(lambda: dispatcher.stats()['queued_messages'] == 1)
+    with pytest.raises(SessionQueueFull):
+        dispatcher.run('chat_a', lambda _merged: None)
+    release.set()
+    running.join(5)
+    waiting.join(5)
+    assert dispatcher.stats()['rejected'] == 1
+
+
+def test_messages_within_the_window_share_one_turn():
+    dispatcher = SessionDispatcher(enabled=True, merge_window=0.2)
+    sent = []
+    results = {}
+
+    def call(text):
+        results[text] = dispatcher.run('chat_a', lambda merged: sent.append(merged) or 'answer', message(text))
+
+    threads = [start(call, 'hi')]
+    time.sleep(0.05)
+    threads.append(start(call, 'a small rose'))
+    for thread in threads:
+        thread.join(5)
+    assert sent == [merge_messages([message('hi'), message('a small rose')])]
+    assert results == {'hi': ('answer', False, 2), 'a small rose': ('answer', True, 2)}
+    assert dispatcher.stats()['merged'] == 1
+
+
+def test_error_reaches_every_merged_message():
+    dispatcher = SessionDispatcher(enabled=True, merge_window=0.1)
+    errors = []
+
+    def call(text):
+        def fail(_merged):
+            raise OSError('n8n down')
+        try:
+            dispatcher.run('chat_a', fail, message(text))
+        except OSError as e:
+            errors.append(e)
+
+    threads = [start(call, 'one'), start(call, 'two')]
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 2
+
+
+def test_async_calls_of_one_session_run_in_order():
+    dispatcher = SessionDispatcher(enabled=True)
+    order = []
+
+    async def call(name, delay):
+        async def fn(_merged):
+            order.append(name + ' start')
+            await asyncio.sleep(delay)
+            order.append(name + ' end')
+            return name
+        return await dispatcher.run_async('chat_a', fn, message(name))
+
+    async def main():
+        return await asyncio.gather(call('first', 0.05), call('second', 0))
+
+    assert asyncio.run(main()) == [('first', True, 1), ('second', True, 1)]
+    assert order == ['first start', 'first end', 'second start', 'second end']
+    assert dispatcher.async_sessions == {}
+
+
+def test_async_messages_within_the_window_share_one_turn():
+    dispatcher = SessionDispatcher(enabled=True, merge_window=0.1)
+    sent = []
+
+    async def fn(merged):
+        sent.append(merged)
+        return 'answer'
+
+    async def main():
+        first = asyncio.ensure_future(dispatcher.run_async('chat_a', fn, message('hi')))
+        await asyncio.sleep(0.02)
+        second = await dispatcher.run_async('chat_a', fn, message('price?'))
+        return await first, second
+
+    assert asyncio.run(main()) == (('answer', False, 2), ('answer', True, 2))
+    assert sent == [merge_messages([message('hi'), message('price?')])]
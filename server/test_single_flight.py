@@ -0,0 +1,148 @@
+import asyncio
+import json
+import threading
+import time
+
+from conftest import chat_message, exchange, request
+from response_cache import ResponseCache
+from session_dispatch import SessionDispatcher
+from single_flight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight(enabled=True)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'answer'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.run('k', fn)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.run('k', fn))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.stats()['coalesced'] < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert calls == [1]
+    assert sorted(results) == [('answer', False)] + [('answer', True)] * 3
+    assert flight.stats() == {'enabled': True, 'in_flight': 0, 'upstream_calls': 1, 'coalesced': 3}
+
+
+def test_error_reaches_followers():
+    flight = SingleFlight(enabled=True)
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError('n8n down')
+
+    errors = []
+
+    def call():
+        try:
+            flight.run('k', fail)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads.append(threading.Thread(target=call))
+    threads[1].start()
+    while flight.stats()['coalesced'] < 1:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 2 and errors[0] is errors[1]
+
+
+def test_disabled_or_keyless_calls_run_alone():
+    assert SingleFlight(enabled=False).run('k', lambda: 1) == (1, False)
+    assert SingleFlight(enabled=True).run(None, lambda: 2) == (2, False)
+
+
+def test_async_followers_share_and_survive_leader_cancel():
+    flight = SingleFlight(enabled=True)
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'answer'
+
+    async def main():
+        leader = asyncio.ensure_future(flight.run_async('k', fn))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.run_async('k', fn))
+        await asyncio.sleep(0)
+        leader.cancel()
+        result = await follower
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(main()) == ('answer', True)
+    assert calls == [1]
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_other_session_is_not_answered_with_a_merged_note(engine_server, fake_n8n, proxy, monkeypatch):
+    """A merged turn of one session must not be shared with an identical message of another"""
+    monkeypatch.setattr(proxy, 'session_dispatcher', SessionDispatcher(enabled=True, merge_window=0.3))
+    monkeypatch.setattr(proxy, 'request_coalescer', SingleFlight(enabled=True))
+    monkeypatch.setattr(proxy, 'response_cache', ResponseCache(enabled=False, per_process=False))
+    fake_n8n.delay = 0.3
+    replies = {}
+
+    def send(name, text, session_id):
+        _status, _headers, body = exchange(engine_server, request(
+            'POST', '/api/chat', chat_message(text, session_id), headers=[('Content-Type', 'application/json')]))
+        replies[name] = json.loads(body)
+
+    threads = [threading.Thread(target=send, args=('a1', 'hi', 'chat_a')),
+               threading.Thread(target=send, args=('a2', 'I want a rose', 'chat_a')),
+               threading.Thread(target=send, args=('b', 'hi', 'chat_b'))]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join(10)
+
+    assert replies['a1'] == {'status': 'merged', 'merged': True}
+    assert replies['a2'] == {'output': 'hi'}
+    assert replies['b'] == {'output': 'hi'}
+    assert len(fake_n8n.requests) == 2
+
+
+def test_identical_faq_of_two_sessions_share_one_call(engine_server, fake_n8n, proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'request_coalescer', SingleFlight(enabled=True))
+    monkeypatch.setattr(proxy, 'response_cache', ResponseCache(enabled=False, per_process=False))
+    fake_n8n.delay = 0.3
+    replies = []
+
+    def send(session_id):
+        _status, _headers, body = exchange(engine_server, request(
+            'POST', '/api/chat', chat_message('price?', session_id), headers=[('Content-Type', 'application/json')]))
+        replies.append(json.loads(body))
+
+    threads = [threading.Thread(target=send, args=(session_id,)) for session_id in ('chat_c', 'chat_d')]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join(10)
+    assert replies == [{'output': 'hi'}] * 2
+    assert len(fake_n8n.requests) == 1
@@ -0,0 +1,103 @@
+import gzip
+import os
+
+import pytest
+
+from conftest import exchange, request
+from static_assets import StaticAssetCache, accepted_encodings
+
+SCRIPT = b'console.log("ink");\n' * 50
+
+
+@pytest.fixture
+def site(tmp_path):
+    (tmp_path / 'index.html').write_bytes(b'<!doctype html><title>InkFlow</title>')
+    (tmp_path / 'app.js').write_bytes(SCRIPT)
+    (tmp_path / 'gallery').mkdir()
+    (tmp_path / 'gallery' / 'index.html').write_bytes(b'<p>gallery</p>')
+    (tmp_path / 'video.mp4').write_bytes(b'\x00' * 4096)
+    (tmp_path / '.env').write_bytes(b'SECRET=1')
+    return tmp_path
+
+
+@pytest.fixture
+def assets(site):
+    cache = StaticAssetCache(root=str(site), max_file_bytes=1024)
+    cache.load()
+    return cache
+
+
+def test_accepted_encodings_skip_q_zero():
+    assert accepted_encodings('gzip;q=0, br, deflate;q=0.5') == {'br', 'deflate'}
+
+
+def test_gzip_is_served_when_accepted(assets):
+    asset, _redirect = assets.resolve('/app.js')
+    status, headers, body, _source = assets.respond(asset, {'Accept-Encoding': 'gzip'})
+    headers = dict(headers)
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(body) == SCRIPT
+    assert headers['ETag'].endswith('-gz"')
+
+
+def test_etag_revalidation_answers_304(assets):
+    asset, _redirect = assets.resolve('/app.js')
+    _status, headers, _body, _source = assets.respond(asset, {})
+    status, _headers, body, _source = assets.respond(asset, {'If-None-Match': 'W/' + dict(headers)['ETag']})
+    assert (status, body) == (304, b'')
+    assert assets.stats()['not_modified'] == 1
+
+
+def test_html_is_revalidated_and_assets_are_cached(assets):
+    html, _redirect = assets.resolve('/')
+    script, _redirect = assets.resolve('/app.js')
+    assert html.cache_control == 'no-cache'
+    assert script.cache_control.startswith('public, max-age=')
+
+
+def test_directories_redirect_to_a_trailing_slash(assets):
+    assert assets.resolve('/gallery') == (None, '/gallery/')
+    asset, _redirect = assets.resolve('/gallery/')
+    assert asset.variants['identity'][0] == b'<p>gallery</p>'
+
+
+@pytest.mark.parametrize('path', ['/../secret.txt', '/%2e%2e/secret.txt', '/.env', '/missing.css'])
+def test_outside_hidden_and_missing_files_are_not_found(assets, path):
+    assert assets.resolve(path) == (None, None)
+
+
+def test_large_files_are_served_from_disk(assets, site):
+    asset, _redirect = assets.resolve('/video.mp4')
+    status, _headers, body, source = assets.respond(asset, {})
+    assert status == 200 and body is None
+    assert source.path == str(site / 'video.mp4')
+
+
+def test_reload_picks_up_changes(assets, site):
+    assert not assets.changed()
+    (site / 'new.css').write_bytes(b'body{}')
+    assert assets.changed()
+    assets.reload()
+    assert assets.resolve('/new.css')[0] is not None
+
+
+def test_stats_do_not_expose_the_directory(assets, site):
+    stats = assets.stats()
+    assert 'root' not in stats
+    assert str(site) not in repr(stats)
+    assert stats['files'] == 4
+    assert stats['in_memory'] == 3
+
+
+def test_engines_serve_from_the_cache(engine_server, proxy, assets, monkeypatch):
+    monkeypatch.setattr(proxy, 'static_assets', assets)
+    status, headers, body = exchange(engine_server, request('GET', '/app.js'))
+    assert status == 200 and body == SCRIPT
+    assert headers['content-length'] == str(len(SCRIPT))
+    status, _headers, body = exchange(engine_server, request(
+        'GET', '/app.js', headers=[('If-None-Match', headers['etag'])]))
+    assert (status, body) == (304, b'')
+    status, _headers, body = exchange(engine_server, request('GET', '/video.mp4'))
+    assert status == 200 and len(body) == os.path.getsize(assets.assets['video.mp4'].path)
@@ -0,0 +1,69 @@
+import json
+import socket
+import time
+
+from conftest import chat_message, exchange, request
+from metrics import MetricsRegistry
+from response_cache import ResponseCache
+
+
+def stream_request(text='hi', session_id='chat_stream'):
+    return request('POST', '/api/chat/stream', chat_message(text, session_id),
+                   headers=[('Content-Type', 'application/json')])
+
+
+def test_first_chunk_is_relayed_before_n8n_finishes(engine_server, fake_n8n):
+    fake_n8n.chunks = [b'{"output": "first', b' second"}']
+    fake_n8n.chunk_delay = 0.5
+    with socket.create_connection(('127.0.0.1', engine_server), timeout=5) as sock:
+        sock.sendall(stream_request())
+        received = bytearray()
+        while b'first' not in received:
+            received += sock.recv(65536)
+        first_at = time.monotonic()
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            received += chunk
+        done_at = time.monotonic()
+    assert done_at - first_at >= 0.3
+    assert received.endswith(b'0\r\n\r\n')
+
+
+def test_stream_headers_keep_proxies_from_buffering(engine_server, fake_n8n):
+    status, headers, _body = exchange(engine_server, stream_request())
+    assert status == 200
+    assert headers['cache-control'] == 'no-cache'
+    assert headers['x-accel-buffering'] == 'no'
+    assert headers['content-type'] == 'application/json'
+
+
+def test_empty_stream_answers_success(engine_server, fake_n8n):
+    fake_n8n.chunks = []
+    _status, _headers, body = exchange(engine_server, stream_request())
+    assert body == b'15\r\n{"status": "success"}\r\n0\r\n\r\n'
+
+
+def test_failed_upstream_is_a_502_before_any_byte(engine_server, fake_n8n):
+    fake_n8n.status = 500
+    status, headers, _body = exchange(engine_server, stream_request())
+    assert status == 502
+    assert 'transfer-encoding' not in headers
+
+
+def test_streamed_answers_are_not_cached(engine_server, fake_n8n, proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'response_cache', ResponseCache(enabled=True, per_process=False))
+    for session_id in ('chat_s1', 'chat_s2'):
+        status, headers, _body = exchange(engine_server, stream_request('price?', session_id))
+        assert status == 200 and 'x-cache' not in headers
+    assert len(fake_n8n.requests) == 2
+    # The streamed turn is in n8n's memory now, so the session is no longer stateless
+    assert proxy.response_cache.key_for(json.loads(chat_message('price?', 'chat_s1'))) is None
+
+
+def test_time_to_first_token_is_recorded(engine_server, fake_n8n, proxy, monkeypatch):
+    monkeypatch.setattr(proxy, 'metrics', MetricsRegistry())
+    exchange(engine_server, stream_request())
+    counts, _total = proxy.metrics.first_token.snapshot()[()]
+    assert sum(counts) == 1
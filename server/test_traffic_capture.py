@@ -0,0 +1,181 @@
+import io
+import json
+import os
+import sys
+import time
+
+import pytest
+
+from conftest import chat_message, exchange, request
+from traffic_capture import HASH_CHARS, TrafficCapture, hebrew_chars
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench'))
+import replay  # noqa: E402
+
+
+class Part:
+    def __init__(self, data=b'', content_type='image/png', name='photo_0'):
+        self.name = name
+        self.file = io.BytesIO(data)
+        self.size = len(data)
+        self.content_type = content_type
+
+
+@pytest.fixture
+def capture(tmp_path):
+    capture = TrafficCapture(enabled=True, path=str(tmp_path / 'capture.jsonl'), salt=b'salt')
+    yield capture
+    if capture.handler:
+        capture.handler.close()
+
+
+def records(capture):
+    with open(capture.path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_off_by_default_costs_nothing(tmp_path):
+    capture = TrafficCapture(enabled=False, path=str(tmp_path / 'capture.jsonl'))
+    record = capture.begin('/api/chat', 'application/json', 10)
+    capture.note_message(record, {'chatInput': 'hi'})
+    capture.finish(record, 200)
+    assert record is None
+    assert not os.path.exists(capture.path)
+
+
+def test_record_keeps_shape_but_no_content(capture):
+    text = 'שלום, price for a rose?'
+    record = capture.begin('/api/chat?x=1', 'application/json', 120, session_header='chat_secret')
+    capture.note_message(record, {'chatInput': text, 'sessionId': 'chat_secret', 'senderPhone': '0501234567'})
+    capture.finish(record, 200)
+
+    [line] = records(capture)
+    assert line['route'] == '/api/chat'
+    assert line['mode'] == 'json'
+    assert line['bytes'] == 120
+    assert line['session_header'] is True
+    assert line['fields'] == ['chatInput', 'senderPhone', 'sessionId']
+    assert line['text'] == [len(text), 4]
+    assert line['session'] == capture.digest(b'chat_secret')
+    assert line['status'] == 200 and line['ms'] >= 0 and 'started' not in line
+    raw = open(capture.path, encoding='utf-8').read()
+    for secret in ('chat_secret', '0501234567', 'rose', 'שלום'):
+        assert secret not in raw
+
+
+def test_gap_is_the_time_since_the_previous_chat_request(capture, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('traffic_capture.time.time', lambda: now[0])
+    first = capture.begin('/api/chat', 'application/json', 1)
+    now[0] += 2.5
+    second = capture.begin('/api/chat', 'application/json', 1)
+    assert first['gap_ms'] is None
+    assert second['gap_ms'] == 2500
+
+
+def test_upload_files_are_hashed_without_moving_the_file(capture):
+    record = capture.begin('/api/chat', 'multipart/form-data; boundary=x', 999)
+    photo = Part(b'\x89PNG' + b'\x01' * 100)
+    photo.file.seek(7)
+    parts = list(capture.watch_parts(record, [Part(name='chatInput'), photo]))
+    capture.note_upload(record, 'hi', 'chat_u', [photo, Part(photo.file.getvalue())])
+    capture.finish(record, 200)
+
+    [line] = records(capture)
+    assert len(parts) == 2
+    assert line['mode'] == 'upload'
+    assert line['fields'] == ['chatInput', 'photo_0']
+    assert photo.file.tell() == 7
+    first, second = line['files']
+    assert first == {'size': 104, 'type': 'image/png', 'hash': second['hash']}
+    assert len(first['hash']) == HASH_CHARS
+
+
+def test_hashes_depend_on_the_salt():
+    assert TrafficCapture(salt=b'a').digest(b'chat_1') != TrafficCapture(salt=b'b').digest(b'chat_1')
+
+
+def test_sampling_keeps_or_drops_whole_sessions(tmp_path):
+    capture = TrafficCapture(enabled=True, path=str(tmp_path / 'capture.jsonl'), sample=0.5, salt=b'salt')
+    kept = {}
+    for session in range(40):
+        for _ in range(3):
+            record = capture.begin('/api/chat', 'application/json', 1)
+            capture.note_session(record, f'chat_{session}')
+            kept.setdefault(session, set()).add(capture.sampled(record))
+    assert all(len(outcomes) == 1 for outcomes in kept.values())
+    assert {True, False} == set().union(*kept.values())
+
+
+def test_hebrew_chars():
+    assert hebrew_chars('קעקוע tattoo') == 5
+
+
+def test_engines_capture_chat_requests(engine_server, fake_n8n, capture, monkeypatch, proxy):
+    monkeypatch.setattr(proxy, 'traffic_capture', capture)
+    status, _headers, _body = exchange(engine_server, request('POST', '/api/chat', chat_message('שלום'),
+                                                              headers=[('Content-Type', 'application/json')]))
+    assert status == 200
+    for _ in range(100):
+        if capture.written:
+            break
+        time.sleep(0.01)
+    [line] = records(capture)
+    assert line['status'] == 200
+    assert line['text'] == [4, 4]
+    assert line['session'] == capture.digest(b'chat_engines')
+
+
+def test_replay_loads_captures_oldest_first(tmp_path, capsys):
+    path = tmp_path / 'capture.jsonl'
+    path.write_text('\n'.join([json.dumps({'v': 1, 'ts': 20}), 'not json', json.dumps({'v': 99, 'ts': 5}),
+                               json.dumps({'v': 1, 'ts': 10})]) + '\n', encoding='utf-8')
+    assert [record['ts'] for record in replay.load_records([str(path)])] == [10, 20]
+    assert 'Skipped 2' in capsys.readouterr().out
+
+
+def test_replay_schedule_keeps_spacing_divided_by_speed():
+    stamps = [{'ts': ts} for ts in (100, 102, 200, 201)]
+    assert replay.schedule(stamps, 2, max_gap=30) == [0, 1, 16, 16.5]
+    assert replay.schedule(stamps, 0, max_gap=30) == [0, 0, 0, 0]
+
+
+@pytest.mark.parametrize('shape', [[40, 15], [4, 4], [12, 0], [7, 6], [0, 0]])
+def test_synthetic_text_has_the_captured_shape(shape):
+    text = replay.synthetic_text(shape, replay.random.Random(1))
+    assert [len(text), hebrew_chars(text)] == shape
+
+
+def test_synthetic_text_without_a_captured_text():
+    assert replay.synthetic_text(None, replay.random.Random(1)) == ''
+
+
+def test_synthesizer_rebuilds_the_captured_request():
+    synthesizer = replay.Synthesizer([('a.png', b'\x89PNG' + b'x' * 50), ('b.jpg', b'\xff\xd8' + b'y' * 500)])
+    record = {'mode': 'upload', 'route': '/api/chat', 'session': 'abcd', 'session_header': True,
+              'text': [5, 0], 'fields': ['chatInput', 'sessionId', 'photo_0', 'photo_1'],
+              'files': [{'size': 300, 'hash': 'h1'}, {'size': 300, 'hash': 'h1'}]}
+    path, body, headers = synthesizer.build(record)
+    assert path == '/api/chat'
+    assert headers['X-Session-Id'] == 'replay-abcd'
+    assert headers['Content-Type'].startswith('multipart/form-data')
+    filename, data = synthesizer.file_data(record['files'][0])
+    assert filename == 'a.png' and len(data) == 300
+    assert body.count(data) == 2
+
+    record = {'mode': 'json', 'session': None, 'text': [3, 0], 'fields': ['chatInput', 'sessionId'], 'async': True}
+    path, body, headers = synthesizer.build(record)
+    assert json.loads(body) == {'chatInput': json.loads(body)['chatInput']}
+    assert headers['Prefer'] == 'respond-async'
+
+
+def test_replay_drives_a_capture_against_the_proxy(engine_server, fake_n8n):
+    captured = [{'v': 1, 'ts': 0, 'mode': 'json', 'route': '/api/chat', 'session': f'{i % 2:04x}',
+                 'text': [10, 4], 'fields': ['chatInput', 'sessionId'], 'status': 200, 'ms': 5} for i in range(4)]
+    results, elapsed = replay.replay(captured, replay.schedule(captured, 0, 30), replay.Synthesizer([]),
+                                     '127.0.0.1', engine_server, 5, 4)
+    report = replay.summarize(results, elapsed)
+    assert report['modes']['json']['status_replayed'] == {'200': 4}
+    assert report['modes']['json']['status_mismatches'] == 0
+    assert sorted(json.loads(body)['sessionId'] for _path, _headers, body in fake_n8n.requests) == \
+        ['replay-0000', 'replay-0000', 'replay-0001', 'replay-0001']
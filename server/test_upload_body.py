@@ -0,0 +1,80 @@
+import base64
+import io
+import json
+
+import pytest
+
+from upload_body import BASE64_READ_SIZE, Base64DataURI, StreamingJSONBody, base64_length
+
+
+def data_uri(data, mime_type='image/png'):
+    return Base64DataURI(io.BytesIO(data), len(data), mime_type)
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 4, BASE64_READ_SIZE - 1, BASE64_READ_SIZE, BASE64_READ_SIZE + 1,
+                                  3 * BASE64_READ_SIZE + 2])
+def test_base64_length_matches_encoder(size):
+    assert base64_length(size) == len(base64.b64encode(b'x' * size))
+
+
+def test_body_is_the_json_with_images_inlined():
+    photos = [bytes(range(256)) * 700, b'\xff\xd8\xff' + b'\x01' * (BASE64_READ_SIZE + 5)]
+    payload = {
+        'chatInput': 'שלום, קעקוע קטן על היד',
+        'sessionId': 'chat_1',
+        'images': [data_uri(photos[0]), data_uri(photos[1], 'image/jpeg')],
+    }
+    body = StreamingJSONBody(payload, ensure_ascii=False)
+    raw = b''.join(body)
+
+    assert len(raw) == len(body)
+    decoded = json.loads(raw)
+    assert decoded['chatInput'] == payload['chatInput']
+    assert decoded['images'] == [
+        'data:image/png;base64,' + base64.b64encode(photos[0]).decode(),
+        'data:image/jpeg;base64,' + base64.b64encode(photos[1]).decode(),
+    ]
+
+
+def test_body_can_be_sent_twice():
+    body = StreamingJSONBody({'image': data_uri(b'\x89PNG' * 1000)})
+    assert b''.join(body) == b''.join(body)
+
+
+def test_user_text_cannot_forge_a_placeholder():
+    text = '\x00deadbeefdeadbeef:0\x00 and \\u0000'
+    body = StreamingJSONBody({'chatInput': text, 'image': data_uri(b'abc')})
+    assert json.loads(b''.join(body))['chatInput'] == text
+
+
+def test_file_shorter_than_recorded_size():
+    body = StreamingJSONBody({'image': Base64DataURI(io.BytesIO(b'abc'), 10, 'image/png')})
+    with pytest.raises(ValueError):
+        b''.join(body)
+
+
+def test_other_objects_are_not_serializable():
+    with pytest.raises(TypeError):
+        StreamingJSONBody({'when': object()})
+
+
+def test_upload_is_forwarded_with_the_image_inlined(engine_server, fake_n8n, monkeypatch):
+    from conftest import exchange
+    from image_processing import image_preprocessor
+    monkeypatch.setattr(image_preprocessor, 'enabled', False)
+    photo = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 40
+    boundary = b'----upload'
+    form = (b'--' + boundary + b'\r\nContent-Disposition: form-data; name="chatInput"\r\n\r\nmy sketch\r\n'
+            b'--' + boundary + b'\r\nContent-Disposition: form-data; name="sessionId"\r\n\r\nchat_up\r\n'
+            b'--' + boundary + b'\r\nContent-Disposition: form-data; name="photo_0"; filename="s.png"\r\n'
+            b'Content-Type: image/png\r\n\r\n' + photo + b'\r\n--' + boundary + b'--\r\n')
+    raw = (b'POST /api/chat HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+           b'Content-Type: multipart/form-data; boundary=' + boundary + b'\r\n'
+           b'Content-Length: %d\r\n\r\n' % len(form)) + form
+    status, _headers, _body = exchange(engine_server, raw)
+    assert status == 200
+    _path, headers, body = fake_n8n.requests[0]
+    forwarded = json.loads(body)
+    assert int(headers['Content-Length']) == len(body)
+    assert forwarded['sessionId'] == 'chat_up'
+    assert forwarded['files'][0]['dataUri'] == 'data:image/png;base64,' + base64.b64encode(photo).decode()
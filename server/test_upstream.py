@@ -0,0 +1,109 @@
+import socket
+import threading
+from urllib.error import HTTPError, URLError
+
+import pytest
+
+import upstream
+from conftest import FakeN8n
+from upstream import CancelToken, UpstreamPool
+
+
+@pytest.fixture
+def n8n():
+    server = FakeN8n()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def pool():
+    pool = UpstreamPool(max_per_host=2, idle_timeout=60)
+    yield pool
+    pool.close_all()
+
+
+def test_keep_alive_connection_is_reused(n8n, pool):
+    for _ in range(3):
+        response = pool.post(n8n.url, b'{}', headers={'Content-Type': 'application/json'})
+        assert response.status == 200
+        assert response.body == b'{"output": "hi"}'
+    stats = pool.stats()
+    assert (stats['misses'], stats['hits'], stats['idle_connections']) == (1, 2, 1)
+
+
+def test_streamed_body_is_sent_with_its_length(n8n, pool):
+    class Body:
+        def __len__(self):
+            return 6
+
+        def __iter__(self):
+            yield b'{"a":'
+            yield b'1'
+
+    pool.post(n8n.url, Body())
+    _path, headers, body = n8n.requests[0]
+    assert headers['Content-Length'] == '6'
+    assert body == b'{"a":1'
+
+
+def test_stale_pooled_connection_is_retried_once(n8n, pool):
+    pool.post(n8n.url, b'{}')
+    # The server side went away while the connection sat idle
+    (conn, _last_used), = pool.idle[('http', '127.0.0.1', n8n.server_address[1])]
+    conn.sock.shutdown(socket.SHUT_RDWR)
+    assert pool.post(n8n.url, b'{}').status == 200
+    assert pool.stats()['misses'] == 2
+
+
+@pytest.mark.parametrize('status', [404, 500])
+def test_error_status_raises_http_error(n8n, pool, status):
+    n8n.status = status
+    with pytest.raises(HTTPError) as caught:
+        pool.post(n8n.url, b'{}')
+    assert caught.value.code == status
+    # The answer was read to the end, so the connection is still usable
+    assert pool.stats()['idle_connections'] == 1
+
+
+def test_connection_refused_raises_url_error(pool):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    with pytest.raises(URLError):
+        pool.post(f'http://127.0.0.1:{port}/webhook', b'{}', timeout=2)
+
+
+def test_pool_keeps_at_most_max_per_host(n8n, pool):
+    connections = [pool.acquire('http', '127.0.0.1', n8n.server_address[1], 5)[0] for _ in range(3)]
+    for conn in connections:
+        pool.release('http', '127.0.0.1', n8n.server_address[1], conn)
+    assert pool.stats()['idle_connections'] == 2
+    assert pool.stats()['evictions'] == 1
+
+
+def test_idle_connections_are_evicted(n8n, pool, monkeypatch, clock):
+    monkeypatch.setattr(upstream, 'time', clock)
+    pool.post(n8n.url, b'{}')
+    clock.advance(30)
+    assert pool.evict_idle() == 0
+    clock.advance(31)
+    assert pool.evict_idle() == 1
+    assert pool.stats()['idle_connections'] == 0
+
+
+def test_cancelled_token_stops_the_call(n8n, pool):
+    token = CancelToken()
+    token.cancel()
+    with pytest.raises(URLError):
+        pool.post(n8n.url, b'{}', cancel_token=token)
+    assert n8n.requests == []
+
+
+def test_stream_yields_chunks_and_pools_the_connection(n8n, pool):
+    n8n.chunks = [b'{"output": ', b'"hi"}']
+    stream = pool.stream(n8n.url, b'{}')
+    assert b''.join(stream.iter_chunks()) == b'{"output": "hi"}'
+    assert pool.stats()['idle_connections'] == 1
@@ -0,0 +1,193 @@
+"""Opt-in capture of chat traffic shape, for replaying production-like load.
+
+Synthetic load gets the mix wrong: how long messages are and how much of
+them is Hebrew, how large the photos are, how often a session sends again
+and how bursty arrivals are. With TRAFFIC_CAPTURE enabled, every chat
+request adds one JSON line to TRAFFIC_CAPTURE_FILE with its shape and
+timing only:
+
+- arrival time, gap since the previous chat request, route and mode,
+- body size, field names and whether X-Session-Id was sent,
+- message length in characters and how many of them are Hebrew,
+- per file: size, sniffed type and a content hash,
+- a keyed hash of the session id, the response status and the duration.
+
+No message text, file content, names, phone numbers or IPs are written.
+Hashes are HMACs under TRAFFIC_CAPTURE_SALT (random per start when unset),
+so they group a session's messages and repeated photos without being
+reversible by guessing. TRAFFIC_CAPTURE_SAMPLE keeps that share of
+sessions, whole. The file rotates at TRAFFIC_CAPTURE_MAX_MB; pre-fork
+workers each write their own file (suffixed with the worker's PID).
+
+server/bench/replay.py re-drives a capture against a proxy.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_CAPTURE = os.getenv('TRAFFIC_CAPTURE', 'false').lower() in ('1', 'true', 'yes')
+TRAFFIC_CAPTURE_FILE = os.getenv('TRAFFIC_CAPTURE_FILE', 'traffic_capture.jsonl')
+TRAFFIC_CAPTURE_MAX_MB = float(os.getenv('TRAFFIC_CAPTURE_MAX_MB', '20'))
+TRAFFIC_CAPTURE_BACKUPS = int(os.getenv('TRAFFIC_CAPTURE_BACKUPS', '5'))
+TRAFFIC_CAPTURE_SAMPLE = float(os.getenv('TRAFFIC_CAPTURE_SAMPLE', '1.0'))
+TRAFFIC_CAPTURE_SALT = os.getenv('TRAFFIC_CAPTURE_SALT', '').encode('utf-8') or os.urandom(16)
+
+# Bumped when the record layout changes; replay.py checks it
+CAPTURE_VERSION = 1
+HASH_CHARS = 16
+HASH_CHUNK = 64 * 1024
+
+
+def hebrew_chars(text):
+    return sum(1 for char in text if '\u0590' <= char <= '\u05ff')
+
+
+class TrafficCapture:
+    """Writes one shape-only record per chat request to a rotating file"""
+    def __init__(self, enabled=TRAFFIC_CAPTURE, path=TRAFFIC_CAPTURE_FILE, max_bytes=TRAFFIC_CAPTURE_MAX_MB * 1024 * 1024,
+                 backups=TRAFFIC_CAPTURE_BACKUPS, sample=TRAFFIC_CAPTURE_SAMPLE, salt=TRAFFIC_CAPTURE_SALT):
+        self.enabled = enabled
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample = sample
+        self.salt = salt
+        self.lock = threading.Lock()
+        self.last_arrival = None
+        self.handler = None
+        # Workers forked after import write their own file
+        self.parent_pid = os.getpid()
+        self.written = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def digest(self, data):
+        return hmac.new(self.salt, data, hashlib.sha256).hexdigest()[:HASH_CHARS]
+
+    def begin(self, path, content_type, content_length, session_header=False, async_job=False):
+        """Start a record for a chat request, or None when capture is off"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self.lock:
+            gap = None if self.last_arrival is None else now - self.last_arrival
+            self.last_arrival = now
+        return {
+            'v': CAPTURE_VERSION,
+            'ts': round(now, 3),
+            'gap_ms': None if gap is None else round(gap * 1000),
+            'route': path.partition('?')[0],
+            'mode': 'upload' if content_type.startswith('multipart/form-data') else 'json',
+            'async': bool(async_job),
+            'bytes': content_length,
+            'session_header': bool(session_header),
+            'fields': [],
+            'session': None,
+            'text': None,
+            'files': [],
+            'started': time.perf_counter(),
+        }
+
+    def note_session(self, record, session_id):
+        if record is not None and isinstance(session_id, str) and session_id:
+            record['session'] = self.digest(session_id.encode('utf-8'))
+
+    def note_text(self, record, text):
+        if record is not None and isinstance(text, str):
+            record['text'] = [len(text), hebrew_chars(text)]
+
+    def note_message(self, record, payload):
+        """Shape of a parsed JSON chat message"""
+        if record is None or not isinstance(payload, dict):
+            return
+        record['fields'] = sorted(payload)
+        self.note_session(record, payload.get('sessionId'))
+        self.note_text(record, payload.get('chatInput'))
+
+    def watch_parts(self, record, parts):
+        """Pass multipart parts through, noting their field names"""
+        for part in parts:
+            if record is not None:
+                record['fields'].append(part.name)
+            yield part
+
+    def note_upload(self, record, chat_input, session_id, files):
+        """Shape of a parsed upload; call before the images are preprocessed"""
+        if record is None:
+            return
+        self.note_session(record, session_id)
+        self.note_text(record, chat_input)
+        for part in files:
+            record['files'].append({'size': part.size, 'type': part.content_type, 'hash': self.hash_file(part.file)})
+
+    def hash_file(self, file):
+        digest = hmac.new(self.salt, digestmod=hashlib.sha256)
+        position = file.tell()
+        file.seek(0)
+        try:
+            while chunk := file.read(HASH_CHUNK):
+                digest.update(chunk)
+        finally:
+            file.seek(position)
+        return digest.hexdigest()[:HASH_CHARS]
+
+    def sampled(self, record):
+        if self.sample >= 1:
+            return True
+        if record['session']:
+            # Whole sessions are kept or dropped, so their pattern survives sampling
+            return int(record['session'], 16) / 16 ** HASH_CHARS < self.sample
+        return random.random() < self.sample
+
+    def finish(self, record, status):
+        """Complete the record with the outcome and append it to the capture file"""
+        if record is None:
+            return
+        record['status'] = status
+        record['ms'] = round((time.perf_counter() - record.pop('started')) * 1000)
+        if not self.sampled(record):
+            self.skipped += 1
+            return
+        line = json.dumps(record, separators=(',', ':'))
+        try:
+            with self.lock:
+                if self.handler is None:
+                    self.handler = self.open()
+                self.handler.emit(logging.makeLogRecord({'msg': line}))
+                self.written += 1
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Traffic capture write failed: {e}")
+
+    def open(self):
+        path = self.path
+        if os.getpid() != self.parent_pid:
+            root, ext = os.path.splitext(path)
+            path = f"{root}-{os.getpid()}{ext}"
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=int(self.max_bytes),
+                                                       backupCount=self.backups, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.info(f"Capturing chat traffic shape to {path}")
+        return handler
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'file': self.handler.baseFilename if self.handler else None,
+            'sample': self.sample,
+            'written': self.written,
+            'skipped': self.skipped,
+            'failed': self.failed,
+        }
+
+
+# Shared capture for both serving engines
+traffic_capture = TrafficCapture()
@@ -0,0 +1,81 @@
+"""JSON request bodies with uploaded images base64-encoded on the fly.
+
+The JSON around each image is rendered once; the image bytes are read
+from their (spooled) upload file and encoded chunk by chunk while the
+body is being sent, so a large photo never exists in memory as a full
+raw, base64 and JSON copy at the same time. An image whose base64 text is
+already at hand (from the image cache) is sent as is. The total length is
+known up front, so the body goes out with a plain Content-Length.
+"""
+import base64
+import json
+import re
+import secrets
+
+# Multiple of 3 so each encoded chunk concatenates into valid base64
+BASE64_READ_SIZE = 3 * 16 * 1024
+
+
+def base64_length(size):
+    return 4 * ((size + 2) // 3)
+
+
+class Base64DataURI:
+    """Placeholder for a data: URI streamed from an open binary file, or from its base64 if encoded is given"""
+    def __init__(self, file, size, mime_type, encoded=None):
+        self.file = file
+        self.size = size
+        self.mime_type = mime_type
+        self.encoded = encoded
+
+    @property
+    def length(self):
+        return base64_length(self.size) if self.encoded is None else len(self.encoded)
+
+    def __repr__(self):
+        return f"<data:{self.mime_type};base64 ({self.size} bytes)>"
+
+
+class StreamingJSONBody:
+    """Iterable JSON body where Base64DataURI values are encoded while sending"""
+    def __init__(self, payload, ensure_ascii=True):
+        token = secrets.token_hex(8)
+        self.files = []
+
+        def placeholder(value):
+            if not isinstance(value, Base64DataURI):
+                raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+            self.files.append(value)
+            # Control characters are always escaped by json, so this cannot clash with user text
+            return f"data:{value.mime_type};base64,\x00{token}:{len(self.files) - 1}\x00"
+
+        text = json.dumps(payload, ensure_ascii=ensure_ascii, default=placeholder)
+        pieces = re.split(r'\\u0000' + token + r':\d+\\u0000', text)
+        self.segments = [piece.encode('utf-8') for piece in pieces]
+        self.length = (sum(len(segment) for segment in self.segments)
+                       + sum(f.length for f in self.files))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        # Re-iterable so a failed attempt can be retried against the fallback webhook
+        for index, segment in enumerate(self.segments):
+            if segment:
+                yield segment
+            if index < len(self.files):
+                yield from self._encode_file(self.files[index])
+
+    @staticmethod
+    def _encode_file(data_uri):
+        if data_uri.encoded is not None:
+            yield data_uri.encoded
+            return
+        data_uri.file.seek(0)
+        remaining = data_uri.size
+        while remaining > 0:
+            chunk = data_uri.file.read(min(BASE64_READ_SIZE, remaining))
+            if not chunk:
+                raise ValueError("Upload file shorter than its recorded size")
+            remaining -= len(chunk)
+            yield base64.b64encode(chunk)
@@ -0,0 +1,310 @@
+"""Pooled keep-alive HTTP client for forwarding chat messages to n8n.
+
+Shared by proxy_server.py and the Vercel function in api/chat.py so every
+chat turn reuses an open TCP (and TLS) connection to the webhook host
+instead of paying a fresh handshake.
+"""
+import http.client
+import io
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.parse
+from collections import deque
+from urllib.error import HTTPError, URLError
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Pool configuration from environment variables with defaults
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', '10'))
+UPSTREAM_POOL_IDLE_SECONDS = float(os.getenv('UPSTREAM_POOL_IDLE_SECONDS', '60'))
+# Largest piece handed out by UpstreamStream.iter_chunks()
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# Errors that mean a kept-alive socket was closed by the server while idle
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+class CancelToken:
+    """Lets another thread abort a blocking upstream call (e.g. the loser of a hedged pair)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conn = None
+        self.cancelled = False
+
+    def attach(self, conn):
+        with self.lock:
+            self.conn = conn
+            return not self.cancelled
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            conn = self.conn
+        sock = conn.sock if conn is not None else None
+        if sock is not None:
+            try:
+                # shutdown() wakes a recv() blocked in another thread; close() alone does not
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class UpstreamResponse:
+    """Fully read response from an upstream call"""
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class UpstreamStream:
+    """Response whose body is read as it arrives; the connection is pooled again once it is consumed"""
+    def __init__(self, pool, key, conn, response, cancel_token=None):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.cancel_token = cancel_token
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def iter_chunks(self, size=STREAM_CHUNK_SIZE):
+        """Yield body bytes as soon as they are available; raises URLError if the upstream fails"""
+        completed = False
+        try:
+            while True:
+                try:
+                    chunk = self.response.read1(size)
+                except (OSError, http.client.HTTPException) as e:
+                    raise URLError(e)
+                if not chunk:
+                    completed = True
+                    return
+                yield chunk
+        finally:
+            conn, self.conn = self.conn, None
+            if conn is not None:
+                if completed:
+                    # read1() does not mark a Content-Length body as done; http.client needs that to reuse conn
+                    self.response.close()
+                    self.pool.finish(self.key, conn, self.response, self.cancel_token)
+                else:
+                    conn.close()
+
+    def settimeout(self, seconds):
+        """Per-read timeout for the rest of the body"""
+        if self.conn is not None and self.conn.sock is not None:
+            self.conn.sock.settimeout(seconds)
+
+    def close(self):
+        """Abandon the rest of the body"""
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            conn.close()
+
+
+class UpstreamPool:
+    """Per-host pool of keep-alive HTTP(S) connections with idle eviction"""
+    def __init__(self, max_per_host=UPSTREAM_POOL_SIZE, idle_timeout=UPSTREAM_POOL_IDLE_SECONDS):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # (scheme, host, port) -> deque of (connection, last_used)
+        self.idle = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connect_count = 0
+        self.connect_seconds = 0.0
+
+    def acquire(self, scheme, host, port, timeout):
+        """Return (connection, reused) for a host, preferring an idle keep-alive one"""
+        key = (scheme, host, port)
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle.get(key)
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used > self.idle_timeout:
+                    self.evictions += 1
+                    conn.close()
+                    continue
+                self.hits += 1
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.misses += 1
+
+        conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        conn = conn_class(host, port, timeout=timeout)
+        connect_start = time.monotonic()
+        conn.connect()
+        with self.lock:
+            self.connect_count += 1
+            self.connect_seconds += time.monotonic() - connect_start
+        return conn, False
+
+    def release(self, scheme, host, port, conn):
+        """Return a connection to the pool, closing it if the pool is full"""
+        key = (scheme, host, port)
+        with self.lock:
+            idle = self.idle.setdefault(key, deque())
+            if len(idle) < self.max_per_host:
+                idle.append((conn, time.monotonic()))
+                return
+            self.evictions += 1
+        conn.close()
+
+    def evict_idle(self):
+        """Close connections that have been idle longer than idle_timeout"""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for idle in self.idle.values():
+                while idle and now - idle[0][1] > self.idle_timeout:
+                    expired.append(idle.popleft()[0])
+            self.evictions += len(expired)
+        for conn in expired:
+            conn.close()
+        return len(expired)
+
+    def close_all(self):
+        with self.lock:
+            pools, self.idle = self.idle, {}
+        for idle in pools.values():
+            for conn, _last_used in idle:
+                conn.close()
+
+    def send(self, method, url, body=None, headers=None, timeout=30, cancel_token=None):
+        """Send a request over a pooled connection; returns (key, conn, response) once the head arrived.
+
+        Raises URLError for connection failures (including cancellation).
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Unsupported URL: {url}")
+        scheme = parts.scheme
+        host = parts.hostname
+        port = parts.port or (443 if scheme == 'https' else 80)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        headers = dict(headers or {})
+        headers.setdefault('Connection', 'keep-alive')
+        if body is not None and not isinstance(body, (bytes, bytearray)):
+            # Streamed bodies (e.g. StreamingJSONBody) know their length up front
+            headers['Content-Length'] = str(len(body))
+
+        endpoint = f"{host}:{port}{parts.path}"
+
+        for attempt in range(2):
+            acquire_start = time.perf_counter()
+            try:
+                conn, reused = self.acquire(scheme, host, port, timeout)
+            except OSError as e:
+                raise URLError(e)
+            if not reused:
+                metrics.observe_upstream(endpoint, 'connect', time.perf_counter() - acquire_start)
+            if cancel_token is not None and not cancel_token.attach(conn):
+                conn.close()
+                raise URLError('cancelled')
+            try:
+                send_start = time.perf_counter()
+                conn.request(method, target, body=body, headers=headers)
+                response = conn.getresponse()
+                # Measured from the start of the send, so it includes the body upload and n8n's run
+                metrics.observe_upstream(endpoint, 'ttfb', time.perf_counter() - send_start)
+            except STALE_CONNECTION_ERRORS as e:
+                conn.close()
+                if cancel_token is not None and cancel_token.cancelled:
+                    raise URLError('cancelled')
+                if reused and attempt == 0:
+                    # The server dropped an idle keep-alive socket; retry once on a fresh one
+                    logger.debug("Stale pooled connection to %s:%s, reconnecting: %r", host, port, e)
+                    continue
+                raise URLError(e)
+            except OSError as e:
+                conn.close()
+                raise URLError(e)
+            except BaseException:
+                conn.close()
+                raise
+            return (scheme, host, port), conn, response
+
+    def finish(self, key, conn, response, cancel_token=None):
+        """Pool a connection whose response has been read to the end"""
+        if response.will_close or (cancel_token is not None and cancel_token.cancelled):
+            conn.close()
+        else:
+            self.release(*key, conn)
+
+    def request(self, method, url, body=None, headers=None, timeout=30, cancel_token=None):
+        """Send a request over a pooled connection and read the whole response.
+
+        Raises HTTPError for 4xx/5xx answers and URLError for connection
+        failures (including cancellation), so callers can keep their
+        urlopen error handling.
+        """
+        key, conn, response = self.send(method, url, body, headers, timeout, cancel_token)
+        try:
+            data = response.read()
+        except OSError as e:
+            conn.close()
+            raise URLError(e)
+        except BaseException:
+            conn.close()
+            raise
+        self.finish(key, conn, response, cancel_token)
+
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(data))
+        return UpstreamResponse(response.status, response.reason, response.headers, data)
+
+    def post(self, url, data, headers=None, timeout=30, cancel_token=None):
+        return self.request('POST', url, body=data, headers=headers, timeout=timeout,
+                            cancel_token=cancel_token)
+
+    def stream(self, url, data, headers=None, timeout=30, cancel_token=None):
+        """POST and return an UpstreamStream as soon as the response head arrives"""
+        key, conn, response = self.send('POST', url, data, headers, timeout, cancel_token)
+        if response.status >= 400:
+            try:
+                error_body = response.read()
+            except (OSError, http.client.HTTPException):
+                error_body = b''
+            conn.close()
+            raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(error_body))
+        return UpstreamStream(self, key, conn, response, cancel_token)
+
+    def stats(self):
+        with self.lock:
+            idle_connections = sum(len(idle) for idle in self.idle.values())
+            avg_connect = self.connect_seconds / self.connect_count if self.connect_count else 0.0
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'idle_connections': idle_connections,
+                'max_per_host': self.max_per_host,
+                'idle_timeout': self.idle_timeout,
+                'avg_connect_ms': round(avg_connect * 1000, 2),
+                # Handshake time not spent thanks to reuse, estimated from the average connect cost
+                'saved_connect_ms': round(self.hits * avg_connect * 1000, 2),
+            }
+
+
+# Shared pool used by every forwarding path in the process
+upstream_pool = UpstreamPool()
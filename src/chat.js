@@ -8,6 +8,12 @@ class ChatWidget {
         this.maxRetries = 3;
         this.retryDelay = 1000; // 1 second
         this.requestTimeout = 10000; // 10 seconds
+        // Render replies token by token via /api/chat/stream (opt-in: streamed answers skip the
+        // proxy's response cache and request coalescing, so enable it only for streaming n8n workflows)
+        this.streamResponses = false;
+        // Queue messages as server-side jobs (202 + long-poll) instead of holding the request open
+        this.asyncJobs = false;
+        this.jobTimeout = 120000; // 2 minutes
         this.connectionStatus = 'unknown';
         this.lastError = null;
         this.init();
@@ -302,10 +308,22 @@ class ChatWidget {
         console.log('[Chat] Showing typing indicator');
         this.showTypingIndicator();
 
+        // Agent bubble that streamed text is written into as it arrives
+        let streamedMessage = null;
+        const onStreamText = (text) => {
+            if (!streamedMessage) {
+                // First token replaces the typing indicator
+                this.hideTypingIndicator();
+                streamedMessage = this.addMessage('', 'agent');
+            }
+            streamedMessage.textContent = text;
+            this.scrollToBottom();
+        };
+
         try {
             // Send message to n8n webhook
             console.log('[Chat] Calling sendToN8n...');
-            const response = await this.sendToN8n(message, this.selectedFiles);
+            const response = await this.sendToN8n(message, this.selectedFiles, onStreamText);
             console.log('[Chat] Response from n8n:', response);
             
             // Clear selected files
@@ -315,7 +333,14 @@ class ChatWidget {
             this.hideTypingIndicator();
 
             // Add agent response - check different response formats
-            if (response && response.output) {
+            if (streamedMessage) {
+                if (response && response.output) {
+                    streamedMessage.textContent = response.output;
+                }
+            } else if (response && response.merged) {
+                // Sent to the agent together with a later message, which carries the reply
+                console.log('[Chat] Message merged into the next reply');
+            } else if (response && response.output) {
                 this.addMessage(response.output, 'agent');
             } else if (response && response.text) {
                 this.addMessage(response.text, 'agent');
@@ -361,7 +386,7 @@ class ChatWidget {
         }
     }
 
-    async sendToN8n(message, files = []) {
+    async sendToN8n(message, files = [], onStreamText = null) {
         console.log('[Chat] sendToN8n called with message:', message);
         console.log('[Chat] Files count:', files.length);
 
@@ -379,7 +404,10 @@ class ChatWidget {
         console.log('[Chat] Payload:', payload);
 
         // Use proxy endpoint to avoid CORS issues
-        const url = '/api/chat';
+        // Only where the browser can read response bodies as they arrive
+        const canStream = typeof ReadableStream !== 'undefined' && typeof TextDecoder !== 'undefined';
+        const streaming = Boolean(onStreamText) && this.streamResponses && canStream && !this.asyncJobs;
+        const url = streaming ? '/api/chat/stream' : (this.asyncJobs ? '/api/chat?async=1' : '/api/chat');
         console.log('[Chat] Sending to URL:', url);
 
         return await this.retryRequest(async () => {
@@ -411,6 +439,8 @@ class ChatWidget {
                     
                     response = await fetch(url, {
                         method: 'POST',
+                        // Lets the proxy apply the session's rate limit before reading the upload
+                        headers: { 'X-Session-Id': this.sessionId },
                         body: formData,
                         signal: controller.signal,
                         mode: 'cors',
@@ -424,7 +454,8 @@ class ChatWidget {
                         headers: {
                             'Content-Type': 'application/json',
                             'X-Requested-With': 'XMLHttpRequest', // Help identify AJAX requests
-                            'Cache-Control': 'no-cache'
+                            'Cache-Control': 'no-cache',
+                            'X-Session-Id': this.sessionId
                         },
                         body: JSON.stringify(payload),
                         signal: controller.signal,
@@ -438,8 +469,15 @@ class ChatWidget {
 
                 console.log('[Chat] Response status:', response.status, response.statusText);
 
+                if (response.status === 202) {
+                    // Accepted as a job: the answer comes from its status URL
+                    response = await this.waitForJob(await response.json());
+                }
+
                 if (response.ok) {
-                    const responseText = await response.text();
+                    const responseText = streaming && response.body
+                        ? await this.readStreamedResponse(response, onStreamText)
+                        : await response.text();
                     console.log('[Chat] Response text:', responseText);
 
                     if (!responseText.trim()) {
@@ -467,7 +505,10 @@ class ChatWidget {
                 const errorText = await response.text();
                 this.connectionStatus = 'error';
                 this.lastError = `HTTP ${response.status}: ${errorText}`;
-                throw new Error(`HTTP error! status: ${response.status} - ${errorText}`);
+                const httpError = new Error(`HTTP error! status: ${response.status} - ${errorText}`);
+                // 429 and 503 say when it is worth trying again
+                httpError.retryAfter = Number(response.headers.get('Retry-After')) || 0;
+                throw httpError;
                 
             } catch (error) {
                 clearTimeout(timeoutId);
@@ -492,6 +533,77 @@ class ChatWidget {
         });
     }
 
+    async waitForJob(job) {
+        console.log('[Chat] Message queued as job:', job.jobId);
+        const deadline = Date.now() + this.jobTimeout;
+
+        while (Date.now() < deadline) {
+            // Long-poll: the server answers as soon as the job finishes, or after ~20s
+            const response = await fetch(`${job.statusUrl}?wait=20`, {
+                cache: 'no-store',
+                credentials: 'same-origin'
+            });
+            if (response.status !== 202) {
+                return response;
+            }
+        }
+
+        const error = new Error('Job timed out');
+        error.name = 'AbortError';
+        throw error;
+    }
+
+    async readStreamedResponse(response, onText) {
+        // n8n streaming webhooks send one JSON object per line ({"type":"item","content":"..."});
+        // any other body is a regular JSON answer, parsed once it is complete
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let raw = '';
+        let pending = '';
+        let streamedText = '';
+        let isTokenStream = false;
+
+        const handleLine = (line) => {
+            const token = this.parseStreamLine(line);
+            if (token === null) return;
+            isTokenStream = true;
+            if (token) {
+                streamedText += token;
+                onText(streamedText);
+            }
+        };
+
+        while (true) {
+            const { done, value } = await reader.read();
+            const text = done ? decoder.decode() : decoder.decode(value, { stream: true });
+            raw += text;
+            pending += text;
+            const lines = pending.split('\n');
+            pending = done ? '' : lines.pop();
+            lines.forEach(handleLine);
+            if (done) break;
+        }
+
+        return isTokenStream ? JSON.stringify({ output: streamedText }) : raw;
+    }
+
+    parseStreamLine(line) {
+        // Token text of a streaming line, '' for begin/end markers, null if it is not one
+        if (!line.trim()) return null;
+        try {
+            const item = JSON.parse(line);
+            if (item && item.type === 'item') {
+                return typeof item.content === 'string' ? item.content : '';
+            }
+            if (item && (item.type === 'begin' || item.type === 'end')) {
+                return '';
+            }
+        } catch (e) {
+            // Part of a multi-line JSON body
+        }
+        return null;
+    }
+
     addMessage(content, sender) {
         const chatMessages = document.getElementById('chatMessages');
         if (!chatMessages) {
@@ -509,6 +621,7 @@ class ChatWidget {
         chatMessages.appendChild(messageDiv);
         
         this.scrollToBottom();
+        return contentDiv;
     }
 
     showTypingIndicator() {
@@ -565,7 +678,8 @@ class ChatWidget {
             return await requestFunction();
         } catch (error) {
             if (attempt < this.maxRetries) {
-                const delay = this.retryDelay * Math.pow(2, attempt - 1); // Exponential backoff
+                // Exponential backoff, but never sooner than the server's Retry-After
+                const delay = Math.max(this.retryDelay * Math.pow(2, attempt - 1), (error.retryAfter || 0) * 1000);
                 
                 // Show retry indicator to user
                 this.showRetryIndicator(attempt);